@@ -0,0 +1,54 @@
+import numpy as np
+
+# Rn/Delta Rn curves of a plate as one float64 array:
+#
+#   values[i, cycle, 0] = Rn, values[i, cycle, 1] = Delta Rn
+#
+# where i is the row of the well in the well-index map. Rows are filled in
+# (well, cycle) order, counts[i] is the number of points of the well (wells
+# with fewer cycles are padded with NaN). curves() returns a view of the
+# array, no data is copied per well. Values keep the float64 of the parse,
+# so the amplificationdata payloads carry the exported decimals (float32
+# would turn 1.0010 into 1.0010000467300415).
+
+rn_dtype = np.float64
+
+
+class AmplificationMatrix(object):
+
+   def __init__(self, wells, values, counts):
+      self.wells  = wells
+      self.values = values
+      self.counts = counts
+      self.index  = {well: i for i, well in enumerate(wells)}
+
+   @classmethod
+   def from_frame(cls, rn):
+      # rn: long-format table with well, cycle, Rn and Delta Rn columns
+      well  = rn['well'].astype(int).values
+      cycle = rn['cycle'].astype(int).values
+      order = np.lexsort((cycle, well))
+      well  = well[order]
+
+      wells, start, counts = np.unique(well, return_index=True, return_counts=True)
+      rows = np.repeat(np.arange(len(wells)), counts)
+      cols = np.arange(len(well)) - np.repeat(start, counts)
+
+      values = np.full((len(wells), counts.max() if len(wells) else 0, 2), np.nan, dtype=rn_dtype)
+      values[rows, cols, 0] = rn['Rn'].values[order]
+      values[rows, cols, 1] = rn['Delta Rn'].values[order]
+      return cls(wells.tolist(), values, counts)
+
+   def __len__(self):
+      return len(self.wells)
+
+   def __contains__(self, well):
+      return int(well) in self.index
+
+   def curves(self, well):
+      # (cycles, 2) view with the Rn and Delta Rn of the well (empty if the
+      # well has no curves)
+      i = self.index.get(int(well))
+      if i is None:
+         return np.empty((0, 2), dtype=rn_dtype)
+      return self.values[i, :self.counts[i]]
@@ -0,0 +1,146 @@
+import os, glob, uuid, datetime
+import numpy as np
+
+# Cross-plate archive of parsed qPCR results and amplification curves. Each
+# plate is stored as one compressed file of typed columns per table, under a
+# partition folder per run date and instrument:
+#
+#   {root}/{table}/date=YYYY-MM-DD/instrument={name}/{plate}.npz
+#
+# Queries only open the partitions that match the date/instrument range.
+
+ARCHIVE_FORMAT = 1
+
+# Stored columns of each table, partition columns (date, instrument) are
+# added when reading.
+archive_schema = {
+   'results': [
+      ('plate',     np.str_),
+      ('well',      np.int16),
+      ('detector',  np.str_),
+      ('ct',        np.float64),
+      ('threshold', np.float64),
+      ('run_date',  'datetime64[s]')
+   ],
+   'rn': [
+      ('plate',     np.str_),
+      ('well',      np.int16),
+      ('cycle',     np.int16),
+      ('rn',        np.float64),
+      ('delta_rn',  np.float64)
+   ]
+}
+
+partition_columns = ('date', 'instrument')
+
+
+def as_date(value):
+   # Accepts dates, datetimes and YYYY-MM-DD strings, returns YYYY-MM-DD
+   if value is None:
+      return None
+   if isinstance(value, (datetime.date, datetime.datetime)):
+      return value.strftime('%Y-%m-%d')
+   return str(value)[:10]
+
+
+class ResultsArchive(object):
+
+   def __init__(self, root):
+      self.root = root
+      os.makedirs(root, exist_ok=True)
+
+   def _partition_dir(self, table, date, instrument):
+      return os.path.join(self.root, table, 'date={}'.format(as_date(date)), 'instrument={}'.format(instrument.lower()))
+
+   ##
+   ## WRITE
+   ##
+
+   def write(self, table, plate, date, instrument, columns):
+      # columns: {column: values} with the columns of archive_schema[table].
+      # Writing a plate again replaces its previous entry.
+      arrays = {'__format__': np.array(ARCHIVE_FORMAT)}
+      rows   = None
+      for name, dtype in archive_schema[table]:
+         arrays[name] = np.asarray(columns[name]).astype(dtype)
+         if rows is None:
+            rows = len(arrays[name])
+         elif rows != len(arrays[name]):
+            raise ValueError('column {} has {} rows, expected {}'.format(name, len(arrays[name]), rows))
+
+      part_dir = self._partition_dir(table, date, instrument)
+      os.makedirs(part_dir, exist_ok=True)
+      fname = os.path.join(part_dir, '{}.npz'.format(plate))
+      tmp   = os.path.join(part_dir, '.{}.{}.tmp'.format(plate, uuid.uuid4().hex[:8]))
+      with open(tmp, 'wb') as f:
+         np.savez_compressed(f, **arrays)
+      os.replace(tmp, fname)
+
+      # Drop the entries of this plate in other partitions (resync with a
+      # different run date or instrument)
+      for old in glob.glob(os.path.join(self.root, table, 'date=*', 'instrument=*', '{}.npz'.format(glob.escape(plate)))):
+         if os.path.abspath(old) != os.path.abspath(fname):
+            os.remove(old)
+
+      return fname
+
+   ##
+   ## QUERY
+   ##
+
+   def partitions(self, table, start=None, end=None, instrument=None):
+      # Returns [(date, instrument, folder)] in the date range (inclusive)
+      start, end = as_date(start), as_date(end)
+      parts = []
+      for date_dir in sorted(glob.glob(os.path.join(self.root, table, 'date=*'))):
+         date = os.path.basename(date_dir).split('=', 1)[1]
+         if (start is not None and date < start) or (end is not None and date > end):
+            continue
+         for inst_dir in sorted(glob.glob(os.path.join(date_dir, 'instrument=*'))):
+            inst = os.path.basename(inst_dir).split('=', 1)[1]
+            if instrument is not None and inst != instrument.lower():
+               continue
+            parts.append((date, inst, inst_dir))
+      return parts
+
+   def load(self, table, columns=None, start=None, end=None, instrument=None, **equals):
+      # Returns {column: array} of the matching rows. Keyword arguments
+      # filter on column equality, e.g. load('results', ['ct'], detector='N1').
+      names  = [name for name, dtype in archive_schema[table]] + list(partition_columns)
+      wanted = names if columns is None else list(columns)
+      for name in list(wanted) + list(equals):
+         if not name in names:
+            raise KeyError('unknown {} column: {}'.format(table, name))
+
+      chunks = {name: [] for name in wanted}
+      for date, inst, part_dir in self.partitions(table, start, end, instrument):
+         for fname in sorted(glob.glob(os.path.join(part_dir, '*.npz'))):
+            with np.load(fname, allow_pickle=False) as data:
+               rows = len(data[archive_schema[table][0][0]])
+               cols = {}
+               def column(name):
+                  if not name in cols:
+                     if name == 'date':
+                        cols[name] = np.full(rows, date, dtype='datetime64[D]')
+                     elif name == 'instrument':
+                        cols[name] = np.full(rows, inst)
+                     else:
+                        cols[name] = data[name]
+                  return cols[name]
+
+               mask = None
+               for name, value in equals.items():
+                  m = column(name) == value
+                  mask = m if mask is None else mask & m
+               if mask is not None and not mask.any():
+                  continue
+               for name in wanted:
+                  chunks[name].append(column(name) if mask is None else column(name)[mask])
+
+      empty = dict(archive_schema[table], date='datetime64[D]', instrument=np.str_)
+      return {name: np.concatenate(chunks[name]) if chunks[name] else np.zeros(0, dtype=empty[name]) for name in wanted}
+
+   def frame(self, table, columns=None, start=None, end=None, instrument=None, **equals):
+      import pandas as pd
+      data = self.load(table, columns, start, end, instrument, **equals)
+      return pd.DataFrame(data, columns=list(data))
@@ -0,0 +1,65 @@
+import os, json, uuid
+
+# Per-plate upload checkpoints. lims_sync records the wells whose results and
+# amplification data were fully written, so an interrupted plate is resumed
+# instead of deleted and uploaded again. A checkpoint is only valid while the
+# parsed source files (size and mtime) are unchanged.
+#
+#   {root}/{plate}.json = {'sources': [[path, size, mtime_ns]], 'wells': {position: results_uri}}
+
+def source_signature(paths):
+   sig = []
+   for path in paths:
+      st = os.stat(path)
+      sig.append([os.path.abspath(path), st.st_size, st.st_mtime_ns])
+   return sig
+
+
+class UploadCheckpoint(object):
+
+   def __init__(self, root):
+      self.root  = root
+      self.state = {}
+      os.makedirs(root, exist_ok=True)
+
+   def _fname(self, plate):
+      return os.path.join(self.root, '{}.json'.format(plate))
+
+   def load(self, plate, sources):
+      # Returns {position: results_uri} of the complete wells, empty if there
+      # is no checkpoint or the source files changed.
+      sig = source_signature(sources)
+      try:
+         with open(self._fname(plate)) as f:
+            state = json.load(f)
+      except (IOError, OSError, ValueError):
+         state = None
+      if state is None or state.get('sources') != sig:
+         state = {'sources': sig, 'wells': {}}
+      self.state[plate] = state
+      return dict(state['wells'])
+
+   def keep(self, plate, wells):
+      # Drops the wells that could not be verified in LIMS
+      state = self.state[plate]
+      state['wells'] = {pos: uri for pos, uri in state['wells'].items() if pos in wells}
+      self._write(plate)
+
+   def complete(self, plate, wells):
+      # wells: {position: results_uri} written successfully
+      self.state[plate]['wells'].update(wells)
+      self._write(plate)
+
+   def clear(self, plate):
+      self.state.pop(plate, None)
+      try:
+         os.remove(self._fname(plate))
+      except FileNotFoundError:
+         pass
+
+   def _write(self, plate):
+      fname = self._fname(plate)
+      tmp   = os.path.join(self.root, '.{}.{}.tmp'.format(plate, uuid.uuid4().hex[:8]))
+      with open(tmp, 'w') as f:
+         json.dump(self.state[plate], f)
+      os.replace(tmp, fname)
@@ -0,0 +1,311 @@
+import os, json, time, shutil, uuid
+import numpy as np
+
+# Columnar on-disk storage of LIMS collections. Every column is stored as a
+# typed .npy file so it can be memory-mapped or loaded on its own. Nested
+# objects (dicts, lists) are stored as JSON strings.
+
+COLUMNAR_FORMAT = 1
+
+column_kinds = ('bool', 'int', 'float', 'str', 'json')
+
+
+###
+### COLUMN ENCODING
+###
+
+def column_kind(values):
+   kind = None
+   for v in values:
+      if v is None:
+         continue
+      if isinstance(v, (dict, list)):
+         return 'json'
+      if isinstance(v, (bool, np.bool_)):
+         k = 'bool'
+      elif isinstance(v, (int, np.integer)):
+         k = 'int'
+      elif isinstance(v, (float, np.floating)):
+         k = 'float'
+      else:
+         k = 'str'
+
+      if kind is None or kind == k:
+         kind = k
+      elif set([kind, k]) == set(['int', 'float']):
+         kind = 'float'
+      else:
+         kind = 'str'
+   return kind or 'str'
+
+def encode_column(values, kind=None):
+   # Returns (typed array, null mask or None, kind)
+   values = list(values)
+   kind   = kind or column_kind(values)
+   nulls  = np.array([v is None for v in values], dtype=bool)
+
+   if kind == 'bool':
+      data = np.array([bool(v) if v is not None else False for v in values], dtype=np.bool_)
+   elif kind == 'int':
+      data = np.array([v if v is not None else 0 for v in values], dtype=np.int64)
+   elif kind == 'float':
+      data = np.array([v if v is not None else np.nan for v in values], dtype=np.float64)
+   elif kind == 'json':
+      data = np.array([json.dumps(v) if v is not None else '' for v in values], dtype=np.str_)
+   else:
+      data = np.array([str(v) if v is not None else '' for v in values], dtype=np.str_)
+
+   # Keep an empty column typed (np.array([]) defaults to float64)
+   if len(values) == 0 and kind in ('str', 'json'):
+      data = np.zeros(0, dtype='<U1')
+
+   return data, (nulls if nulls.any() else None), kind
+
+def decode_value(v, kind, null):
+   if null:
+      return None
+   if kind == 'json':
+      return json.loads(v)
+   return v.item() if hasattr(v, 'item') else v
+
+
+###
+### OBJECT PROJECTION
+###
+
+def get_path(obj, path):
+   for key in path:
+      if obj is None:
+         return None
+      obj = obj.get(key) if isinstance(obj, dict) else None
+   return obj
+
+def normalize_fields(fields):
+   # fields: None, list of keys or {column: key or (key, subkey, ...)}. Keys
+   # in a list follow the LIMS filter syntax for nested fields (sample__project).
+   if fields is None:
+      return None
+   if not isinstance(fields, dict):
+      fields = {f: tuple(f.split('__')) for f in fields}
+   return {name: (tuple(path) if isinstance(path, (list, tuple)) else (path,)) for name, path in fields.items()}
+
+def objects_to_columns(objects, fields=None):
+   # Converts a list of LIMS objects (dicts) into {column: [values]}. When
+   # fields is given only those (possibly nested) fields are kept.
+   fields = normalize_fields(fields)
+   if fields is None:
+      names = []
+      for o in objects:
+         for k in o:
+            if not k in names:
+               names.append(k)
+      fields = {k: (k,) for k in names}
+
+   return {name: [get_path(o, path) for o in objects] for name, path in fields.items()}
+
+
+###
+### PAGE TO COLUMN CONVERSION
+###
+
+def merge_chunks(chunks):
+   # chunks: list of (array, nulls, kind) for the same column
+   kinds = set(kind for arr, nulls, kind in chunks if not (nulls is not None and nulls.all()))
+   if len(kinds) > 1:
+      # Pages disagree on the column type, re-encode the decoded values
+      values = [decode_value(v, kind, n) for arr, nulls, kind in chunks for v, n in zip(arr, nulls if nulls is not None else np.zeros(len(arr), dtype=bool))]
+      return encode_column(values)
+
+   kind  = kinds.pop() if kinds else chunks[0][2]
+   parts = [arr if k == kind else encode_column([None]*len(arr), kind)[0] for arr, nulls, k in chunks]
+   data  = np.concatenate(parts) if parts else encode_column([], kind)[0]
+   nulls = np.concatenate([nulls if nulls is not None else np.zeros(len(arr), dtype=bool) for arr, nulls, k in chunks]) if chunks else np.zeros(0, dtype=bool)
+   return data, (nulls if nulls.any() else None), kind
+
+def columns_to_frame(data, nulls, kinds):
+   import pandas as pd
+   frame = {}
+   for name in data:
+      kind = kinds[name]
+      col  = data[name]
+      mask = nulls.get(name)
+      if kind == 'json':
+         col = [decode_value(v, kind, n) for v, n in zip(col, mask if mask is not None else np.zeros(len(col), dtype=bool))]
+      elif mask is not None:
+         if kind in ('int', 'float'):
+            col = np.where(mask, np.nan, col.astype(np.float64))
+         else:
+            col = np.where(mask, None, col.astype(object))
+      frame[name] = col
+   return pd.DataFrame(frame, columns=list(data))
+
+class ColumnBuilder(object):
+   # Converts pages of LIMS objects into typed columns as they arrive, so
+   # only the projected fields are kept in memory.
+
+   def __init__(self, fields):
+      self.fields = normalize_fields(fields)
+      self.chunks = {name: [] for name in self.fields}
+      self.rows   = 0
+
+   def append(self, objects):
+      for name, values in objects_to_columns(objects, self.fields).items():
+         self.chunks[name].append(encode_column(values))
+      self.rows += len(objects)
+
+   def columns(self):
+      # Returns ({column: array}, {column: null mask or None}, {column: kind})
+      data, nulls, kinds = {}, {}, {}
+      for name, chunks in self.chunks.items():
+         merged = merge_chunks(chunks)
+         data[name], nulls[name], kinds[name] = merged
+         self.chunks[name] = [merged]
+      return data, nulls, kinds
+
+   def frame(self):
+      return columns_to_frame(*self.columns())
+
+
+###
+### SNAPSHOT STORE
+###
+
+class SnapshotStore(object):
+   # Layout: {root}/{collection}/{generation}/{column}.npy (+ {column}.null.npy)
+   #         {root}/{collection}/{generation}/meta.json
+   #         {root}/{collection}/CURRENT (name of the active generation)
+
+   def __init__(self, root):
+      self.root = root
+      os.makedirs(root, exist_ok=True)
+
+   def _collection_dir(self, collection):
+      return os.path.join(self.root, collection)
+
+   def _current_dir(self, collection):
+      try:
+         with open(os.path.join(self._collection_dir(collection), 'CURRENT')) as f:
+            gen = f.read().strip()
+      except (IOError, OSError):
+         return None
+      return os.path.join(self._collection_dir(collection), gen) if gen else None
+
+   def collections(self):
+      return sorted(c for c in os.listdir(self.root) if self._current_dir(c))
+
+   def _read_meta(self, gen_dir):
+      try:
+         with open(os.path.join(gen_dir, 'meta.json')) as f:
+            return json.load(f)
+      except (IOError, OSError, ValueError):
+         return None
+
+   def meta(self, collection):
+      gen_dir = self._current_dir(collection)
+      return None if gen_dir is None else self._read_meta(gen_dir)
+
+   def age(self, collection):
+      meta = self.meta(collection)
+      return None if meta is None else time.time() - meta['created']
+
+   def is_fresh(self, collection, max_age):
+      age = self.age(collection)
+      return age is not None and max_age is not None and age <= max_age
+
+   def save(self, collection, data, fields=None, kinds=None):
+      # data: list of LIMS objects or {column: values}
+      columns = data if isinstance(data, dict) else objects_to_columns(data, fields)
+      kinds   = kinds or {}
+      names   = list(columns)
+      encoded = [encode_column(columns[name], kinds.get(name)) for name in names]
+      return self.save_columns(collection, names, encoded)
+
+   def save_builder(self, collection, builder):
+      data, nulls, kinds = builder.columns()
+      return self.save_columns(collection, list(data), [(data[n], nulls[n], kinds[n]) for n in data])
+
+   def save_columns(self, collection, names, encoded):
+      # encoded: list of (array, null mask or None, kind) matching names
+      col_dir = self._collection_dir(collection)
+      gen     = '{}.{}'.format(int(time.time()*1000), uuid.uuid4().hex[:8])
+      gen_dir = os.path.join(col_dir, gen)
+      os.makedirs(gen_dir)
+
+      meta = {
+         'format':     COLUMNAR_FORMAT,
+         'collection': collection,
+         'created':    time.time(),
+         'rows':       None,
+         'columns':    {}
+      }
+      for name, (arr, nulls, kind) in zip(names, encoded):
+         if meta['rows'] is None:
+            meta['rows'] = len(arr)
+         elif meta['rows'] != len(arr):
+            shutil.rmtree(gen_dir, ignore_errors=True)
+            raise ValueError('column {} has {} rows, expected {}'.format(name, len(arr), meta['rows']))
+         np.save(os.path.join(gen_dir, '{}.npy'.format(name)), arr, allow_pickle=False)
+         if nulls is not None:
+            np.save(os.path.join(gen_dir, '{}.null.npy'.format(name)), nulls, allow_pickle=False)
+         meta['columns'][name] = {'kind': kind, 'nulls': nulls is not None}
+      meta['rows'] = meta['rows'] or 0
+
+      with open(os.path.join(gen_dir, 'meta.json'), 'w') as f:
+         json.dump(meta, f)
+
+      # Switch the active generation atomically, then drop old generations
+      tmp = os.path.join(col_dir, 'CURRENT.{}'.format(gen))
+      with open(tmp, 'w') as f:
+         f.write(gen)
+      os.replace(tmp, os.path.join(col_dir, 'CURRENT'))
+
+      for old in os.listdir(col_dir):
+         if old != gen and not old.startswith('CURRENT'):
+            shutil.rmtree(os.path.join(col_dir, old), ignore_errors=True)
+
+      return meta
+
+   def _load(self, collection, columns, mmap, max_age):
+      # Reads one generation only, even if a new one is saved meanwhile
+      gen_dir = self._current_dir(collection)
+      meta    = None if gen_dir is None else self._read_meta(gen_dir)
+      if meta is None or (max_age is not None and time.time() - meta['created'] > max_age):
+         return None
+      if columns is not None and not all(name in meta['columns'] for name in columns):
+         return None
+
+      columns = list(meta['columns']) if columns is None else columns
+      mode    = 'r' if mmap else None
+      data, nulls, kinds = {}, {}, {}
+      try:
+         for name in columns:
+            data[name]  = np.load(os.path.join(gen_dir, '{}.npy'.format(name)), mmap_mode=mode, allow_pickle=False)
+            nulls[name] = np.load(os.path.join(gen_dir, '{}.null.npy'.format(name)), mmap_mode=mode) if meta['columns'][name]['nulls'] else None
+            kinds[name] = meta['columns'][name]['kind']
+      except (IOError, OSError):
+         # Generation removed by a concurrent save
+         return None
+      return data, nulls, kinds, meta['rows']
+
+   def load(self, collection, columns=None, mmap=True, max_age=None):
+      # Returns ({column: array}, {column: null mask or None}) or None if the
+      # snapshot is missing, older than max_age (seconds) or lacks a column.
+      loaded = self._load(collection, columns, mmap, max_age)
+      return None if loaded is None else loaded[:2]
+
+   def load_frame(self, collection, columns=None, max_age=None):
+      loaded = self._load(collection, columns, False, max_age)
+      return None if loaded is None else columns_to_frame(*loaded[:3])
+
+   def load_records(self, collection, columns=None, max_age=None):
+      # Rebuilds the list of LIMS objects (only the requested columns)
+      loaded = self._load(collection, columns, False, max_age)
+      if loaded is None:
+         return None
+      data, nulls, kinds, rows = loaded
+      names = list(data)
+      cols  = []
+      for name in names:
+         mask = nulls[name] if nulls[name] is not None else np.zeros(rows, dtype=bool)
+         cols.append([decode_value(v, kinds[name], n) for v, n in zip(data[name], mask)])
+      return [dict(zip(names, vals)) for vals in zip(*cols)] if names else [{} for i in range(rows)]
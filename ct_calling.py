@@ -0,0 +1,61 @@
+import numpy as np
+
+# Local Ct calling from the amplification curves of a plate. All wells are
+# processed at once on a (wells x cycles) matrix: the baseline of each curve
+# is fitted and subtracted, and Ct is the cycle where the corrected curve
+# crosses the threshold for the last time (upwards), linearly interpolated
+# between the two cycles around the crossing.
+
+default_baseline = (3, 15) # first and last baseline cycles (ABI default)
+
+
+def curve_matrix(wells, cycles, values):
+   # Long (well, cycle, value) arrays to (well ids, cycle ids, wells x cycles)
+   well_ids, well_idx   = np.unique(np.asarray(wells), return_inverse=True)
+   cycle_ids, cycle_idx = np.unique(np.asarray(cycles), return_inverse=True)
+   curves = np.full((len(well_ids), len(cycle_ids)), np.nan)
+   curves[well_idx, cycle_idx] = np.asarray(values, dtype=np.float64)
+   return well_ids, cycle_ids, curves
+
+def baseline_correct(curves, cycles, baseline=default_baseline):
+   # Subtracts the least squares line fitted to the baseline cycles
+   cycles = np.asarray(cycles, dtype=np.float64)
+   sel    = (cycles >= baseline[0]) & (cycles <= baseline[1])
+   if sel.sum() < 2:
+      # Not enough cycles to fit a line
+      return curves.copy()
+
+   x     = cycles[sel] - cycles[sel].mean()
+   y     = curves[:, sel]
+   ymean = np.nanmean(y, axis=1)
+   slope = np.nansum(x[None,:] * (y - ymean[:,None]), axis=1) / (x**2).sum()
+   fit   = ymean[:,None] + slope[:,None] * (cycles[None,:] - cycles[sel].mean())
+   return curves - fit
+
+def threshold_crossing(curves, cycles, thresholds):
+   # Interpolated cycle of the last upward threshold crossing of each curve,
+   # NaN if the curve does not end above the threshold.
+   cycles     = np.asarray(cycles, dtype=np.float64)
+   thresholds = np.broadcast_to(np.asarray(thresholds, dtype=np.float64), (curves.shape[0],))
+   above      = curves >= thresholds[:,None]
+   cross      = above[:,1:] & ~above[:,:-1]
+
+   # Last crossing: first True in the reversed rows
+   found = cross.any(axis=1) & above[:,-1]
+   last  = cross.shape[1] - 1 - np.argmax(cross[:,::-1], axis=1)
+   rows  = np.arange(curves.shape[0])
+   y0, y1 = curves[rows, last], curves[rows, last+1]
+   c0, c1 = cycles[last], cycles[last+1]
+   with np.errstate(divide='ignore', invalid='ignore'):
+      ct = c0 + (thresholds - y0) / (y1 - y0) * (c1 - c0)
+   ct[~found] = np.nan
+   return ct
+
+def call_ct(wells, cycles, rn, thresholds, baseline=default_baseline):
+   # wells, cycles, rn: long arrays of the plate curves; thresholds: scalar
+   # or {well: threshold}. Returns (well ids, Ct array), NaN = undetermined.
+   well_ids, cycle_ids, curves = curve_matrix(wells, cycles, rn)
+   if isinstance(thresholds, dict):
+      thresholds = np.array([thresholds.get(w, np.nan) for w in well_ids], dtype=np.float64)
+   corrected = baseline_correct(curves, cycle_ids, baseline)
+   return well_ids, threshold_crossing(corrected, cycle_ids, thresholds)
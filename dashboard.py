@@ -0,0 +1,107 @@
+import time, threading, logging, traceback
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+from html_report import escape
+
+# Local HTTP dashboard. Pages are served from an in-memory snapshot that a
+# background thread rebuilds every `interval` seconds, so page views never
+# wait for (or load) LIMS. If a refresh fails, the last good snapshot is
+# kept and the error is shown on top of it.
+
+default_interval = 300 # seconds between refreshes
+
+error_html = '<p style="color:red"><b>Last refresh failed ({}):</b> {}</p>'
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+   daemon_threads = True
+
+
+class Dashboard(object):
+
+   def __init__(self, build, interval=default_interval):
+      # build(): returns the page HTML (str)
+      self.build     = build
+      self.interval  = interval
+      self.html      = None
+      self.updated   = None
+      self.error     = None
+      self.refreshes = 0
+      self.stopped   = threading.Event()
+      self.thread    = None
+
+   def refresh(self):
+      start = time.time()
+      try:
+         html = self.build()
+      except Exception:
+         self.error = (time.strftime('%d/%m/%Y %H:%M:%S'), traceback.format_exc().strip().split('\n')[-1])
+         logging.error(' dashboard: refresh failed\n{}'.format(traceback.format_exc()))
+         return False
+      # Replaced as a whole, request threads always see a complete snapshot
+      self.html, self.updated, self.error = html.encode('utf-8'), time.time(), None
+      self.refreshes += 1
+      logging.info(' dashboard: snapshot refreshed in {:.1f}s ({} bytes)'.format(time.time() - start, len(self.html)))
+      return True
+
+   def run(self):
+      while not self.stopped.wait(self.interval):
+         self.refresh()
+
+   def start(self):
+      # First snapshot before serving, then refresh in the background
+      self.refresh()
+      self.thread = threading.Thread(target=self.run, name='dashboard-refresh', daemon=True)
+      self.thread.start()
+
+   def stop(self):
+      self.stopped.set()
+      if self.thread is not None:
+         self.thread.join()
+
+   def page(self):
+      html, error = self.html, self.error
+      if error is None:
+         return html or b'<p>Loading...</p>'
+      note = error_html.format(*[escape(e) for e in error]).encode('utf-8')
+      if html is None:
+         return note
+      # Right after the opening <body> tag of the snapshot
+      start = html.find(b'<body')
+      if start < 0:
+         return note + html
+      end = html.index(b'>', start) + 1
+      return html[:end] + note + html[end:]
+
+   def handler(self):
+      dashboard = self
+
+      class Handler(BaseHTTPRequestHandler):
+
+         def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/index.html'):
+               self.send_error(404)
+               return
+            body = dashboard.page()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-cache')
+            self.end_headers()
+            self.wfile.write(body)
+
+         def log_message(self, format, *args):
+            logging.debug(' dashboard: {} {}'.format(self.address_string(), format % args))
+
+      return Handler
+
+   def serve(self, host, port):
+      # Blocks until interrupted
+      self.start()
+      server = ThreadingHTTPServer((host, port), self.handler())
+      logging.info(' dashboard: serving on http://{}:{}/ (refresh every {}s)'.format(host, port, self.interval))
+      try:
+         server.serve_forever()
+      finally:
+         server.server_close()
+         self.stop()
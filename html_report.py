@@ -0,0 +1,82 @@
+import io, gzip
+from email.mime.text import MIMEText
+from email.mime.application import MIMEApplication
+
+# One-pass HTML report writer for the e-mail digests. Fragments are written
+# to buffers and joined once at the end; the index is collected while the
+# sections are written and placed below the title. Long blocks that do not
+# fit in the size budget are moved to gzip-compressed HTML attachments.
+
+default_size_budget = 1000000 # bytes of HTML in the e-mail body
+
+mono = '<span style="font-family:\'Courier New\'">{}</span>'
+
+def escape(text):
+   return str(text).replace('&','&amp;').replace('<','&lt;').replace('>','&gt;')
+
+
+class HtmlReport(object):
+
+   def __init__(self, style, size_budget=default_size_budget):
+      self.style       = style
+      self.size_budget = size_budget
+      self.head        = io.StringIO()
+      self.body        = io.StringIO()
+      self.index       = []
+      self.attachments = []
+      self.size        = 0
+      self._block      = None
+
+   def write(self, *fragments):
+      out = self._block if self._block is not None else self.body
+      for fragment in fragments:
+         out.write(fragment)
+         self.size += len(fragment)
+
+   def title(self, text):
+      # The title goes above the index
+      fragment = '<h1>{}</h1>\n'.format(text)
+      self.head.write(fragment)
+      self.size += len(fragment)
+
+   def section(self, anchor, title, label=None):
+      # label: index entry (defaults to the section title)
+      self.index.append('- <a href="#{}">{}</a><br>'.format(anchor, label or title))
+      self.write('<br><h2><a name="{}"></a>{}</h2>\n'.format(anchor, title))
+
+   def begin_block(self):
+      # Content written until end_block() may be moved to an attachment
+      self._block = io.StringIO()
+
+   def end_block(self, name, note):
+      block, self._block = self._block.getvalue(), None
+      if self.size_budget is None or self.size <= self.size_budget:
+         self.body.write(block)
+         return False
+
+      # Over budget: compress the block as a standalone document
+      self.size -= len(block)
+      fname = '{}.html.gz'.format(name)
+      doc   = '<html><head><style>{}</style></head><body>{}</body></html>'.format(self.style, block)
+      data  = gzip.compress(doc.encode('utf-8'))
+      self.attachments.append((fname, data))
+      self.write('<br><i>{} moved to attachment <b>{}</b> ({:.1f} KB) to keep this e-mail small.</i><br>\n'.format(note, fname, len(data)/1024.0))
+      return True
+
+   def render(self, out=None):
+      # Writes the full document to out (file-like) or returns it as a string
+      out_buf = out if out is not None else io.StringIO()
+      out_buf.write('<html><head><style>{}</style></head><body>'.format(self.style))
+      out_buf.write(self.head.getvalue())
+      out_buf.write(''.join(self.index))
+      out_buf.write(self.body.getvalue())
+      out_buf.write('</body></html>')
+      return out_buf.getvalue() if out is None else None
+
+   def mime_parts(self):
+      parts = [MIMEText(self.render(), 'html')]
+      for fname, data in self.attachments:
+         part = MIMEApplication(data, 'gzip', Name=fname)
+         part['Content-Disposition'] = 'attachment; filename="{}"'.format(fname)
+         parts.append(part)
+      return parts
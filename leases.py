@@ -0,0 +1,125 @@
+import os, json, time, uuid, socket, zlib
+
+# Plate sharding and leases for running lims_sync on several hosts that
+# share the export folder. Plates are partitioned across the workers by a
+# stable hash of the barcode, and a worker only syncs a plate while it holds
+# its lease, a lock file on the shared filesystem:
+#
+#   {root}/{plate}.lease = {'owner', 'host', 'pid', 'acquired'}
+#
+# Lock files are created with O_EXCL, so only one worker can hold a lease.
+# The lease expires `ttl` seconds after the last renewal (the mtime of the
+# file); expired leases of crashed workers are reclaimed by the next worker.
+
+default_ttl = 900 # seconds
+
+
+def shard_of(barcode, shards):
+   # Stable across hosts and runs (unlike hash())
+   return zlib.crc32(barcode.upper().encode('utf-8')) % shards
+
+def parse_shard(text):
+   # 'INDEX/COUNT' -> (index, count)
+   index, count = [int(x) for x in text.split('/')]
+   if count < 1 or not 0 <= index < count:
+      raise ValueError('shard index must be in [0, {})'.format(count))
+   return index, count
+
+
+class PlateLeases(object):
+
+   def __init__(self, root, owner=None, ttl=default_ttl):
+      self.root  = root
+      self.ttl   = ttl
+      self.owner = owner or '{}:{}:{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+      self.held  = set()
+      os.makedirs(root, exist_ok=True)
+
+   def _fname(self, plate):
+      return os.path.join(self.root, '{}.lease'.format(plate))
+
+   def _read(self, fname):
+      # (lease, mtime) or (None, None) if there is no lease file
+      try:
+         with open(fname) as f:
+            lease = json.load(f)
+         return lease, os.stat(fname).st_mtime
+      except FileNotFoundError:
+         return None, None
+      except ValueError:
+         # Being written by its owner or truncated: treated as a live lease
+         # until it is older than the ttl
+         try:
+            return {}, os.stat(fname).st_mtime
+         except FileNotFoundError:
+            return None, None
+
+   def _create(self, fname):
+      try:
+         fd = os.open(fname, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+      except FileExistsError:
+         return False
+      with os.fdopen(fd, 'w') as f:
+         json.dump({'owner': self.owner, 'host': socket.gethostname(), 'pid': os.getpid(), 'acquired': time.time()}, f)
+      return True
+
+   def acquire(self, plate):
+      # True if the lease is ours (new, already held or reclaimed)
+      if plate in self.held:
+         return self.renew(plate)
+      fname = self._fname(plate)
+      if self._create(fname):
+         self.held.add(plate)
+         return True
+
+      lease, mtime = self._read(fname)
+      if lease is not None and time.time() - mtime < self.ttl:
+         return False
+
+      # Expired: move the stale lease away (only one worker wins the rename)
+      # and check that it was still the stale one before taking the lease
+      stale = '{}.{}.stale'.format(fname, uuid.uuid4().hex[:8])
+      try:
+         os.rename(fname, stale)
+      except FileNotFoundError:
+         pass
+      else:
+         moved, moved_mtime = self._read(stale)
+         if moved is not None and time.time() - moved_mtime < self.ttl:
+            # Renewed or reclaimed meanwhile: put it back
+            try:
+               os.link(stale, fname)
+            except FileExistsError:
+               pass
+            os.remove(stale)
+            return False
+         os.remove(stale)
+
+      if self._create(fname):
+         self.held.add(plate)
+         return True
+      return False
+
+   def owns(self, plate):
+      lease, _ = self._read(self._fname(plate))
+      return lease is not None and lease.get('owner') == self.owner
+
+   def renew(self, plate):
+      # Extends the lease, False if it was lost (expired and reclaimed)
+      if not self.owns(plate):
+         self.held.discard(plate)
+         return False
+      os.utime(self._fname(plate))
+      return True
+
+   def release(self, plate):
+      if self.owns(plate):
+         try:
+            os.remove(self._fname(plate))
+         except FileNotFoundError:
+            pass
+      self.held.discard(plate)
+
+   def release_all(self):
+      for plate in list(self.held):
+         self.release(plate)
@@ -0,0 +1,270 @@
+import json, gzip, math, time, random, threading
+import requests
+
+try:
+   import orjson
+except ImportError:
+   orjson = None
+
+# HTTP client for the LIMS API. Bodies are serialized with orjson when
+# available and optionally gzip-compressed; the bytes sent and the CPU spent
+# serializing are accumulated in RequestStats. Idempotent calls are retried
+# with jittered exponential backoff, the number of concurrent calls adapts to
+# errors and latency (AIMD) and a circuit breaker fails fast during outages.
+
+thread_time = getattr(time, 'thread_time', time.process_time)
+
+default_json_encoder = 'orjson' if orjson else 'json'
+gzip_min_size        = 1024 # smaller bodies are not worth compressing
+gzip_level           = 6
+
+
+###
+### JSON ENCODERS
+###
+
+# NaN and infinity are sent as null by both encoders (orjson does it by
+# itself), a non-finite value only fails its field, not the request.
+
+def finite(data):
+   # Copy of data with NaN and infinity replaced by None
+   if isinstance(data, float):
+      return data if math.isfinite(data) else None
+   if isinstance(data, dict):
+      return {k: finite(v) for k, v in data.items()}
+   if isinstance(data, (list, tuple)):
+      return [finite(v) for v in data]
+   return data
+
+def encode_json(data):
+   try:
+      return json.dumps(data, separators=(',', ':'), allow_nan=False).encode('utf-8')
+   except ValueError:
+      # Non-finite values (only walked when present)
+      return json.dumps(finite(data), separators=(',', ':'), allow_nan=False).encode('utf-8')
+
+def encode_orjson(data):
+   try:
+      return orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY)
+   except TypeError:
+      # Types not supported by orjson (e.g. numpy scalars in lists of dicts)
+      return encode_json(data)
+
+json_encoders = {'json': encode_json}
+if orjson:
+   json_encoders['orjson'] = encode_orjson
+
+
+###
+### REQUEST STATISTICS
+###
+
+class RequestStats(object):
+
+   def __init__(self):
+      self.lock          = threading.Lock()
+      self.requests      = 0
+      self.retries       = 0
+      self.bodies        = 0
+      self.body_bytes    = 0
+      self.wire_bytes    = 0
+      self.encode_time   = 0.0
+      self.compress_time = 0.0
+
+   def add(self, body_bytes=0, wire_bytes=0, encode_time=0.0, compress_time=0.0):
+      with self.lock:
+         self.requests      += 1
+         self.bodies        += 1 if body_bytes else 0
+         self.body_bytes    += body_bytes
+         self.wire_bytes    += wire_bytes
+         self.encode_time   += encode_time
+         self.compress_time += compress_time
+
+   def retry(self):
+      with self.lock:
+         self.retries += 1
+
+   def summary(self):
+      with self.lock:
+         return '{} requests ({} retries), {} bodies, {:.1f} KB JSON, {:.1f} KB on the wire, serialization {:.3f}s CPU, compression {:.3f}s CPU'.format(
+            self.requests, self.retries, self.bodies, self.body_bytes/1024.0, self.wire_bytes/1024.0, self.encode_time, self.compress_time
+         )
+
+
+###
+### BODY ENCODING
+###
+
+def encode_body(json_data, encoder=default_json_encoder, compress=False, stats=None):
+   # Returns (body bytes or None, extra headers)
+   if json_data is None:
+      if stats is not None:
+         stats.add()
+      return None, {}
+
+   t0      = thread_time()
+   body    = json_encoders[encoder](json_data)
+   t1      = thread_time()
+   size    = len(body)
+   headers = {}
+   if compress and size >= gzip_min_size:
+      body = gzip.compress(body, compresslevel=gzip_level)
+      headers['Content-Encoding'] = 'gzip'
+   t2 = thread_time()
+
+   if stats is not None:
+      stats.add(size, len(body), t1-t0, t2-t1)
+   return body, headers
+
+
+###
+### RETRIES
+###
+
+idempotent_methods = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+transient_status   = (429, 500, 502, 503, 504)
+
+def backoff_delay(attempt, base=0.5, cap=30.0):
+   # Full jitter: uniform in [0, min(cap, base*2^attempt)]
+   return random.uniform(0, min(cap, base * 2**attempt))
+
+
+###
+### ADAPTIVE CONCURRENCY LIMIT
+###
+
+class AdaptiveLimiter(object):
+   # Additive increase (+1 per window of successful calls), multiplicative
+   # decrease on errors or when the latency of a call rises above
+   # latency_tolerance times the moving average of its kind (key).
+
+   def __init__(self, initial=4, minimum=1, maximum=32, decrease=0.5, latency_tolerance=3.0, latency_alpha=0.1):
+      self.cond              = threading.Condition()
+      self.limit             = float(initial)
+      self.minimum           = minimum
+      self.maximum           = maximum
+      self.decrease          = decrease
+      self.latency_tolerance = latency_tolerance
+      self.latency_alpha     = latency_alpha
+      self.latency           = {}
+      self.inflight          = 0
+
+   def acquire(self):
+      with self.cond:
+         while self.inflight >= int(self.limit):
+            self.cond.wait()
+         self.inflight += 1
+
+   def release(self, latency=None, error=False, key=None):
+      with self.cond:
+         self.inflight -= 1
+         if error:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+         elif latency is not None:
+            average = self.latency.get(key, latency)
+            if latency > average * self.latency_tolerance:
+               self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+               self.limit = min(self.maximum, self.limit + 1.0/self.limit)
+            self.latency[key] = average + self.latency_alpha * (latency - average)
+         self.cond.notify_all()
+
+
+###
+### CIRCUIT BREAKER
+###
+
+class LimsUnavailable(Exception):
+   pass
+
+class CircuitBreaker(object):
+   # Opens after failure_threshold consecutive failures. While open calls
+   # fail fast; after reset_timeout seconds one trial call is let through
+   # (half-open) and its outcome closes or reopens the circuit.
+
+   def __init__(self, failure_threshold=5, reset_timeout=30.0):
+      self.lock              = threading.Lock()
+      self.failure_threshold = failure_threshold
+      self.reset_timeout     = reset_timeout
+      self.failures          = 0
+      self.opened            = None
+      self.trial             = False
+
+   @property
+   def state(self):
+      with self.lock:
+         if self.opened is None:
+            return 'closed'
+         return 'half-open' if time.time() - self.opened >= self.reset_timeout else 'open'
+
+   def before(self):
+      with self.lock:
+         if self.opened is None:
+            return
+         if time.time() - self.opened < self.reset_timeout or self.trial:
+            raise LimsUnavailable('LIMS circuit breaker open after {} consecutive failures'.format(self.failures))
+         self.trial = True
+
+   def success(self):
+      with self.lock:
+         self.failures = 0
+         self.opened   = None
+         self.trial    = False
+
+   def failure(self):
+      with self.lock:
+         self.failures += 1
+         if self.trial or self.failures >= self.failure_threshold:
+            self.opened = time.time()
+         self.trial = False
+
+
+###
+### LIMS SESSION
+###
+
+class LimsSession(object):
+
+   def __init__(self, json_encoder=None, gzip_requests=False, retries=4, timeout=120.0, limiter=None, breaker=None):
+      self.json_encoder  = json_encoder if json_encoder in json_encoders else default_json_encoder
+      self.gzip_requests = gzip_requests
+      self.retries       = retries
+      self.timeout       = timeout
+      self.stats         = RequestStats()
+      self.limiter       = limiter or AdaptiveLimiter()
+      self.breaker       = breaker or CircuitBreaker()
+      self.http          = requests.Session() # keeps the connections to LIMS open
+
+   def request(self, method, url, params=None, json_data=None, headers=None):
+      # Returns the last response; raises the last connection error or
+      # LimsUnavailable when the circuit breaker is open.
+      body, body_headers = encode_body(json_data, self.json_encoder, self.gzip_requests, self.stats)
+      if body_headers:
+         headers = dict(headers or {}, **body_headers)
+      attempts = self.retries + 1 if method.upper() in idempotent_methods else 1
+
+      for attempt in range(attempts):
+         if attempt:
+            self.stats.retry()
+            time.sleep(backoff_delay(attempt-1))
+         self.breaker.before()
+         self.limiter.acquire()
+         start = time.time()
+         try:
+            r = self.http.request(method, url, params=params, headers=headers, data=body, timeout=self.timeout, verify=False)
+         except (requests.ConnectionError, requests.Timeout):
+            self.limiter.release(error=True)
+            self.breaker.failure()
+            if attempt == attempts-1:
+               raise
+            continue
+
+         failed = r.status_code in transient_status
+         self.limiter.release(time.time() - start, failed, method.upper())
+         if failed:
+            self.breaker.failure()
+            if attempt < attempts-1:
+               continue
+         else:
+            self.breaker.success()
+         return r
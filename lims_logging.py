@@ -0,0 +1,176 @@
+import re, json, queue, threading, contextlib, collections
+import logging, logging.handlers
+
+# Logging helpers shared by the LIMS scripts. Log messages tag the plate
+# they refer to as [pcrplate=BARCODE] or [pcrplate=BARCODE/pcrwell=A1].
+#
+# The run log is written by a background thread (AsyncLogHandler): logging
+# calls only put the record in a queue, formatting and file writes happen
+# off the upload loop. Records carry the phase of the run (fetch, parse,
+# upload, render) they were logged in, see log_phase().
+
+log_format   = '[%(asctime)s][%(levelname)s]%(message)s'
+plate_regex  = re.compile(r'\[pcrplate=([^/\]]+)')
+well_regex   = re.compile(r'\[pcrplate=([^/\]]+)(?:/pcrwell=([^/\]]+))?')
+end_regex    = re.compile(r'\] (SUCCESS|ABORT) pcrplate processing')
+
+log_context = threading.local()
+
+
+@contextlib.contextmanager
+def log_phase(name):
+   # Tags the records logged by this thread with the phase
+   previous = getattr(log_context, 'phase', None)
+   log_context.phase = name
+   try:
+      yield
+   finally:
+      log_context.phase = previous
+
+def current_phase():
+   return getattr(log_context, 'phase', None)
+
+def plate_well(record):
+   # (plate, well) tagged in the message, None if not tagged
+   match = well_regex.search(record.getMessage())
+   if match is None:
+      return None, None
+   return match.group(1), match.group(2)
+
+
+###
+### PER-PLATE LOG INDEX
+###
+
+class PlateLogIndex(logging.Handler):
+   # Keeps the formatted WARNING and above records of each plate in memory,
+   # so the digest does not need to grep the log file.
+
+   def __init__(self, level=logging.WARNING):
+      logging.Handler.__init__(self, level)
+      self.setFormatter(logging.Formatter(log_format))
+      self.index = collections.defaultdict(lambda: collections.defaultdict(list))
+
+   def emit(self, record):
+      match = plate_regex.search(record.getMessage())
+      if match is None:
+         return
+      # ERROR and CRITICAL are indexed together
+      level = min(record.levelno, logging.ERROR)
+      self.index[level][match.group(1)].append(self.format(record))
+
+   def lines(self, plate, level):
+      with self.lock:
+         return list(self.index[level].get(plate, []))
+
+   def plates(self, level):
+      with self.lock:
+         return [p for p, lines in self.index[level].items() if lines]
+
+
+###
+### RUN LOG
+###
+
+class JsonFormatter(logging.Formatter):
+   # One JSON object per line, with the plate, well and phase as fields
+
+   def format(self, record):
+      plate, well = plate_well(record)
+      line = {
+         'time':    self.formatTime(record),
+         'level':   record.levelname,
+         'plate':   plate,
+         'well':    well,
+         'phase':   getattr(record, 'phase', None),
+         'message': record.getMessage()
+      }
+      if record.exc_info:
+         line['exception'] = self.formatException(record.exc_info)
+      return json.dumps(line)
+
+
+class PlateSummaryHandler(logging.Handler):
+   # Collapses the per-well INFO records of a plate into one summary line,
+   # WARNING and above are always written. The summary is written before the
+   # SUCCESS/ABORT line of the plate (or the first record of another plate).
+
+   def __init__(self, target):
+      logging.Handler.__init__(self)
+      self.target  = target
+      self.plate   = None
+      self.wells   = []
+      self.lines   = 0
+      self.last    = None
+
+   def flush_summary(self):
+      if self.lines:
+         summary = logging.makeLogRecord(self.last.__dict__)
+         summary.msg  = '[pcrplate={}] {} pcrwell INFO lines collapsed ({} wells: {}..{})'.format(self.plate, self.lines, len(self.wells), self.wells[0], self.wells[-1])
+         summary.args = None
+         self.target.handle(summary)
+      self.plate, self.wells, self.lines, self.last = None, [], 0, None
+
+   def emit(self, record):
+      plate, well = plate_well(record)
+      if well is not None and record.levelno <= logging.INFO:
+         if plate != self.plate:
+            self.flush_summary()
+            self.plate = plate
+         if not self.wells or self.wells[-1] != well:
+            self.wells.append(well)
+         self.lines += 1
+         self.last   = record
+         return
+      if plate != self.plate or end_regex.search(record.getMessage()):
+         self.flush_summary()
+      self.target.handle(record)
+
+   def flush(self):
+      self.flush_summary()
+      self.target.flush()
+
+   def close(self):
+      self.flush_summary()
+      self.target.close()
+      logging.Handler.close(self)
+
+
+class AsyncLogHandler(logging.handlers.QueueHandler):
+   # Hands the records to `target` in a background thread. close() (called
+   # by logging.shutdown) writes the queued records; records logged after
+   # that are written synchronously.
+
+   def __init__(self, target):
+      logging.handlers.QueueHandler.__init__(self, queue.Queue())
+      self.target   = target
+      self.listener = logging.handlers.QueueListener(self.queue, target, respect_handler_level=True)
+      self.listener.start()
+
+   def prepare(self, record):
+      # Same process: the record is queued as is, the message is formatted
+      # by the background thread
+      record.phase = current_phase()
+      return record
+
+   def emit(self, record):
+      if self.listener is None:
+         self.target.handle(self.prepare(record))
+      else:
+         logging.handlers.QueueHandler.emit(self, record)
+
+   def close(self):
+      if self.listener is not None:
+         self.listener.stop()
+         self.listener = None
+      self.target.flush()
+      logging.handlers.QueueHandler.close(self)
+
+
+def log_handler(log_file, json_lines=False, summary=False, format=log_format):
+   # Asynchronous run log handler (text or JSON lines, per-plate summaries)
+   target = logging.FileHandler(log_file)
+   target.setFormatter(JsonFormatter() if json_lines else logging.Formatter(format))
+   if summary:
+      target = PlateSummaryHandler(target)
+   return AsyncLogHandler(target)
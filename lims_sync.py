@@ -3,17 +3,23 @@ import sys
 if sys.version_info < (3,0):
       raise ImportError('Python version < 3.0 not supported')
 
-import glob, os, io, re
-import smtplib, ssl
+import glob, os, io, re, time, math, collections
 import traceback
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 import argparse
-import requests
 import datetime
 import logging
-from dateutil.parser import parse as date_parse
-import pandas as pd
+from html_report import HtmlReport, mono
+from lims_logging import PlateLogIndex, log_handler
+from spool import Spool
+from sync_state import SyncState, clipped_file
+from checkpoint import UploadCheckpoint
+from parse_cache import ParseCache
+from mailer import Mailer, SpooledMailer
+from profiling import PhaseProfiler
+from leases import PlateLeases, shard_of, parse_shard, default_ttl
+
+# pandas, numpy, requests (lims_client) and the modules that depend on them
+# are imported by load_dependencies() once there is something to sync
 
 __version__ = '0.15'
 
@@ -27,23 +33,8 @@ control_amplif = {
    'Pos_RP_N1N2': [True,  True,  True]
 }
 
-# Get environment variables
-LIMS_USER       = os.environ.get('LIMS_USER')
-LIMS_PASSWORD   = os.environ.get('LIMS_PASSWORD')
-EMAIL_SENDER    = os.environ.get('LIMS_EMAIL_ADDRESS')
-EMAIL_PASSWORD  = os.environ.get('LIMS_EMAIL_PASSWORD')
-EMAIL_RECEIVERS = os.environ.get('LIMS_EMAIL_RECEIVERS')
-
-if LIMS_USER       is None or\
-   LIMS_PASSWORD   is None or\
-   EMAIL_SENDER    is None or\
-   EMAIL_RECEIVERS is None or\
-   EMAIL_PASSWORD  is None:
-   print("ERROR: define environment variables LIMS_USER, LIMS_PASSWORD, LIMS_EMAIL_ADDRESS, LIMS_EMAIL_PASSWORD, LIMS_EMAIL_RECEIVERS before running this script.")
-   sys.exit(1)
-
-job_name  = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-job_start = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+# Environment variables with the LIMS and e-mail credentials
+env_variables = ['LIMS_USER', 'LIMS_PASSWORD', 'LIMS_EMAIL_ADDRESS', 'LIMS_EMAIL_PASSWORD', 'LIMS_EMAIL_RECEIVERS']
 
 # API DEFINITIONS
 base_url           = 'https://orfeu.cnag.crg.eu'
@@ -76,23 +67,81 @@ def getOptions(args=sys.argv[1:]):
    parser.add_argument('path', help='Input folder (where the *_results.txt and *_clipped.txt files are)')
    parser.add_argument('-o', '--output', help='Parsed output folder', required=True)
    parser.add_argument('-l', '--logpath', help='Root folder to store logs', required=True)
+   parser.add_argument('-s', '--snapshot', help='Folder to store columnar snapshots of the fetched LIMS collections')
+   parser.add_argument('--snapshot-max-age', type=float, help='Reuse snapshots younger than this many seconds instead of querying LIMS')
+   parser.add_argument('--spool', help='Only sync the plates listed in this sync_folder spool folder instead of scanning the input folder')
+   parser.add_argument('--state', help='File recording the exports already processed, unchanged exports are skipped without querying LIMS')
+   parser.add_argument('--state-retry', type=float, default=3600, help='Seconds after which unchanged exports that could not be synced are retried (default: %(default)s)')
+   parser.add_argument('-a', '--archive', help='Also append parsed results and Rn curves to this columnar archive (partitioned by run date and instrument)')
+   parser.add_argument('--chunk-wells', type=int, default=amplification_chunk_wells, help='Maximum number of wells per amplificationdata PATCH request')
+   parser.add_argument('--chunk-objects', type=int, default=amplification_chunk_objects, help='Maximum number of amplificationdata objects per PATCH request')
+   parser.add_argument('--chunk-retries', type=int, default=amplification_retries, help='Number of times a failed amplificationdata PATCH request is retried')
+   parser.add_argument('--json-encoder', choices=['json', 'orjson'], help='JSON encoder for LIMS request bodies (default: orjson if installed)')
+   parser.add_argument('--gzip-requests', action='store_true', help='Send gzip-compressed request bodies (Content-Encoding: gzip) to LIMS')
+   parser.add_argument('--lims-retries', type=int, default=4, help='Number of retries (jittered exponential backoff) of idempotent LIMS requests on timeouts and 429/5xx responses')
+   parser.add_argument('--lims-timeout', type=float, default=120, help='LIMS request timeout in seconds')
+   parser.add_argument('-k', '--checkpoint', help='Folder to store per-well upload checkpoints, interrupted plates are resumed instead of fully resynced')
+   parser.add_argument('--diff-resync', action='store_true', help='On resync only rewrite the wells whose results (detector, Ct, threshold, amplification) changed')
+   parser.add_argument('--parse-cache', help='Folder to cache parsed results/Rn tables, keyed by the content of the exported files')
+   parser.add_argument('--ct-mode', choices=['instrument', 'check', 'local'], default=ct_mode, help='instrument: use the instrument Ct; check: warn about wells where the Ct computed from Rn differs; local: use the computed Ct (default: %(default)s)')
+   parser.add_argument('--ct-tolerance', type=float, default=ct_tolerance, help='Maximum difference (cycles) between instrument and local Ct in check mode')
+   parser.add_argument('--digest-budget', type=int, default=digest_size_budget, help='Maximum size (bytes) of the e-mail digest body, longer sections are sent as compressed attachments')
+   parser.add_argument('--profile', action='store_true', help='Write cProfile stats of each phase (fetch, parse, upload, render) next to the run log')
+   parser.add_argument('--trace-memory', action='store_true', help='Write the top memory allocations (tracemalloc) of each phase run next to the run log')
+   parser.add_argument('--shard', type=parse_shard, metavar='INDEX/COUNT', help='Only sync the plates of this shard (barcode hash), e.g. 0/3 on the first of three hosts')
+   parser.add_argument('--lease-dir', help='Shared folder for plate lease files, a plate is only synced by the worker holding its lease')
+   parser.add_argument('--lease-ttl', type=float, default=default_ttl, help='Seconds after which the lease of a crashed worker is reclaimed (default: %(default)s)')
+   parser.add_argument('--log-json', action='store_true', help='Write the run log as JSON lines (time, level, plate, well, phase, message)')
+   parser.add_argument('--log-summary', action='store_true', help='Collapse the per-well INFO lines of the run log into per-plate summaries (warnings and errors are kept)')
+   parser.add_argument('--mail-spool', help='Queue the e-mail digest in this folder instead of sending it (delivered by: python mailer.py MAIL_SPOOL)')
    options = parser.parse_args(args)
+   if options.shard and options.spool:
+      parser.error('--shard cannot be used with --spool (the spool is consumed as a whole)')
    return options
 
+def getEnvironment(environ=os.environ):
+   env = {name: environ.get(name) for name in env_variables}
+   if None in env.values():
+      print("ERROR: define environment variables {} before running this script.".format(', '.join(env_variables)))
+      sys.exit(1)
+   return env
+
+def load_dependencies():
+   # Heavy imports, deferred until there is something to sync
+   global np, pd, requests, date_parse, SnapshotStore, ResultsArchive, call_ct, plate_96, plate_384, LimsSession, LimsUnavailable, backoff_delay, AmplificationMatrix
+   import numpy as np
+   import pandas as pd
+   import requests
+   from dateutil.parser import parse as date_parse
+   from columnar import SnapshotStore
+   from archive import ResultsArchive
+   from ct_calling import call_ct
+   from plate_geometry import plate_96, plate_384
+   from lims_client import LimsSession, LimsUnavailable, backoff_delay
+   from amplification import AmplificationMatrix
+
 ###
 ### LOGGING
 ###
 
-def setup_logger(log_path):
+def new_job():
+   # Job name (also the log file name) and start time
+   now = datetime.datetime.now()
+   return now.strftime('%Y%m%d_%H%M%S'), now.strftime('%d/%m/%Y %H:%M:%S')
+
+def setup_logger(log_path, job_name, json_lines=False, summary=False):
    log_level = logging.INFO
    log_file = '{}/{}.log'.format(log_path, job_name)
-   log_format = '[%(asctime)s][%(levelname)s]%(message)s'
 
-   logging.basicConfig(level=log_level, filename=log_file, format=log_format)
+   # Written from a background thread
+   logger = logging.getLogger()
+   logger.setLevel(log_level)
+   logger.addHandler(log_handler(log_file, json_lines, summary))
 
    return log_file
 
 
+
 ###
 ### DIAGNOSIS
 ###
@@ -143,252 +192,49 @@ def compute_diagnosis(samples):
 ### EMAIL NOTIFICATIONS
 ### 
 
-smtp_server     = "smtp.gmail.com"
-email_port      = 465
-email_receivers = EMAIL_RECEIVERS.split(',')
-
-def html_digest(digest, log_file, tb):
-   # Convert digest lists to sets
-   digest['nofile']  = list(set(digest['nofile']))
-   digest['noinfo']  = list(set(digest['noinfo']))
-   digest['nowells'] = list(set(digest['nowells']))
-   digest['success'] = list(set(digest['success']))
-   digest['warning'] = list(set(digest['warning']))
-   digest['error']   = list(set(digest['error']))
-
-   job_end = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
-   
-   html = '<html><head><style>\nth, td { text-align: center; padding: 10px; }\ntable, th, td { border: 1px solid black; }\n</style></head><body>'
-   html_index = '- <a href="#description">Job description</a><br>'
-   
-   # Header with run description
-   html += '<h1>LIMS update report</h1>\n'
-   html += 'HTML_REPORT_INDEX'
-   html += '<br><h2><a name="description"></a>Job description:</h2>\n'
-   html += '<ul><li><b>Job name:</b> <span style="font-family:\'Courier New\'">{}</span></li>'.format(job_name)
-   html += '<li><b>Job start:</b> <span style="font-family:\'Courier New\'">{}</span></li>'.format(job_start)
-   html += '<li><b>Job end:</b> <span style="font-family:\'Courier New\'">{}</span></li>'.format(job_end)
-   html += '<li><b>Script version:</b> <span style="font-family:\'Courier New\'">{}</span></li>'.format(__version__)   
-   html += '<li><b>Command:</b> <span style="font-family:\'Courier New\'">{}</span></li>'.format(' '.join(sys.argv))
-   html += '<li><b>Working directory:</b> <span style="font-family:\'Courier New\'">{}</span></li>'.format(os.getcwd())
-   html += '<li><b>Log file:</b> <span style="font-family:\'Courier New\'">{}</span></li>'.format(log_file)
-   html += '<li><b>Exit status:</b> <span style="font-family:\'Courier New\'">{}</span></li></ul>\n'.format(1 if tb else 0)
-
-   if tb:
-      html += '<br><h2>Cause of failure:</h2>'
-      html += '<span style="font-family:\'Courier New\'">{}</span>'.format(tb.replace('<','&lt;').replace('>','&gt;').replace('\n','<br>'))
-      
-   # Update summary (only if there are samples to talk about)
-   if len(digest['noinfo'])  > 0 or \
-      len(digest['nofile'])  > 0 or \
-      len(digest['error'])   > 0 or \
-      len(digest['warning']) > 0 or \
-      len(digest['success']) > 0 or \
-      len(digest['nowells']) > 0:
-      html_index += '- <a href="#summary">Update summary</a><br>'
-      html += '<br><h2><a name="summary"></a>Update summary:</h2>'
-
-      #  No results file found
-      if len(digest['nofile']) > 0:
-         html += '<br>The following PCR runs <b>did not synchronize</b> because the PCR results have not been exported properly:</b>\n<ul>'
-         for bcd in digest['nofile']:
-            html += '<li>{}</li>'.format(bcd)
-         html += '</ul>'
-      
-      #  No info
-      if len(digest['noinfo']) > 0:
-         html += '<br>The following PCR runs <b>did not synchronize</b> because the PCR plate has not been pre-registered in LIMS:</b>\n<ul>'
-         for bcd in digest['noinfo']:
-            html += '<li>{}</li>'.format(bcd)
-         html += '</ul>'
-         
-      #  No pcrwells found
-      if len(digest['nowells']) > 0:
-         html += '<br>The following PCR runs <b>did not synchronize</b> because no PCR wells were found in LIMS (did you create the well layout?):</b>\n<ul>'
-         for bcd in digest['nowells']:
-            html += '<li>{}</li>'.format(bcd)
-         html += '</ul>'
-
-      #  Error
-      if len(digest['error']) > 0:
-         html += '<br>PCR plates with LIMS synchronization <b><span style="color:red">ERRORS</span></b>: (click to see log digest)\n<ul>'
-         for bcd in digest['error']:
-            html += '<li><a href="#{}error">{}</a></li>'.format(bcd, bcd)
-         html += '</ul>'
-
-      #  Warning
-      if len(digest['warning']) > 0:
-         html += '<br>PCR plates with LIMS synchronization <b><span style="color:orange">WARNINGS</span></b>: (click to see log digest)\n<ul>'
-         for bcd in digest['warning']:
-            html += '<li><a href="#{}warn">{}</a></li>'.format(bcd, bcd)
-         html += '</ul>'
-
-      #  Success (there is sample/control data)
-      if len(digest['success']) > 0:
-         html += '<br><b>List of synchronized PCR runs:</b>\n<ul>'
-         for bcd, resync in digest['success']:
-            html += '<li>{}{}</li>'.format(bcd, ' (resync)' if resync else '') 
-         html += '</ul>'
-
-         # Sample stats
-         html_index += '- <a href="#stats">Sample stats</a><br>'
-         html += '<br><h2><a name="stats"></a>Sample stats</h2>\n'
-         html += '<table style="white-space:nowrap;"><tr>\
-            <th>PCR barcode</th>\
-            <th>Total Samples</th>\
-            <td>Negative</td>\
-            <td>Positive</td>\
-            <td>Inconclusive</td>\
-            <td>Invalid</td>\
-            <td>No AD</td>\
-            <th>Total Controls</th>\
-            <td>Passed</td>\
-            <td>Failed</td>\
-            </tr>'
-                     
-         for bcd in digest['sample']:
-            # Compute sample frequencies
-            freq = pd.Series([c[0] for r in digest['sample'][bcd] for c in r]).value_counts()
-            for s in status_code:
-               if not status_code[s] in freq.index:
-                  freq[status_code[s]] = 0
-
-            # Fill table
-            html += '<tr>'
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(bcd)
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['P']]+freq[status_code['N']]+freq[status_code['I']]+freq[status_code['NAD']]+freq[status_code['NV']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['N']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['P']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['I']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['NV']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['NAD']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['PCT']]+freq[status_code['FCT']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['PCT']])
-            html += '<td><span style="font-family:\'Courier New\'">{}</span></td>'.format(freq[status_code['FCT']])
-            html += '</tr>'
-         html += '</table>'
-
-         # PCR plate viz
-
-         # Legend
-         html_index += '- <a href="#sampviz">Sample visualization</a><br>'
-         html += '<br><h2><a name="sampviz"></a>Sample visualization</h2>\n'
-         html += '<table style="white-space:nowrap; empty-cells: show; border: 0px;"><tr>'
-         html += '<td style="background-color:{}">&nbsp;</td><td>Negative</td>'.format(status_color[status_code['N']])
-         html += '<td style="background-color:{}">&nbsp;</td><td>Positive</td>'.format(status_color[status_code['P']])
-         html += '<td style="background-color:{}">&nbsp;</td><td>Inconclusive</td>'.format(status_color[status_code['I']])
-         html += '<td style="background-color:{}">&nbsp;</td><td>Invalid</td>'.format(status_color[status_code['NV']])
-         html += '<td style="background-color:{}">&nbsp;</td><td>Control OK</td>'.format(status_color[status_code['PCT']])
-         html += '<td style="background-color:{}">&nbsp;</td><td>Control FAIL</td>'.format(status_color[status_code['FCT']])
-         html += '<td style="background-color:{}">&nbsp;</td><td>Empty</td>'.format(status_color[status_code['EMP']])
-         html += '<td style="background-color:{}">&nbsp;</td><td>No autodiag</td>'.format(status_color[status_code['NAD']])
-         html += '<td style="border: 2px solid red;">&nbsp;</td><td>No Rp</td></tr></table>'
-         for bcd in digest['sample']:
-            html += '<h3>PCR run: {}</h3>\n'.format(bcd)
-
-            # Table
-            html += '<table style="empty-cells: show;"><tr>'
-            # Add headers (numbers)
-            for i in range(13):
-               html += '<th style="width:18px;"><span style="font-family:\'Courier New\'">{}</span></th>'.format(i if i else '')
-            html += '</tr>'
-
-            # Add rows
-            for i, r in enumerate(digest['sample'][bcd]):
-               html += '<tr><th><span style="font-family:\'Courier New\'">{}</span></th>'.format(chr(65+i))
-               for c in r:
-                  html += '<td style="background-color:{};{}">&nbsp;</td>'.format(status_color[c[0]], '' if c[1] or c[0] == status_code['EMP'] else 'border: 2px solid red;')
-               html += '</tr>'
-            html += '</table>'
-         # Control checks
-         html_index += '- <a href="#controls">Control checks</a><br>'
-         html += '<br><h2><a name="controls"></a>Control checks</h2>\n'
-
-         control_bcd = list(digest['control'].keys())
-
-         if len(control_bcd) > 0:
-            # Table header
-            control_names = digest['control'][control_bcd[0]].keys()
-            html += '<table style="white-space:nowrap"><tr><th>PCR barcode</th>'
-            for cname in control_names:
-               html += '<th>{}</th>'.format(cname)
-            html += '</tr>'
-
-            # Table content
-            for bcd in control_bcd:
-               html += '<tr><td>{}</td>'.format(bcd)
-               for ctl in digest['control'][bcd]:
-                  conds = list(set(digest['control'][bcd][ctl]))
-                  html += '<td>'
-                  if len(conds) > 0:
-                     for cond in conds:
-                        html += '<span style="color:{}"><b>{}</b></span>({}) '.format('green' if cond[1] == 'P' else 'red', 'Pass' if cond[1] == 'P' else 'Fail', cond[0])
-                  else:
-                     html += 'None'
-                  html += '</td>'
-
-               html +='</tr>'
-            html += '</table>'
-
-         else:
-            html += 'No control samples found!'
-
-      # Log digests
-      if len(digest['error']) > 0 or len(digest['warning']) > 0:
-         html_index += '- <a href="#logs">Log digest</a><br>'
-         html += '<br><h2><a name="logs"></a>Log digest</h2>\n'
-         # Error logs
-         if len(digest['error']) > 0:
-            # Grep error log from file
-            with open(log_file) as f:
-               error_lines = [line for line in f if re.search(r'ERROR', line)]
+digest_size_budget = 1000000 # bytes, larger digests move long blocks to attachments
+
+html_style = '\nth, td { text-align: center; padding: 10px; }\ntable, th, td { border: 1px solid black; }\n'
+
+# Precomputed plate visualization fragments
+mono_cell      = '<td>' + mono + '</td>'
+plate_cells    = {(code, rp): '<td style="background-color:{};{}">&nbsp;</td>'.format(status_color[code], '' if rp or code == status_code['EMP'] else 'border: 2px solid red;') for code in status_color for rp in (False, True)}
+plate_legend   = '<table style="white-space:nowrap; empty-cells: show; border: 0px;"><tr>' + ''.join('<td style="background-color:{}">&nbsp;</td><td>{}</td>'.format(status_color[status_code[s]], name) for s, name in [
+                    ('N', 'Negative'), ('P', 'Positive'), ('I', 'Inconclusive'), ('NV', 'Invalid'), ('PCT', 'Control OK'),
+                    ('FCT', 'Control FAIL'), ('EMP', 'Empty'), ('NAD', 'No autodiag')
+                 ]) + '<td style="border: 2px solid red;">&nbsp;</td><td>No Rp</td></tr></table>'
+
+def plate_header():
+   # (table header, row headers) of the 96-well plate visualization, the plate
+   # geometry (numpy) is only imported when a digest is rendered
+   from plate_geometry import plate_96
+   header = '<table style="empty-cells: show;"><tr>' + ''.join('<th style="width:18px;">' + mono.format(i if i else '') + '</th>' for i in range(plate_96.cols+1)) + '</tr>'
+   rows   = ['<tr><th>' + mono.format(name) + '</th>' for name in plate_96.row_names]
+   return header, rows
+
+def new_digest():
+   return {
+      'skipped': [],
+      'nofile':  [],
+      'noinfo':  [],
+      'nowells': [],
+      'success': [],
+      'warning': [],
+      'error':   [],
+      'leased':  [], # synced by another worker, retried in the next run
+      'control': {},
+      'sample':  {}
+   }
+
+def digest_pending(digest, tb=None):
+   # Something interesting to report
+   return bool(tb) or any(len(digest[k]) > 0 for k in ['error', 'warning', 'success', 'noinfo', 'nofile', 'nowells'])
 
-            html += '<h3>Error logs:</h3>'
-            for bcd in digest['error']:
-               pattern = 'pcrplate={}'.format(bcd)
-               html += '<br><a name="{}error"></a>Error log for {}:\n'.format(bcd,bcd)
-               html += '<br><p style="font-family:\'Courier New\'">{}</p><br>'.format('<br>'.join([line for line in error_lines if re.search(pattern, line)]))
 
-         # Warning logs
-         if len(digest['warning']) > 0:
-            # Grep warning log from log file
-            with open(log_file) as f:
-               warn_lines = [line for line in f if re.search(r'WARNING', line)]
-
-            html += '<h3>Warning logs:</h3>'
-            for bcd in digest['warning']:
-               pattern = 'pcrplate={}'.format(bcd)
-               html += '<br><a name="{}warn"></a>Warning log for {}:\n'.format(bcd,bcd)
-               html += '<br><p style="font-family:\'Courier New\'">{}</p><br>'.format('<br>'.join([line for line in warn_lines if re.search(pattern, line)]))
-
-            
-   html += "</body></html>"
-
-   # Add index at the top
-   html = html.replace('HTML_REPORT_INDEX', html_index)
-
-   return MIMEText(html, 'html')
-
-
-def send_digest(digest, log_file, tb=None):
-   message = MIMEMultipart()
-   message['From']    = 'PRBB LIMS <{}>'.format(EMAIL_SENDER)
-   message['Subject'] = "LIMS update {} ({})".format('report' if tb is None else 'FAILED', job_name)
-   message['Bcc']     = ','.join(email_receivers)
-   message.attach(html_digest(digest, log_file, tb))
-   
-   context = ssl.create_default_context()
-   with smtplib.SMTP_SSL(smtp_server, email_port, context=context) as server:
-      server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-      server.sendmail(EMAIL_SENDER, email_receivers, message.as_string())
-
-      
 ###
 ### ERROR CONTROL
 ###
 
-tb = None
-
 def assert_critical(cond, msg):
    if not cond:
       logging.critical(msg)
@@ -409,26 +255,156 @@ def assert_warning(cond, msg):
 ### LIMS REQUEST METHODS
 ###
 
-req_headers = {'content-type': 'application/json', 'Authorization': 'ApiKey {}:{}'.format(LIMS_USER, LIMS_PASSWORD) };
+def lims_headers(user, password):
+   return {'content-type': 'application/json', 'Authorization': 'ApiKey {}:{}'.format(user, password)}
+
+
+###
+### AMPLIFICATION DATA UPLOAD
+###
+
+# amplificationdata PATCH requests carry up to this many wells/objects
+amplification_chunk_wells   = 24
+amplification_chunk_objects = 2000
+amplification_retries       = 2
+
+def amplification_data(curves, results_uri):
+   # amplificationdata objects of a well from its (cycles, {Rn, Delta Rn})
+   # curves, values are sent as parsed
+   values = curves.tolist()
+   return [{'results': results_uri, 'cycle': cycle, 'rn': r, 'delta_rn': d} for cycle, (r, d) in enumerate(values, 1)]
+
+def amplification_chunks(wells, max_wells, max_objects):
+   # wells: list of (position, [amplificationdata objects])
+   chunk, size = [], 0
+   for well in wells:
+      if chunk and (len(chunk) >= max_wells or size + len(well[1]) > max_objects):
+         yield chunk
+         chunk, size = [], 0
+      chunk.append(well)
+      size += len(well[1])
+   if chunk:
+      yield chunk
+
+
+###
+### LOCAL CT CALLING
+###
+
+# instrument: keep the instrument Ct, check: log wells where the local Ct
+# disagrees, local: replace the instrument Ct with the local call
+ct_mode      = 'instrument'
+ct_tolerance = 0.5 # cycles
+
+def local_ct(results, rn):
+   # Local Ct of each results row (NaN if undetermined), computed from Rn
+   # with the instrument threshold of the well
+   thresholds = dict(zip(results['Well'].astype(int), pd.to_numeric(results['Threshold'], errors='coerce')))
+   wells, ct  = call_ct(rn['well'].astype(int).values, rn['cycle'].values, rn['Rn'].values, thresholds)
+   return pd.Series(ct, index=wells).reindex(results['Well'].astype(int).values).values
+
+
+###
+### RESYNC DIFF
+###
+
+def same_value(a, b):
+   # Numeric values are compared as floats (LIMS returns them as strings)
+   if a is None or b is None:
+      return a is None and b is None
+   try:
+      return math.isclose(float(a), float(b), rel_tol=1e-9, abs_tol=1e-9)
+   except (TypeError, ValueError):
+      return a == b
+
+def lims_curves(amp_objs):
+   # {results id: (cycles, {Rn, Delta Rn}) array} of amplificationdata objects
+   points = collections.defaultdict(list)
+   for o in amp_objs:
+      values = [np.nan if o[k] is None else float(o[k]) for k in ('rn', 'delta_rn')]
+      points[results_id(o['results'])].append([int(o['cycle'])] + values)
+   return {rid: np.array(sorted(p))[:,1:] for rid, p in points.items()}
+
+def same_curves(stored, curves):
+   # Curves are compared with a small tolerance (LIMS returns the values as
+   # decimal strings)
+   if stored is None:
+      stored = np.empty((0, 2))
+   return stored.shape == curves.shape and np.allclose(stored, curves, rtol=1e-6, atol=1e-6, equal_nan=True)
+
+def unchanged_wells(results, res_objs, pcrwell_pos_to_uri, detector_ids, curves, stored_curves):
+   # {position: results_uri} of the wells whose results in LIMS match the
+   # parsed detector, Ct, threshold and amplification, and whose
+   # amplificationdata in LIMS (stored_curves, see lims_curves) match the
+   # parsed curves (WARN: ASSUMES ONE RESULTS OBJECT PER WELL)
+   lims = collections.defaultdict(list)
+   for o in res_objs:
+      lims[o['pcr_well']].append(o)
+
+   rows = collections.Counter(plate_384.position[results['Well'].astype(int).values])
+
+   unchanged = {}
+   for _, row in results.iterrows():
+      pcrwell_pos = plate_384.position[int(row['Well'])]
+      objs = lims.get(pcrwell_pos_to_uri.get(pcrwell_pos), [])
+      if len(objs) != 1 or rows[pcrwell_pos] != 1:
+         continue
+      ct, amplification, threshold = result_values(row)
+      o = objs[0]
+      if o['detector'] == detector_ids.get(row['Detector Name'].lower()) and \
+         same_value(o['ct'], ct) and \
+         same_value(o['qpcr_threshold'], threshold) and \
+         o['amplification'] == amplification and \
+         same_curves(stored_curves.get(str(o['id'])), curves.curves(int(row['Well']))):
+         unchanged[pcrwell_pos] = o['resource_uri']
+   return unchanged
+
+
+###
+### UPLOAD CHECKPOINTS
+###
+
+def results_id(uri):
+   # Id of a results object from its resource uri or Location header
+   return uri.rstrip('/').split('/')[-1]
+
 
-def lims_request(method, url, params=None, json_data=None, headers=req_headers):
-   # methods: GET, OPTIONS, HEAD, POST, PUT, PATCH, DELETE
-   r = requests.request(method, url, params=params, headers=headers, json=json_data, verify=False)
-   assert_error(r.status_code < 300,
-                  'LIMS request returned non-successful response ({}). Request details: METHOD={}, URL={}, PARAMS={}, DATA={}'.format(
-                     r.status_code,
-                     method,
-                     url,
-                     params,
-                     json_data
-                  ))
-   return r, r.status_code
+###
+### SYNC_FOLDER HANDOFF
+###
+
+def plate_barcode(results_file):
+   return results_file.split('/')[-1].split('_results.txt')[0]
+
+def spooled_results(spool, entries):
+   # Results files listed in the spool entries (a new clipped file also
+   # triggers the sync of its plate)
+   flist = []
+   for name in entries:
+      for fname in spool.read(name)['files']:
+         if fname.endswith('_clipped.txt'):
+            fname = fname[:-len('_clipped.txt')] + '_results.txt'
+         if fname.endswith('_results.txt') and not fname in flist:
+            flist.append(fname)
+   return flist
+
+def requeue_spooled(spool, entries, flist, retry, job_name):
+   # Plates that could not be synced are spooled again for the next run
+   pending = [fname for fname in flist if plate_barcode(fname) in retry and os.path.isfile(fname)]
+   if pending:
+      spool.put({'job': job_name, 'source': 'lims_sync', 'files': pending})
+      logging.info(' spool: {} plates kept in {} for the next run'.format(len(pending), spool.root))
+   for name in entries:
+      spool.ack(name)
 
 
 ###
 ### DATA PARSING METHODS
 ###
 
+# Bump when a parser changes its output (invalidates the parse cache)
+parser_version = 1
+
 def parse_viia7(results_file):
    with open(results_file) as f_in:
       run_date = None
@@ -518,469 +494,1086 @@ def parse_7900ht_results(results_file):
 def rename_Ct(x):
    return 'NA' if x in ['Unknown','Undetermined','None'] else x
 
+def result_values(row):
+   # Ct, amplification and qPCR threshold of a parsed results row
+   ct            = None  if row['Ct'] == 'NA' else row['Ct']
+   amplification = False if ct is None else float(ct) <= default_ct_threshold
+   threshold     = None  if pd.isna(row['Threshold']) else row['Threshold']
+   return ct, amplification, threshold
+
 
 ###
-### MAIN SCRIPT
+### RESULTS ARCHIVE
 ###
 
-if __name__ == '__main__':
-   
-   # Parse arguments
-   options = getOptions(sys.argv[1:])
-   path    = options.path
-   outpath = options.output
+def archive_plate(archive, platebc, results, rn, run_date, instrument):
+   date = date_parse(run_date)
+   archive.write('results', platebc, date, instrument, {
+      'plate':     [platebc]*len(results),
+      'well':      results['Well'].astype(int),
+      'detector':  results['Detector Name'].astype(str),
+      'ct':        pd.to_numeric(results['Ct'], errors='coerce'),
+      'threshold': pd.to_numeric(results['Threshold'], errors='coerce'),
+      'run_date':  [date.replace(tzinfo=None)]*len(results)
+   })
+   return archive.write('rn', platebc, date, instrument, {
+      'plate':    [platebc]*len(rn),
+      'well':     rn['well'].astype(int),
+      'cycle':    rn['cycle'].astype(int),
+      'rn':       rn['Rn'].astype(float),
+      'delta_rn': rn['Delta Rn'].astype(float)
+   })
 
-   # Set up logger
-   logpath = setup_logger(options.logpath).replace('//','/')
 
-   # Log job info
-   logging.info(' version:  {}'.format(__version__))
-   logging.info(' job name: {}'.format(job_name))
-   logging.info(' command:  {}'.format(' '.join(sys.argv)))
-   logging.info(' workdir:  {}'.format(os.getcwd()))
-   logging.info(' logfile:  {}'.format(logpath))
-   logging.info(' report:   {}'.format(EMAIL_RECEIVERS))
-
-   try:
-      # Digest structure
-      digest = {
-         'skipped': [],
-         'nofile':  [],
-         'noinfo':  [],
-         'nowells': [],
-         'success': [],
-         'warning': [],
-         'error':   [],
-         'control': {},
-         'sample':  {}
-      }
-
-      # Test LIMS connection
-      _, status = lims_request('GET', base_url)
-      assert_critical(status < 300, 'Test connection to LIMS API failed')
+###
+### SYNC ENGINE
+###
 
-      # Get list of pcr plates
-      pcrplates, status = lims_request('GET', url=pcrplate_url, params={'limit': 1000000})
-      assert_critical(status < 300, 'Could not retreive pcr plates from LIMS')
-      pcrplates = pcrplates.json()['objects']
-      pcrplates_barcodes = [pcrplate['barcode'] for pcrplate in pcrplates]
+class SyncEngine(object):
+   # Syncs instrument exports with LIMS. The LIMS session, the reference
+   # collections (pcr plates, detectors, machines) and the optional stores are
+   # kept between plates, so a long-running process can call sync_plate() for
+   # each new export. Results of the current job are collected in self.digest.
+
+   def __init__(self, lims_user, lims_password, output, log_file=None, session=None, snapshot=None, snapshot_max_age=None,
+                archive=None, checkpoint=None, parse_cache=None, sync_state=None, diff_resync=False, ct_mode=ct_mode,
+                ct_tolerance=ct_tolerance, chunk_wells=amplification_chunk_wells, chunk_objects=amplification_chunk_objects,
+                chunk_retries=amplification_retries, plates_refresh=None, digest_size_budget=digest_size_budget, profiler=None, leases=None):
+      load_dependencies()
+      self.headers            = lims_headers(lims_user, lims_password)
+      self.output             = output
+      self.log_file           = log_file
+      self.session            = session or LimsSession()
+      self.snapshot           = snapshot
+      self.snapshot_max_age   = snapshot_max_age
+      self.archive            = archive
+      self.checkpoint         = checkpoint
+      self.parse_cache        = parse_cache
+      self.sync_state         = sync_state
+      self.diff_resync        = diff_resync
+      self.ct_mode            = ct_mode
+      self.ct_tolerance       = ct_tolerance
+      self.chunk_wells        = chunk_wells
+      self.chunk_objects      = chunk_objects
+      self.chunk_retries      = chunk_retries
+      self.plates_refresh     = plates_refresh # seconds, None: pcr plates are only loaded once
+      self.digest_size_budget = digest_size_budget
+      self.profiler           = profiler or PhaseProfiler()
+      self.leases             = leases # PlateLeases, when several workers share the exports
+
+      # Reference collections
+      self.pcrplates          = None
+      self.pcrplates_barcodes = []
+      self.pcrplates_time     = None
+      self.snapshot_loaded    = set() # collections loaded from the snapshot
+      self.detector_ids       = {}
+      self.machine_ids        = {}
+
+      # Warnings and errors of each plate for the digest
+      self.log_index = PlateLogIndex()
+      logging.getLogger().addHandler(self.log_index)
+
+      self.start_job()
+
+   def start_job(self, job_name=None, job_start=None):
+      # New digest (and job name) for the next batch of plates
+      name, start    = new_job()
+      self.job_name  = job_name or name
+      self.job_start = job_start or start
+      self.digest    = new_digest()
+      self.log_index.index.clear()
+
+   def close(self):
+      logging.getLogger().removeHandler(self.log_index)
+
+
+   ##
+   ## LIMS REQUESTS
+   ##
+
+   def request(self, method, url, params=None, json_data=None, headers=None):
+      # methods: GET, OPTIONS, HEAD, POST, PUT, PATCH, DELETE
+      r = self.session.request(method, url, params=params, json_data=json_data, headers=headers or self.headers)
+      assert_error(r.status_code < 300,
+                     'LIMS request returned non-successful response ({}). Request details: METHOD={}, URL={}, PARAMS={}, DATA={}'.format(
+                        r.status_code,
+                        method,
+                        url,
+                        params,
+                        json_data
+                     ))
+      return r, r.status_code
+
+   def get_collection(self, collection, url, columns, err_msg, refresh=False):
+      # Reuse a fresh snapshot if allowed, otherwise fetch and store a new one
+      if self.snapshot is not None and self.snapshot_max_age is not None and not refresh:
+         objs = self.snapshot.load_records(collection, columns, max_age=self.snapshot_max_age)
+         if objs is not None:
+            logging.info(' snapshot: {} loaded from {} ({} objects)'.format(collection, self.snapshot.root, len(objs)))
+            self.snapshot_loaded.add(collection)
+            return objs
+
+      r, status = self.request('GET', url=url, params={'limit': 1000000})
+      assert_critical(status < 300, err_msg)
+      objs = r.json()['objects']
+      self.snapshot_loaded.discard(collection)
+
+      if self.snapshot is not None:
+         self.snapshot.save(collection, objs)
+         logging.info(' snapshot: {} saved to {} ({} objects)'.format(collection, self.snapshot.root, len(objs)))
+      return objs
+
+   def load_references(self):
+      with self.profiler.phase('fetch'):
+         # Test LIMS connection
+         _, status = self.request('GET', base_url)
+         assert_critical(status < 300, 'Test connection to LIMS API failed')
+
+         # Get list of pcr plates
+         self.load_plates()
+
+         # Get list of detector ids
+         detectors = self.get_collection('detector', detector_url, ['name', 'resource_uri'], 'Could not retreive pcr detectors from LIMS')
+         self.detector_ids = {detector['name'].lower(): detector['resource_uri'] for detector in detectors}
+
+         # Get list of PCR machines
+         machines = self.get_collection('pcrruninstrument', pcrmachine_url, ['name', 'resource_uri'], 'Could not retreive pcr machines from LIMS')
+         self.machine_ids = {machine['name'].lower(): machine['resource_uri'] for machine in machines}
+
+   def load_plates(self, refresh=False):
+      self.pcrplates = self.get_collection('pcrplate', pcrplate_url, ['barcode', 'id', 'resource_uri'], 'Could not retreive pcr plates from LIMS', refresh)
+      self.pcrplates_barcodes = [pcrplate['barcode'] for pcrplate in self.pcrplates]
+      self.pcrplates_time = time.time()
+
+   def refresh_plates(self):
+      # Plates registered after the pcr plates were loaded, or after the
+      # snapshot they were loaded from was saved (reloaded from LIMS once)
+      if 'pcrplate' in self.snapshot_loaded or (self.plates_refresh is not None and time.time() - self.pcrplates_time >= self.plates_refresh):
+         self.load_plates(refresh=True)
+
+
+   ##
+   ## DATA PARSING
+   ##
+
+   def parse_plate(self, parser, results_file, clipped_file):
+      # Returns (results, rn, run_date), from the parse cache if possible
+      sources = [results_file, clipped_file] if parser == '7900ht' else [results_file]
+      key = self.parse_cache.key('{}:{}'.format(parser, parser_version), sources) if self.parse_cache is not None else None
+      if key is not None:
+         parsed = self.parse_cache.get(key)
+         if parsed is not None:
+            return parsed
+
+      with self.profiler.phase('parse', plate_barcode(results_file)):
+         if parser == '7900ht':
+            parsed = parse_7900ht(results_file, clipped_file)
+         else:
+            parsed = parse_viia7(results_file)
+
+      if key is not None:
+         self.parse_cache.put(key, parsed)
+      return parsed
+
+   def check_ct(self, platebc, results, rn):
+      # Cross-check (or replace, in local mode) the instrument Ct
+      local = local_ct(results, rn)
+      instr = pd.to_numeric(results['Ct'], errors='coerce').values
+      both  = ~np.isnan(local) & ~np.isnan(instr)
+      diff  = (np.isnan(local) != np.isnan(instr)) | (both & (np.abs(np.where(both, local - instr, 0)) > self.ct_tolerance))
+
+      for well, ct, lct in zip(results['Well'].values[diff], instr[diff], local[diff]):
+         logging.warning('[pcrplate={}/pcrwell={}] local Ct {} differs from instrument Ct {}'.format(platebc, plate_384.position[int(well)], 'NA' if np.isnan(lct) else round(lct, 3), 'NA' if np.isnan(ct) else ct))
+      logging.info('[pcrplate={}] local Ct check: {} of {} wells differ'.format(platebc, int(diff.sum()), len(results)))
+
+      if self.ct_mode == 'local':
+         results['Ct'] = ['NA' if np.isnan(ct) else round(float(ct), 3) for ct in local]
+         logging.info('[pcrplate={}] instrument Ct replaced with local Ct calls'.format(platebc))
+
+
+   ##
+   ## AMPLIFICATION DATA UPLOAD
+   ##
+
+   def upload_amplification(self, platebc, wells, on_chunk=None):
+      # Returns the positions of the wells that could not be uploaded.
+      # on_chunk(positions) is called after each successful chunk.
+      # The wells of the remaining chunks fail too if the plate lease is lost.
+      failed = []
+      chunks = amplification_chunks(wells, self.chunk_wells, self.chunk_objects)
+      for chunk in chunks:
+         positions = [pos for pos, objs in chunk]
+         objects   = [obj for pos, objs in chunk for obj in objs]
+
+         # Another worker reclaimed the plate lease, stop writing
+         if not self.lease_held(platebc, 'amplificationdata PATCH of wells {}'.format(','.join(positions))):
+            failed.extend(positions)
+            failed.extend(pos for rest in chunks for pos, objs in rest)
+            break
 
-      # Get list of detector ids
-      detectors, status = lims_request('GET', url=detector_url, params={'limit': 1000000})
-      assert_critical(status < 300, 'Could not retreive pcr detectors from LIMS')
-      detector_ids = {detector['name'].lower(): detector['resource_uri'] for detector in detectors.json()['objects']}
+         # A PATCH to the list endpoint creates objects, it is not idempotent:
+         # the server may have committed the chunk before failing. A failed
+         # chunk is only retried if none of its curves are in LIMS, and counts
+         # as uploaded if all of them are.
+         for attempt in range(1, self.chunk_retries+2):
+            if attempt > 1:
+               time.sleep(backoff_delay(attempt-2))
+            _, status = self.request('PATCH', amplification_url, json_data={'objects': objects})
+            applied = status < 300
+            if applied:
+               break
+            logging.warning('[pcrplate={}/amplificationdata] PATCH of wells {} failed with status {} (attempt {}/{})'.format(platebc, ','.join(positions), status, attempt, self.chunk_retries+1))
 
-      # Get list of PCR machines
-      machines, status = lims_request('GET', url=pcrmachine_url, params={'limit': 1000000})
-      assert_critical(status < 300, 'Could not retreive pcr machines from LIMS')
-      machine_ids = {machine['name'].lower(): machine['resource_uri'] for machine in machines.json()['objects']}
+            stored = self.stored_wells(platebc, chunk)
+            if stored is None:
+               logging.warning('[pcrplate={}/amplificationdata] could not check the curves of wells {} in LIMS, not retried'.format(platebc, ','.join(positions)))
+               break
+            if len(stored) > 0:
+               applied = len(stored) == len([pos for pos, objs in chunk if objs])
+               if applied:
+                  logging.warning('[pcrplate={}/amplificationdata] curves of wells {} found in LIMS, the failed PATCH was applied'.format(platebc, ','.join(positions)))
+               else:
+                  logging.warning('[pcrplate={}/amplificationdata] curves of wells {} partially stored in LIMS, not retried'.format(platebc, ','.join(positions)))
+               break
 
-      # Find all processed samples in path
-      flist = glob.glob('{}/*_results.txt'.format(path))
+         if applied:
+            logging.info('[pcrplate=%s/amplificationdata] patch/post(amplificationdata) = %s (wells: %s, objects: %s)', platebc, status, ','.join(positions), len(objects))
+            if on_chunk is not None:
+               on_chunk(positions)
+         else:
+            failed.extend(positions)
+      return failed
+
+   def amplification_curves(self, platebc):
+      # Curves of the plate in LIMS (see lims_curves), None if the request failed
+      r, status = self.request('GET', amplification_url, params={'limit': 1000000, 'results__pcr_well__pcr_plate__barcode__exact': platebc})
+      if status != 200:
+         return None
+      return lims_curves(r.json()['objects'])
+
+   def stored_wells(self, platebc, chunk):
+      # Positions of the chunk wells with curves in LIMS, None if the
+      # amplificationdata of the plate could not be fetched
+      stored = self.amplification_curves(platebc)
+      if stored is None:
+         return None
+      return [pos for pos, objs in chunk if objs and results_id(objs[0]['results']) in stored]
+
+   def lease_held(self, platebc, writing):
+      # Renews the plate lease before a write, False if another worker
+      # reclaimed it (the plate is aborted, nothing else is written)
+      if self.leases is None or self.leases.renew(platebc):
+         return True
+      logging.error('[pcrplate={}] plate lease lost, {} aborted'.format(platebc, writing))
+      return False
+
+   def checkpoint_wells(self, platebc, results_uris):
+      # Callback recording the wells of each uploaded amplificationdata chunk
+      if self.checkpoint is None:
+         return None
+      return lambda positions: self.checkpoint.complete(platebc, {pos: results_uris[pos] for pos in positions})
+
+
+   ##
+   ## PLATE SYNC
+   ##
+
+   def sync_plate(self, results_file):
+      # Syncs the export of one plate, returns the digest status of the plate:
+      # success, skipped, noinfo, nofile, nowells or error (leased if another
+      # worker holds the plate lease). A LIMS timeout or connection error only
+      # fails the plate; LimsUnavailable (circuit breaker open) is raised
+      # after marking the plate as failed.
+      if self.pcrplates is None:
+         self.load_references()
+
+      platebc = plate_barcode(results_file)
+      if self.leases is not None and not self.leases.acquire(platebc):
+         logging.info('[pcrplate={}] plate leased by another worker, skipped'.format(platebc))
+         self.digest['leased'].append(platebc)
+         return 'leased'
+      try:
+         with self.profiler.phase('upload', platebc):
+            return self._sync_plate(results_file)
+      except (requests.RequestException, LimsUnavailable) as e:
+         logging.error('[pcrplate={}] LIMS request failed: {}'.format(platebc, e))
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['error'].append(platebc)
+         if isinstance(e, LimsUnavailable):
+            raise
+         return 'error'
+      finally:
+         if self.leases is not None:
+            self.leases.release(platebc)
+
+   def _sync_plate(self, results_file):
+      resync  = False
+      platebc = plate_barcode(results_file)
+
+      # Check if PCRPLATE is already in LIMS (TODO: also check if status is PROCESSING)
+      if not platebc in self.pcrplates_barcodes:
+         self.refresh_plates()
+      if not assert_warning(platebc in self.pcrplates_barcodes, '[pcrplate={}] pcrplate/barcode not present in LIMS system, cannot sync data until it is created'.format(platebc)):
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['noinfo'].append(platebc)
+         return 'noinfo'
+
+
+      ##
+      ## CHECK SYNC STATUS
+      ##
+
+      plateobj = [p for p in self.pcrplates if p['barcode'].lower() == platebc.lower()][0]
+      logging.info('[pcrplate={}] pcrplate found in LIMS (id:{}, uri:{})'.format(platebc, plateobj['id'], plateobj['resource_uri']))
+
+      # Check if pcrrun for this plate already exists
+      r, status = self.request('GET', url=pcrrun_url, params={'pcr_plate__barcode__exact': platebc})
+      if not assert_error(status == 200, '[pcrplate={}] error checking presence of PCRRUN'.format(platebc)):
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['error'].append(platebc)
+         return 'error'
+
+      if len(r.json()['objects']) > 0:
+         logging.info("[pcrplate={}] pcrrun info already in LIMS".format(platebc))
+         self.digest['skipped'].append(platebc)
+         if self.sync_state is not None:
+            self.sync_state.record(results_file)
+         return 'skipped'
+
+      logging.info('[pcrplate={}] BEGIN pcrplate processing'.format(platebc))
+
+
+      ##
+      ## PARSE PCR OUTPUT FILES
+      ##
+
+      # Check that results file exists
+      clipped_fname = clipped_file(results_file)
+      if not assert_error(os.path.isfile(results_file), '[pcrplate={}] qPCR results file not found: {}'.format(platebc, results_file)):
+         self.digest['error'].append(platebc)
+         self.digest['nofile'].append(platebc)
+         return 'nofile'
+
+      # Check _results.txt file header (parse machine type)
+      parser = ''
+      runinstrument = None
+      with open(results_file) as f:
+         firstline = f.readline()
+         if firstline[0] == '*':
+            parser = 'viia7'
+         elif re.search('Results',firstline):
+            parser = '7900ht'
+         else:
+            assert_error(False, '[pcrplate={}] SDS Results header not found in: {}'.format(platebc, results_file))
+            self.digest['error'].append(platebc)
+            self.digest['nofile'].append(platebc)
+            return 'nofile'
 
-      for fname in flist:
-         resync  = False
-         platebc = fname.split('/')[-1].split('_results.txt')[0]
 
-         # Check if PCRPLATE is already in LIMS (TODO: also check if status is PROCESSING)
-         if not assert_warning(platebc in pcrplates_barcodes, '[pcrplate={}] pcrplate/barcode not present in LIMS system, cannot sync data until it is created'.format(platebc)):
-            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
-            digest['noinfo'].append(platebc)
-            continue
+      if parser == '7900ht':
+         if not assert_error(os.path.isfile(clipped_fname), '[pcrplate={}] qPCR clipped file not found: {}'.format(platebc, clipped_fname)):
+            self.digest['error'].append(platebc)
+            self.digest['nofile'].append(platebc)
+            return 'nofile'
 
 
-         ##
-         ## CHECK SYNC STATUS
-         ##
+         # Check _clipped.txt file header
+         with open(clipped_fname) as f:
+            firstline = f.readline()
+            if not assert_error(re.search('Clipped',firstline), '[pcrplate={}] SDS Clipped header not found in: {}'.format(platebc, clipped_fname)):
+               self.digest['error'].append(platebc)
+               self.digest['nofile'].append(platebc)
+               return 'nofile'
 
-         plateobj = [p for p in pcrplates if p['barcode'].lower() == platebc.lower()][0]
-         logging.info('[pcrplate={}] pcrplate found in LIMS (id:{}, uri:{})'.format(platebc, plateobj['id'], plateobj['resource_uri']))
+         results, rn, run_date = self.parse_plate(parser, results_file, clipped_fname)
 
-         # Check if pcrrun for this plate already exists
-         r, status = lims_request('GET', url=pcrrun_url, params={'pcr_plate__barcode__exact': platebc})
-         if not assert_error(status == 200, '[pcrplate={}] error checking presence of PCRRUN'.format(platebc)):
-            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
-            digest['error'].append(platebc)
-            continue
+         # Set machine
+         runinstrument = self.machine_ids['7900HT'.lower()] if '7900HT'.lower() in self.machine_ids else None
+      
+      elif parser == 'viia7':
+         results, rn, run_date = self.parse_plate(parser, results_file, clipped_fname)
+         runinstrument = self.machine_ids['viia7'.lower()] if 'viia7'.lower() in self.machine_ids else None
+               
+      # Format results
+      results['Ct'] = results['Ct'].apply(rename_Ct)
+      results['pcrplate'] = platebc
 
-         if len(r.json()['objects']) > 0:
-            logging.info("[pcrplate={}] pcrrun info already in LIMS".format(platebc))
-            digest['skipped'].append(platebc)
-            continue
+      # Cross-check or replace the instrument Ct
+      if self.ct_mode != 'instrument':
+         self.check_ct(platebc, results, rn)
 
-         logging.info('[pcrplate={}] BEGIN pcrplate processing'.format(platebc))
+      # Rn/Delta Rn curves of all the wells (the exports are sorted too)
+      rn     = rn.sort_values(by=['well','cycle'])
+      curves = AmplificationMatrix.from_frame(rn)
 
+      # Format parsed output paths
+      results_outfile = '{}/{}_out.tsv'.format(self.output, platebc)
+      rn_outfile = '{}/{}_rn.tsv'.format(self.output, platebc)
 
-         ##
-         ## PARSE PCR OUTPUT FILES
-         ##
 
-         # Check that results file exists
-         clipped_fname = '{}/{}_clipped.txt'.format(path, platebc)
-         if not assert_error(os.path.isfile(fname), '[pcrplate={}] qPCR results file not found: {}'.format(platebc, fname)):
-            digest['error'].append(platebc)
-            digest['nofile'].append(platebc)
-            continue
+      # Wells completed by an interrupted run of this plate
+      sources = [results_file, clipped_fname] if parser == '7900ht' else [results_file]
+      done      = self.checkpoint.load(platebc, sources) if self.checkpoint is not None else {}
+      kept      = {}
+      unchanged = {}
 
-         # Check _results.txt file header (parse machine type)
-         parser = ''
-         runinstrument = None
-         with open(fname) as f:
-            firstline = f.readline()
-            if firstline[0] == '*':
-               parser = 'viia7'
-            elif re.search('Results',firstline):
-               parser = '7900ht'
-            else:
-               assert_error(False, '[pcrplate={}] SDS Results header not found in: {}'.format(platebc, fname))
-               digest['error'].append(platebc)
-               digest['nofile'].append(platebc)
-               continue
 
+      ##
+      ## CHECK IF RESYNC NEEDED
+      ##
 
-         if parser == '7900ht':
-            if not assert_error(os.path.isfile(clipped_fname), '[pcrplate={}] qPCR clipped file not found: {}'.format(platebc, clipped_fname)):
-               digest['error'].append(platebc)
-               digest['nofile'].append(platebc)
-               continue
+      r, status = self.request('GET', results_url, params={'limit':10000, 'pcr_well__pcr_plate__barcode__exact':platebc})
+      if not assert_error(status == 200, '[pcrplate={}] error checking presence of RESULTS'.format(platebc)):
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['error'].append(platebc)
+         return 'error'
 
 
-            # Check _clipped.txt file header
-            with open(clipped_fname) as f:
-               firstline = f.readline()
-               if not assert_error(re.search('Clipped',firstline), '[pcrplate={}] SDS Clipped header not found in: {}'.format(platebc, clipped_fname)):
-                  digest['error'].append(platebc)
-                  digest['nofile'].append(platebc)
-                  continue
+      res_objs = r.json()['objects']
+      if len(res_objs) > 0:
+         logging.info('[pcrplate={}] results information is already in LIMS: RESYNC'.format(platebc))
+         resync = True
 
-            results, rn, run_date = parse_7900ht(fname, clipped_fname)
+         # Check first
+         if not assert_error(len(res_objs) <= 384, '[pcrplate={}] error when querying RESULTS for this plate, got {} objects'.format(platebc, len(res_objs))):
+            self.digest['error'].append(platebc)
+            return 'error'
 
-            # Set machine
-            runinstrument = machine_ids['7900HT'.lower()] if '7900HT'.lower() in machine_ids else None
-         
-         elif parser == 'viia7':
-            results, rn, run_date = parse_viia7(fname)
-            runinstrument = machine_ids['viia7'.lower()] if 'viia7'.lower() in machine_ids else None
-                  
-         # Format results
-         results['Ct'] = results['Ct'].apply(rename_Ct)
-         results['pcrplate'] = platebc
 
-         # Format parsed output paths
-         results_outfile = '{}/{}_out.tsv'.format(outpath, platebc)
-         rn_outfile = '{}/{}_rn.tsv'.format(outpath, platebc)
+      ##
+      ## GET PCRWELLS
+      ##
 
+      # Get all PCRWELL for this PCRPLATE
+      r, status = self.request('GET', url=pcrwell_url, params={'limit': 10000, 'pcr_plate__barcode__exact': platebc})
+      if not assert_error(status == 200, '[pcrplate={}/pcrwell] error getting PCRWELLs for this PCRPLATE'.format(platebc)):
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['error'].append(platebc)
+         return 'error'
 
-         ##
-         ## CHECK IF RESYNC NEEDED
-         ##
+      # PCRWELL position is in A1, A2, B1 format
+      pcrwells = r.json()['objects']
 
-         r, status = lims_request('GET', results_url, params={'limit':10000, 'pcr_well__pcr_plate__barcode__exact':platebc})
-         if not assert_error(status == 200, '[pcrplate={}] error checking presence of RESULTS'.format(platebc)):
+      if not assert_warning(len(pcrwells) > 0, '[pcrplate={}] no pcrwells found in LIMS for this pcrplate'.format(platebc)):
+         self.digest['nowells'].append(platebc)
+         return 'nowells'
+      else:
+         logging.info('[pcrplate={}/pcrwell] len(pcrplate={}/pcrwell) = {}'.format(platebc, platebc, len(pcrwells)))
+         
+      # Create a lookup table of well_position -> well_id
+      pcrwell_pos_to_uri = {p['position'].upper():p['resource_uri'] for p in pcrwells}
+
+
+      ##
+      ## RESYNC: DELETE CHANGED RESULTS
+      ##
+
+      if resync:
+         # Keep the checkpointed wells whose results are still in LIMS
+         lims_ids = set(str(o['id']) for o in res_objs)
+         kept     = {pos: uri for pos, uri in done.items() if results_id(uri) in lims_ids}
+         if len(kept) > 0:
+            logging.info('[pcrplate={}] RESUME: {} wells already complete in LIMS (checkpoint)'.format(platebc, len(kept)))
+
+         # Keep the wells whose results did not change
+         if self.diff_resync:
+            stored_curves = self.amplification_curves(platebc)
+            if assert_warning(stored_curves is not None, '[pcrplate={}] DIFF RESYNC: could not get the amplificationdata in LIMS, all wells are rewritten'.format(platebc)):
+               unchanged = unchanged_wells(results, res_objs, pcrwell_pos_to_uri, self.detector_ids, curves, stored_curves)
+            logging.info('[pcrplate={}] DIFF RESYNC: {} wells unchanged, {} wells to rewrite'.format(platebc, len(unchanged), len(results)-len(unchanged)))
+            kept.update(unchanged)
+
+         kept_ids    = set(results_id(uri) for uri in kept.values())
+         results_ids = [o['id'] for o in res_objs if not str(o['id']) in kept_ids]
+
+         # Delete current results
+         if len(results_ids) > 0 and not self.lease_held(platebc, 'results DELETE'):
             logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
-            digest['error'].append(platebc)
+            self.digest['error'].append(platebc)
+            return 'error'
+         for r_id in results_ids:
+            if not assert_error(r_id, '[pcrplate={}] avoiding full DELETE, for some reason results_id="". ABORT PLATE'.format(platebc, len(res_objs))):
+               self.digest['error'].append(platebc)
+               continue
+            del_uri = '{}/{}'.format(results_url, r_id)
+            self.request('DELETE', del_uri)
+            logging.info('[pcrplate={}/results={}] deleted RESULTS entry in LIMS (uri: {})'.format(platebc,r_id,del_uri))
+
+      if self.checkpoint is not None:
+         self.checkpoint.keep(platebc, kept)
+
+      # Create diagnosis for each PCRWELL
+      diagnosis = [[None,None,None] for i in range(plate_384.size+1)]
+
+      ##
+      ## GET CONTROL POSITIONS
+      ##
+
+      # Get control positions
+      control_type = {}
+      for control_name in control_amplif:
+         # Get request, filter by sample type
+         r, status = self.request("GET", url=pcrwell_url, params={'rna_extraction_well__sample__sample_type__name__exact': control_name, 'pcr_plate__barcode__exact': platebc})
+         if not assert_error(status == 200, '[pcrplate={}/pcrwell] error retreiving control position (control name={})'.format(platebc, control_name)):
+            logging.warning('[pcrplate={}] automatic control checking disabled for control name={}'.format(platebc, control_name))
+
+         # Create a lookup table: well_position -> control type
+         cp = {p['position'] : control_name for p in r.json()['objects']}
+         control_type.update(cp)
+
+      ##
+      ## DIGEST DATA
+      ##
+
+      # Prepare digest sample structure
+      self.digest['sample'][platebc] = [[[status_code['EMP'], None] for y in range(plate_96.cols)] for x in range(plate_96.rows)]
+
+      # Prepare digest control structure
+      self.digest['control'][platebc] = {ct: list() for ct in control_amplif}
+
+
+      ###
+      ### UPLOAD RESULTS
+      ###
+
+      fail_flag = False
+      failed_wells = []
+      results_uris = {}
+      amplification_wells = []
+      on_chunk = self.checkpoint_wells(platebc, results_uris)
+
+      # Per-well INFO lines take lazy arguments, they are formatted by the log
+      # handler thread (not at all if INFO is off), not in this loop
+      for row in results.iterrows():
+         row = row[1]
+         well_num = int(row['Well'])
+         pcrwell_pos = plate_384.position[well_num]
+         logging.info('[pcrplate=%s/pcrwell=%s] BEGIN pcrwell processing', platebc, pcrwell_pos)
+
+         if not (pcrwell_pos in pcrwell_pos_to_uri):
+            logging.info('[pcrplate=%s/pcrwell] well %s not found in LIMS', platebc, pcrwell_pos)
+            logging.info('[pcrplate=%s/pcrwell=%s] ABORT pcrwell processing', platebc, pcrwell_pos)
             continue
 
+         ##
+         ## RESULTS
+         ##
 
-         res_objs = r.json()['objects']
-         if len(res_objs) > 0:
-            ##
-            ## RESYNC: DELETE CURRENT RESULTS
-            ##
+         # Ct and amplification
+         ct, amplification, threshold = result_values(row)
 
-            logging.info('[pcrplate={}] results information is already in LIMS: RESYNC'.format(platebc))
-            resync = True
+         # qPCR detector
+         if not assert_warning(row['Detector Name'].lower() in self.detector_ids, '[pcrplate={}/pcrwell={}] detector {} not found in LIMS, setting to "None"'.format(platebc, pcrwell_pos, row['Detector Name'])):
+            detector_id = None
+            self.digest['warning'].append(platebc)
+         else:
+            detector_id = self.detector_ids[row['Detector Name'].lower()]
+
+         # results LIMS object
+         results_data = {
+            'id':None,
+            'pcr_well': pcrwell_pos_to_uri[pcrwell_pos],
+            'comments': None,
+            'date_analysis': datetime.datetime.now().isoformat(),
+            'date_sent': datetime.datetime.now().isoformat(),
+            'amplification': amplification,
+            'threshold': default_ct_threshold,
+            'qpcr_threshold': threshold,
+            'detector': detector_id,
+            'detector_lot_number': None,
+            'ct': ct
+         }
 
-            # Check first
-            if not assert_error(len(res_objs) <= 384, '[pcrplate={}] error when querying RESULTS for this plate, got {} objects'.format(platebc, len(res_objs))):
-               digest['error'].append(platebc)
-               continue
+         # Store amplification in the diagnosis table of the A1, A2 and B1 wells
+         # of the sample block, B2 is empty (WARN: ASSUMES LOCAL SINGLEPLEX)
+         samp = plate_384.quadrant[well_num]
+         if samp < 3:
+            for dpos in plate_384.block[well_num][:3]:
+               diagnosis[dpos][samp] = amplification
+
+         # Results and amplification already in LIMS (unchanged, or written by
+         # an interrupted run)
+         if pcrwell_pos in unchanged:
+            logging.info('[pcrplate=%s/pcrwell=%s] results and curves unchanged in LIMS (diff resync), upload skipped', platebc, pcrwell_pos)
+            continue
+         if pcrwell_pos in kept:
+            logging.info('[pcrplate=%s/pcrwell=%s] results already in LIMS (checkpoint), upload skipped', platebc, pcrwell_pos)
+            continue
 
-            results_ids = [o['id'] for o in res_objs]
+         # POST request (results), the lease is renewed for each chunk of wells
+         if len(amplification_wells) == 0 and not self.lease_held(platebc, 'results POST'):
+            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+            self.digest['error'].append(platebc)
+            fail_flag = True
+            break
+         r, status = self.request('POST', results_url, json_data=results_data)
+         if not assert_error(status == 201, '[pcrplate={}/pcrwell={}/results] error creating results'.format(platebc, pcrwell_pos)):
+            logging.info('[pcrplate=%s/pcrwell=%s] ABORT pcrwell processing', platebc, pcrwell_pos)
+            self.digest['error'].append(platebc)
+            fail_flag = True
+            break
 
-            # Delete current results
-            for r_id in results_ids:
-               if not assert_error(r_id, '[pcrplate={}] avoiding full DELETE, for some reason results_id="". ABORT PLATE'.format(platebc, len(res_objs))):
-                  digest['error'].append(platebc)
-                  continue
-               del_uri = '{}/{}'.format(results_url, r_id)
-               lims_request('DELETE', del_uri)
-               logging.info('[pcrplate={}/results={}] deleted RESULTS entry in LIMS (uri: {})'.format(platebc,r_id,del_uri))
+         # Get new element uri
+         results_uri = r.headers['Location']
+         results_uris[pcrwell_pos] = results_uri
+         logging.info('[pcrplate=%s/pcrwell=%s/results] post(results) = %s (uri:%s)', platebc, pcrwell_pos, status, results_uri)
 
 
          ##
-         ## GET PCRWELLS
+         ## RN/DELTA_RN CURVES
          ##
 
-         # Get all PCRWELL for this PCRPLATE
-         r, status = lims_request('GET', url=pcrwell_url, params={'limit': 10000, 'pcr_plate__barcode__exact': platebc})
-         if not assert_error(status == 200, '[pcrplate={}/pcrwell] error getting PCRWELLs for this PCRPLATE'.format(platebc)):
-            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
-            digest['error'].append(platebc)
-            continue
+         # Uploaded in multi-well chunks, completed wells are checkpointed
+         amplification_wells.append((pcrwell_pos, amplification_data(curves.curves(well_num), results_uri)))
+         if len(amplification_wells) >= self.chunk_wells:
+            failed_wells += self.upload_amplification(platebc, amplification_wells, on_chunk)
+            amplification_wells = []
 
-         # PCRWELL position is in A1, A2, B1 format
-         pcrwells = r.json()['objects']
 
-         if not assert_warning(len(pcrwells) > 0, '[pcrplate={}] no pcrwells found in LIMS for this pcrplate'.format(platebc)):
-            digest['nowells'].append(platebc)
-            continue
-         else:
-            logging.info('[pcrplate={}/pcrwell] len(pcrplate={}/pcrwell) = {}'.format(platebc, platebc, len(pcrwells)))
-            
-         # Create a lookup table of well_position -> well_id
-         pcrwell_pos_to_uri = {p['position'].upper():p['resource_uri'] for p in pcrwells}
+      if fail_flag:
+         return 'error'
 
-         # Create diagnosis for each PCRWELL
-         diagnosis = [[None,None,None] for i in range(385)]
+      ##
+      ## UPLOAD AMPLIFICATION DATA
+      ##
 
-         ##
-         ## GET CONTROL POSITIONS
-         ##
-
-         # Get control positions
-         control_type = {}
-         for control_name in control_amplif:
-            # Get request, filter by sample type
-            r, status = lims_request("GET", url=pcrwell_url, params={'rna_extraction_well__sample__sample_type__name__exact': control_name, 'pcr_plate__barcode__exact': platebc})
-            if not assert_error(status == 200, '[pcrplate={}/pcrwell] error retreiving control position (control name={})'.format(platebc, control_name)):
-               logging.warning('[pcrplate={}] automatic control checking disabled for control name={}'.format(platebc, control_name))
+      failed_wells += self.upload_amplification(platebc, amplification_wells, on_chunk)
+      if not assert_error(len(failed_wells) == 0, '[pcrplate={}/amplificationdata] error in PATCH request to create Rn, failed wells: {}'.format(platebc, ','.join(failed_wells))):
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['error'].append(platebc)
+         return 'error'
 
-            # Create a lookup table: well_position -> control type
-            cp = {p['position'] : control_name for p in r.json()['objects']}
-            control_type.update(cp)
+      ##
+      ## AUTOMATIC DIAGNOSIS (SINGLEPLEX SPECIFIC CODE)
+      ##
 
-         ##
-         ## DIGEST DATA
-         ##
+      pcrwells_update = []
+      for pcrwell in pcrwells:
+         dpos = plate_384.well_number(pcrwell['position'])
+         auto_diagnosis = compute_diagnosis(diagnosis[dpos])
+         
+         # Base position, this is the top left well of each singleplexed sample (WARN: ASSUMES LOCAL SINGLEPLEX)
+         base_pos = plate_384.base[dpos]
+            
+         # Row/column in 96-well plate
+         row = plate_384.parent_row[dpos]
+         col = plate_384.parent_col[dpos]
 
-         # Prepare digest sample structure
-         digest['sample'][platebc] = [[[status_code['EMP'], None] for y in range(12)] for x in range(8)]
+         # Report no Rp amplification
+         self.digest['sample'][platebc][row][col][1] = diagnosis[dpos][2]
 
-         # Prepare digest control structure
-         digest['control'][platebc] = {ct: list() for ct in control_amplif}
+         # Check if control well has the expected amplification
+         if pcrwell['position'] in control_type:
+            pass_fail = diagnosis[dpos] == control_amplif[control_type[pcrwell['position']]]
+            pass_fail = 'P' if pass_fail else 'F'
 
+            # Store control status in control check
+            w384_pos = plate_384.position[base_pos]
+            self.digest['control'][platebc][control_type[w384_pos]].append((w384_pos, pass_fail))
+            
+            # Store control status in sample digest
+            self.digest['sample'][platebc][row][col][0] = status_code['PCT' if pass_fail == 'P' else 'FCT']
+            
+         else:
+            pass_fail = 'NA'
+            # Store sample diagnosis in sample digest
+            self.digest['sample'][platebc][row][col][0] = status_code['NAD' if auto_diagnosis is None else auto_diagnosis]
 
-         ###
-         ### UPLOAD RESULTS
-         ###
+         # Diff resync: only send the autodiagnosis values that changed
+         if self.diff_resync and pcrwell.get('pass_fail', '') == pass_fail and pcrwell.get('automatic_diagnosis', '') == auto_diagnosis:
+            continue
 
-         fail_flag = False
-         for row in results.iterrows():
-            i = row[0]
-            row = row[1]
-            well_num = int(row['Well'])
-            pcrwell_pos = chr(65+(well_num-1)//24)+str((well_num-1)%24+1)
-            logging.info('[pcrplate={}/pcrwell={}] BEGIN pcrwell processing'.format(platebc, pcrwell_pos))
+         pcrwells_update.append({
+            'pass_fail': pass_fail,
+            'automatic_diagnosis': auto_diagnosis,
+            'resource_uri': pcrwell['resource_uri']
+         })
 
-            if not (pcrwell_pos in pcrwell_pos_to_uri):
-               logging.info('[pcrplate={}/pcrwell] well {} not found in LIMS'.format(platebc, pcrwell_pos))
-               logging.info('[pcrplate={}/pcrwell={}] ABORT pcrwell processing'.format(platebc, pcrwell_pos))
-               continue
+      ##
+      ## UPDATE PCRWELL
+      ##
+      
+      # All wells have been processed, PATCH back to API
+      if len(pcrwells_update) > 0:
+         if not self.lease_held(platebc, 'pcrwell PATCH'):
+            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+            self.digest['error'].append(platebc)
+            return 'error'
+         _, status = self.request('PATCH', pcrwell_url, json_data={'objects': pcrwells_update})
+         if not assert_error(status < 300, '[pcrplate={}/pcrwell] error in PATCH request to update pcrwell (autodiagnosis)'.format(platebc, pcrwell_pos)):
+            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+            self.digest['error'].append(platebc)
+            return 'error'
+         logging.info('[pcrplate={}/pcrwell] patch/update(pcrwell) = {} ({} pcrwells)'.format(platebc, status, len(pcrwells_update)))
+      else:
+         logging.info('[pcrplate={}/pcrwell] autodiagnosis unchanged, no pcrwell update needed'.format(platebc))
+
+
+      ##
+      ## CREATE PCR RUN
+      ##
+
+      # Now create PCRRUN, this way if we don't reach this point it will trigger
+      # resync of the same sample in the next sync job.
+
+      # pcrrun LIMS object
+      pcrrun_data = {
+         'id': None,
+         'pcr_plate': plateobj['resource_uri'],
+         'technician_id': None,
+         'pcr_run_instrument': runinstrument,
+         'pcr_run_protocol_id': None,
+         'date_run': date_parse(run_date).isoformat(),
+         'raw_results_file_path': results_file,
+         'results_file_path': results_outfile,
+         'run_log_path': self.log_file,
+         'analysis_result_file_path': results_file,
+         'status': 'R',
+         'comments': None
+      }
 
-            ##
-            ## RESULTS
-            ##
+      # POST request (pcrplate)
+      if not self.lease_held(platebc, 'pcrrun POST'):
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['error'].append(platebc)
+         return 'error'
+      r, status = self.request('POST', pcrrun_url, json_data=pcrrun_data)
+      if not assert_error(status == 201, '[pcrplate={}] error creating PCRRUN in LIMS'.format(platebc)):
+         logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
+         self.digest['error'].append(platebc)
+         return 'error'
+
+      # Log new element uri
+      pcrrun_uri = r.headers['Location']
+      if self.checkpoint is not None:
+         self.checkpoint.clear(platebc)
+      logging.info('[pcrplate={}/pcrrun] post(pcrrun) = {} (uri:{})'.format(platebc, status, pcrrun_uri))
+
+
+      ##
+      ## STORE PARSED RESULTS FILE
+      ##
+
+      # Store parsing output
+      rn['bcd'] = platebc
+      
+      results.to_csv(results_outfile, sep='\t', index=False)
+      logging.info('[pcrplate={}] parsed results exported to: {}'.format(platebc, results_outfile))
 
-            # Ct and amplification
-            ct            = None  if row['Ct'] == 'NA' else row['Ct']
-            amplification = False if ct is None else float(ct) <= default_ct_threshold
-            threshold     = None  if pd.isna(row['Threshold']) else row['Threshold']
+      rn.to_csv(rn_outfile, sep='\t', index=False)
+      logging.info('[pcrplate={}] export Rn/Delta Rn values to: {}'.format(platebc, rn_outfile))
 
-            # qPCR detector
-            if not assert_warning(row['Detector Name'].lower() in detector_ids, '[pcrplate={}/pcrwell={}] detector {} not found in LIMS, setting to "None"'.format(platebc, pcrwell_pos, row['Detector Name'])):
-               detector_id = None
-               digest['warning'].append(platebc)
-            else:
-               detector_id = detector_ids[row['Detector Name'].lower()]
-
-            # results LIMS object
-            results_data = {
-               'id':None,
-               'pcr_well': pcrwell_pos_to_uri[pcrwell_pos],
-               'comments': None,
-               'date_analysis': datetime.datetime.now().isoformat(),
-               'date_sent': datetime.datetime.now().isoformat(),
-               'amplification': amplification,
-               'threshold': default_ct_threshold,
-               'qpcr_threshold': threshold,
-               'detector': detector_id,
-               'detector_lot_number': None,
-               'ct': ct
-            }
-
-            # Store amplification in diagnosis table (WARN: ASSUMES LOCAL SINGLEPLEX)
-            if ((well_num-1)//24)%2:
-               if (well_num-1)%2: # B2 (empty)
-                  dpos = None
-               else: # B1
-                  dpos = well_num-24
-                  samp = 2
-            else:
-               if (well_num-1)%2: # A2
-                  dpos = well_num-1
-                  samp = 1
-               else: # A1
-                  dpos = well_num
-                  samp = 0
-
-            if dpos:
-               diagnosis[dpos][samp] = diagnosis[dpos+1][samp] = diagnosis[dpos+24][samp] = amplification
-
-            # POST request (results)
-            r, status = lims_request('POST', results_url, json_data=results_data)
-            if not assert_error(status == 201, '[pcrplate={}/pcrwell={}/results] error creating results'.format(platebc, pcrwell_pos)):
-               logging.info('[pcrplate={}/pcrwell={}] ABORT pcrwell processing'.format(platebc, pcrwell_pos))
-               digest['error'].append(platebc)
-               fail_flag = True
-               break
+      if self.archive is not None:
+         archive_plate(self.archive, platebc, results, rn, run_date, parser)
+         logging.info('[pcrplate={}] results and Rn/Delta Rn values archived to: {}'.format(platebc, self.archive.root))
 
-            # Get new element uri
-            results_uri = r.headers['Location']
-            logging.info('[pcrplate={}/pcrwell={}/results] post(results) = {} (uri:{})'.format(platebc, pcrwell_pos, status, results_uri))
-
-
-            ##
-            ## RN/DELTA_RN CURVES
-            ##
-            rn       = rn.sort_values(by=['well','cycle'])
-            rn_vals  = rn[rn['well'] == row['Well']]['Rn'].tolist()
-            drn_vals = rn[rn['well'] == row['Well']]['Delta Rn'].tolist()
-
-            # Create a list of amplificationdata objects
-            amplification_data = []
-            cycle = 1
-            for r,d in zip(rn_vals, drn_vals):
-               amplification_data.append({
-                  'results': results_uri,
-                  'cycle': cycle,
-                  'rn': r,
-                  'delta_rn': d
-               })
-               cycle += 1
-
-            # PATCH request (amplificationdata)
-            _, status = lims_request('PATCH', amplification_url, json_data={'objects': amplification_data})
-            if not assert_error(status < 300, '[pcrplate={}/pcrwell={}/amplificationdata] error in PATCH request to create Rn'.format(platebc, pcrwell_pos)):
-               logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
-               digest['error'].append(platebc)
-               fail_flag = True
-               break
-            logging.info('[pcrplate={}/pcrwell={}/results/amplificationdata] patch/post(amplificationdata) = {}'.format(platebc, pcrwell_pos, status))
+      logging.info('[pcrplate={}] SUCCESS pcrplate processing'.format(platebc))
 
+      # Add to synced list
+      self.digest['success'].append((platebc, resync))
+      if self.sync_state is not None:
+         self.sync_state.record(results_file)
 
-         if fail_flag:
-            continue
-         ##
-         ## AUTOMATIC DIAGNOSIS (SINGLEPLEX SPECIFIC CODE)
-         ##
+      return 'success'
 
-         pcrwells_update = []
-         for pcrwell in pcrwells:
-            dpos = int((ord(pcrwell['position'][0].upper())-65)*24 + int(pcrwell['position'][1:]))
-            auto_diagnosis = compute_diagnosis(diagnosis[dpos])
-            
-            # Find base position, this is the top left well of each singleplexed sample (WARN: ASSUMES LOCAL SINGLEPLEX)
-            if ((dpos-1)//24)%2:
-               base_pos = dpos-25 if (dpos-1)%2 else dpos-24
-            else:
-               base_pos = dpos-1 if (dpos-1)%2 else dpos
-               
-            # Find row/column in 96-well plate
-            row = (base_pos-1)//48
-            col = ((base_pos-1)%48)//2
 
-            # Report no Rp amplification
-            digest['sample'][platebc][row][col][1] = diagnosis[dpos][2]
+   ##
+   ## DIGEST
+   ##
 
-            # Check if control well has the expected amplification
-            if pcrwell['position'] in control_type:
-               pass_fail = diagnosis[dpos] == control_amplif[control_type[pcrwell['position']]]
-               pass_fail = 'P' if pass_fail else 'F'
+   def html_digest(self, log_file, tb=None):
+      digest = self.digest
 
-               # Store control status in control check
-               w384_pos = chr(65+(base_pos-1)//24)+str((base_pos-1)%24+1)
-               digest['control'][platebc][control_type[w384_pos]].append((w384_pos, pass_fail))
-               
-               # Store control status in sample digest
-               digest['sample'][platebc][row][col][0] = status_code['PCT' if pass_fail == 'P' else 'FCT']
-               
-            else:
-               pass_fail = 'NA'
-               # Store sample diagnosis in sample digest
-               digest['sample'][platebc][row][col][0] = status_code['NAD' if auto_diagnosis is None else auto_diagnosis]
+      # Convert digest lists to sets
+      digest['nofile']  = list(set(digest['nofile']))
+      digest['noinfo']  = list(set(digest['noinfo']))
+      digest['nowells'] = list(set(digest['nowells']))
+      digest['success'] = list(set(digest['success']))
+      digest['warning'] = list(set(digest['warning']))
+      digest['error']   = list(set(digest['error']))
 
-            pcrwells_update.append({
-               'pass_fail': pass_fail,
-               'automatic_diagnosis': auto_diagnosis,
-               'resource_uri': pcrwell['resource_uri']
-            })
+      job_end = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
 
-         ##
-         ## UPDATE PCRWELL
-         ##
+      html = HtmlReport(html_style, self.digest_size_budget)
+   
+      # Header with run description
+      html.title('LIMS update report')
+      html.section('description', 'Job description:', 'Job description')
+      html.write(
+         '<ul><li><b>Job name:</b> {}</li>'.format(mono.format(self.job_name)),
+         '<li><b>Job start:</b> {}</li>'.format(mono.format(self.job_start)),
+         '<li><b>Job end:</b> {}</li>'.format(mono.format(job_end)),
+         '<li><b>Script version:</b> {}</li>'.format(mono.format(__version__)),
+         '<li><b>Command:</b> {}</li>'.format(mono.format(' '.join(sys.argv))),
+         '<li><b>Working directory:</b> {}</li>'.format(mono.format(os.getcwd())),
+         '<li><b>Log file:</b> {}</li>'.format(mono.format(log_file)),
+         '<li><b>LIMS requests:</b> {}</li>'.format(mono.format(self.session.stats.summary())),
+         '<li><b>Exit status:</b> {}</li></ul>\n'.format(mono.format(1 if tb else 0))
+      )
+
+      if tb:
+         html.write('<br><h2>Cause of failure:</h2>', mono.format(tb.replace('<','&lt;').replace('>','&gt;').replace('\n','<br>')))
+      
+      # Update summary (only if there are samples to talk about)
+      if len(digest['noinfo'])  > 0 or \
+         len(digest['nofile'])  > 0 or \
+         len(digest['error'])   > 0 or \
+         len(digest['warning']) > 0 or \
+         len(digest['success']) > 0 or \
+         len(digest['nowells']) > 0:
+         html.section('summary', 'Update summary:', 'Update summary')
+
+         #  No results file found
+         if len(digest['nofile']) > 0:
+            html.write('<br>The following PCR runs <b>did not synchronize</b> because the PCR results have not been exported properly:</b>\n<ul>')
+            html.write(*['<li>{}</li>'.format(bcd) for bcd in digest['nofile']])
+            html.write('</ul>')
+      
+         #  No info
+         if len(digest['noinfo']) > 0:
+            html.write('<br>The following PCR runs <b>did not synchronize</b> because the PCR plate has not been pre-registered in LIMS:</b>\n<ul>')
+            html.write(*['<li>{}</li>'.format(bcd) for bcd in digest['noinfo']])
+            html.write('</ul>')
          
-         # All wells have been processed, PATCH back to API
-         _, status = lims_request('PATCH', pcrwell_url, json_data={'objects': pcrwells_update})
-         if not assert_error(status < 300, '[pcrplate={}/pcrwell] error in PATCH request to update pcrwell (autodiagnosis)'.format(platebc, pcrwell_pos)):
-            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
-            digest['error'].append(platebc)
-            continue
-         logging.info('[pcrplate={}/pcrwell] patch/update(pcrwell) = {}'.format(platebc, status))
+         #  No pcrwells found
+         if len(digest['nowells']) > 0:
+            html.write('<br>The following PCR runs <b>did not synchronize</b> because no PCR wells were found in LIMS (did you create the well layout?):</b>\n<ul>')
+            html.write(*['<li>{}</li>'.format(bcd) for bcd in digest['nowells']])
+            html.write('</ul>')
 
+         #  Error
+         if len(digest['error']) > 0:
+            html.write('<br>PCR plates with LIMS synchronization <b><span style="color:red">ERRORS</span></b>: (click to see log digest)\n<ul>')
+            html.write(*['<li><a href="#{}error">{}</a></li>'.format(bcd, bcd) for bcd in digest['error']])
+            html.write('</ul>')
 
-         ##
-         ## CREATE PCR RUN
-         ##
+         #  Warning
+         if len(digest['warning']) > 0:
+            html.write('<br>PCR plates with LIMS synchronization <b><span style="color:orange">WARNINGS</span></b>: (click to see log digest)\n<ul>')
+            html.write(*['<li><a href="#{}warn">{}</a></li>'.format(bcd, bcd) for bcd in digest['warning']])
+            html.write('</ul>')
+
+         #  Success (there is sample/control data)
+         if len(digest['success']) > 0:
+            html.write('<br><b>List of synchronized PCR runs:</b>\n<ul>')
+            html.write(*['<li>{}{}</li>'.format(bcd, ' (resync)' if resync else '') for bcd, resync in digest['success']])
+            html.write('</ul>')
+
+            # Sample stats
+            html.section('stats', 'Sample stats')
+            html.write('<table style="white-space:nowrap;"><tr>\
+            <th>PCR barcode</th>\
+            <th>Total Samples</th>\
+            <td>Negative</td>\
+            <td>Positive</td>\
+            <td>Inconclusive</td>\
+            <td>Invalid</td>\
+            <td>No AD</td>\
+            <th>Total Controls</th>\
+            <td>Passed</td>\
+            <td>Failed</td>\
+            </tr>')
+                     
+            for bcd in digest['sample']:
+               # Compute sample frequencies
+               freq = collections.Counter(c[0] for r in digest['sample'][bcd] for c in r)
+
+               # Fill table
+               html.write('<tr>', *[mono_cell.format(v) for v in [
+                  bcd,
+                  freq[status_code['P']]+freq[status_code['N']]+freq[status_code['I']]+freq[status_code['NAD']]+freq[status_code['NV']],
+                  freq[status_code['N']],
+                  freq[status_code['P']],
+                  freq[status_code['I']],
+                  freq[status_code['NV']],
+                  freq[status_code['NAD']],
+                  freq[status_code['PCT']]+freq[status_code['FCT']],
+                  freq[status_code['PCT']],
+                  freq[status_code['FCT']]
+               ]])
+               html.write('</tr>')
+            html.write('</table>')
+
+            # PCR plate viz
+            html.section('sampviz', 'Sample visualization')
+            html.write(plate_legend)
+
+            html.begin_block()
+            plate_head, plate_rows = plate_header()
+            for bcd in digest['sample']:
+               html.write('<h3>PCR run: {}</h3>\n'.format(bcd), plate_head)
+               for i, r in enumerate(digest['sample'][bcd]):
+                  html.write(plate_rows[i], *[plate_cells[(c[0], bool(c[1]))] for c in r])
+                  html.write('</tr>')
+               html.write('</table>')
+            html.end_block('{}_sample_visualization'.format(self.job_name), 'Sample visualization')
+
+            # Control checks
+            html.section('controls', 'Control checks')
+
+            control_bcd = list(digest['control'].keys())
+
+            if len(control_bcd) > 0:
+               # Table header
+               control_names = digest['control'][control_bcd[0]].keys()
+               html.write('<table style="white-space:nowrap"><tr><th>PCR barcode</th>', *['<th>{}</th>'.format(cname) for cname in control_names])
+               html.write('</tr>')
+
+               # Table content
+               for bcd in control_bcd:
+                  html.write('<tr><td>{}</td>'.format(bcd))
+                  for ctl in digest['control'][bcd]:
+                     conds = list(set(digest['control'][bcd][ctl]))
+                     html.write('<td>')
+                     if len(conds) > 0:
+                        html.write(*['<span style="color:{}"><b>{}</b></span>({}) '.format('green' if cond[1] == 'P' else 'red', 'Pass' if cond[1] == 'P' else 'Fail', cond[0]) for cond in conds])
+                     else:
+                        html.write('None')
+                     html.write('</td>')
+
+                  html.write('</tr>')
+               html.write('</table>')
 
-         # Now create PCRRUN, this way if we don't reach this point it will trigger
-         # resync of the same sample in the next sync job.
-
-         # pcrrun LIMS object
-         pcrrun_data = {
-            'id': None,
-            'pcr_plate': plateobj['resource_uri'],
-            'technician_id': None,
-            'pcr_run_instrument': runinstrument,
-            'pcr_run_protocol_id': None,
-            'date_run': date_parse(run_date).isoformat(),
-            'raw_results_file_path': fname,
-            'results_file_path': results_outfile,
-            'run_log_path': logpath,
-            'analysis_result_file_path': fname,
-            'status': 'R',
-            'comments': None
-         }
+            else:
+               html.write('No control samples found!')
+
+         # Log digests
+         if len(digest['error']) > 0 or len(digest['warning']) > 0:
+            html.section('logs', 'Log digest')
+            html.begin_block()
+            # Error logs
+            if len(digest['error']) > 0:
+               html.write('<h3>Error logs:</h3>')
+               for bcd in digest['error']:
+                  html.write('<br><a name="{}error"></a>Error log for {}:\n'.format(bcd,bcd))
+                  html.write('<br><p style="font-family:\'Courier New\'">{}</p><br>'.format('<br>'.join(self.log_index.lines(bcd, logging.ERROR))))
+
+            # Warning logs
+            if len(digest['warning']) > 0:
+               html.write('<h3>Warning logs:</h3>')
+               for bcd in digest['warning']:
+                  html.write('<br><a name="{}warn"></a>Warning log for {}:\n'.format(bcd,bcd))
+                  html.write('<br><p style="font-family:\'Courier New\'">{}</p><br>'.format('<br>'.join(self.log_index.lines(bcd, logging.WARNING))))
+            html.end_block('{}_log_digest'.format(self.job_name), 'Log digest')
+
+      return html.mime_parts()
+
+   def send_digest(self, mailer, tb=None):
+      subject = "LIMS update {} ({})".format('report' if tb is None else 'FAILED', self.job_name)
+      with self.profiler.phase('render'):
+         parts = self.html_digest(self.log_file, tb)
+      mailer.send(subject, parts)
 
-         # POST request (pcrplate)
-         r, status = lims_request('POST', pcrrun_url, json_data=pcrrun_data)
-         if not assert_error(status == 201, '[pcrplate={}] error creating PCRRUN in LIMS'.format(platebc)):
-            logging.info('[pcrplate={}] ABORT pcrplate processing'.format(platebc))
-            digest['error'].append(platebc)
-            continue
 
-         # Log new element uri
-         pcrrun_uri = r.headers['Location']
-         logging.info('[pcrplate={}/pcrrun] post(pcrrun) = {} (uri:{})'.format(platebc, status, pcrrun_uri))
+###
+### MAIN SCRIPT
+###
 
+if __name__ == '__main__':
+   
+   # Parse arguments
+   options = getOptions(sys.argv[1:])
+   env     = getEnvironment()
+   path    = options.path
 
-         ##
-         ## STORE PARSED RESULTS FILE
-         ##
+   # Find the new or changed exports: all processed samples in path, or only
+   # those handed off by sync_folder, minus the exports already synced
+   spool      = Spool(options.spool) if options.spool else None
+   sync_state = SyncState(options.state) if options.state else None
+   if spool is not None:
+      spool_entries = spool.entries()
+      found = spooled_results(spool, spool_entries)
+   else:
+      found = glob.glob('{}/*_results.txt'.format(path))
+   if options.shard:
+      found = [fname for fname in found if shard_of(plate_barcode(fname), options.shard[1]) == options.shard[0]]
+   flist = [fname for fname in found if sync_state is None or sync_state.changed(fname)]
+
+   # Nothing to do: exit before the heavy imports, without log file or LIMS traffic
+   if len(flist) == 0:
+      if spool is not None:
+         for name in spool_entries:
+            spool.ack(name)
+      sys.exit(0)
+
+   load_dependencies()
 
-         # Store parsing output
-         rn['bcd'] = platebc
-         
-         results.to_csv(results_outfile, sep='\t', index=False)
-         logging.info('[pcrplate={}] parsed results exported to: {}'.format(platebc, results_outfile))
+   # Set up logger
+   job_name, job_start = new_job()
+   logpath = setup_logger(options.logpath, job_name, options.log_json, options.log_summary).replace('//','/')
+
+   # Sync engine with the job settings and the optional state folders
+   engine = SyncEngine(
+      env['LIMS_USER'],
+      env['LIMS_PASSWORD'],
+      options.output,
+      log_file           = logpath,
+      session            = LimsSession(options.json_encoder, options.gzip_requests, options.lims_retries, options.lims_timeout),
+      snapshot           = SnapshotStore(options.snapshot) if options.snapshot else None,
+      snapshot_max_age   = options.snapshot_max_age if options.snapshot else None,
+      archive            = ResultsArchive(options.archive) if options.archive else None,
+      checkpoint         = UploadCheckpoint(options.checkpoint) if options.checkpoint else None,
+      parse_cache        = ParseCache(options.parse_cache) if options.parse_cache else None,
+      sync_state         = sync_state,
+      diff_resync        = options.diff_resync,
+      ct_mode            = options.ct_mode,
+      ct_tolerance       = options.ct_tolerance,
+      chunk_wells        = options.chunk_wells,
+      chunk_objects      = options.chunk_objects,
+      chunk_retries      = options.chunk_retries,
+      digest_size_budget = options.digest_budget,
+      profiler           = PhaseProfiler(options.logpath, job_name, options.profile, options.trace_memory),
+      leases             = PlateLeases(options.lease_dir, ttl=options.lease_ttl) if options.lease_dir else None
+   )
+   engine.start_job(job_name, job_start)
+   mailer = Mailer(env['LIMS_EMAIL_ADDRESS'], env['LIMS_EMAIL_PASSWORD'], env['LIMS_EMAIL_RECEIVERS'])
+   if options.mail_spool:
+      mailer = SpooledMailer(mailer, Spool(options.mail_spool))
+
+   # Log job info
+   logging.info(' version:  {}'.format(__version__))
+   logging.info(' job name: {}'.format(job_name))
+   logging.info(' command:  {}'.format(' '.join(sys.argv)))
+   logging.info(' workdir:  {}'.format(os.getcwd()))
+   logging.info(' logfile:  {}'.format(logpath))
+   logging.info(' report:   {}'.format(env['LIMS_EMAIL_RECEIVERS']))
+
+   tb = None
+   try:
+      # Test LIMS connection, get pcr plates, detectors and machines
+      engine.load_references()
+
+      if spool is not None:
+         logging.info(' spool: {} entries, {} plates'.format(len(spool_entries), len(found)))
+      if options.shard:
+         logging.info(' shard: {}/{}'.format(*options.shard))
+      logging.info(' exports: {} found, {} new or changed'.format(len(found), len(flist)))
+
+      deferred = []
+      for i, fname in enumerate(flist):
+         try:
+            engine.sync_plate(fname)
+         except LimsUnavailable as e:
+            # The remaining plates are left for the next run
+            deferred = [plate_barcode(f) for f in flist[i+1:]]
+            logging.error(' LIMS unavailable ({}), {} plates deferred to the next run'.format(e, len(deferred)))
+            break
 
-         rn.to_csv(rn_outfile, sep='\t', index=False)
-         logging.info('[pcrplate={}] export Rn/Delta Rn values to: {}'.format(platebc, rn_outfile))
+      logging.info(' LIMS requests: {}'.format(engine.session.stats.summary()))
+      if engine.parse_cache is not None:
+         logging.info(' parse cache: {} hits, {} misses'.format(engine.parse_cache.hits, engine.parse_cache.misses))
 
-         logging.info('[pcrplate={}] SUCCESS pcrplate processing'.format(platebc))
+      # Plates to retry in the next runs
+      digest = engine.digest
+      retry  = set(digest['error'] + digest['noinfo'] + digest['nowells'] + digest['nofile'] + digest['leased'] + deferred)
+      if sync_state is not None:
+         for fname in flist:
+            if plate_barcode(fname) in retry:
+               sync_state.record(fname, options.state_retry)
 
-         # Add to synced list
-         digest['success'].append((platebc, resync))
+      # Consume the spool, keeping the plates that must be retried
+      if spool is not None:
+         requeue_spooled(spool, spool_entries, flist, retry, job_name)
 
    except AssertionError:
       # Flush log file
@@ -997,15 +1590,11 @@ if __name__ == '__main__':
       print('Execution exception (sending traceback in e-mail digest):\n{}'.format(tb))
       
    finally:
+      if sync_state is not None:
+         sync_state.save()
       # Flush log file
       logging.shutdown()
       # Send digest e-mail if there is something interesting to report
-      if tb \
-         or len(digest['error']) > 0 \
-         or len(digest['warning']) > 0\
-         or len(digest['success']) > 0\
-         or len(digest['noinfo']) > 0\
-         or len(digest['nofile']) > 0\
-         or len(digest['nowells']) > 0:
-
-         send_digest(digest, logpath, tb)
+      if digest_pending(engine.digest, tb):
+         engine.send_digest(mailer, tb)
+      engine.profiler.dump()
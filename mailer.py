@@ -0,0 +1,252 @@
+import sys, os, time, random, logging, argparse, threading, collections
+import smtplib, ssl
+from email import message_from_string
+from email.mime.multipart import MIMEMultipart
+from email.mime.message import MIMEMessage
+from email.mime.text import MIMEText
+from spool import Spool
+
+try:
+   import fcntl
+except ImportError:
+   fcntl = None
+
+# E-mail delivery of the LIMS digests. The SMTP settings and credentials are
+# given explicitly (the scripts read them from the environment).
+#
+# With a mail spool the scripts do not talk to the SMTP server: the digest
+# is queued in a spool folder (SpooledMailer) and a SpoolSender delivers the
+# queued digests over a single SMTP connection, either in a background
+# thread or by running this module:
+#
+#   python mailer.py SPOOL [--loop SECONDS]
+#
+# Failed deliveries are retried with exponential backoff. When more than
+# `coalesce` digests for the same receivers are waiting, they are sent as a
+# single e-mail with the digests attached.
+
+smtp_server  = 'smtp.gmail.com'
+email_port   = 465
+smtp_timeout = 60 # seconds
+
+retry_base     = 60   # seconds before the first retry
+retry_cap      = 3600 # maximum seconds between retries
+coalesce_after = 3    # pending digests (same receivers) sent as one e-mail
+
+
+class Mailer(object):
+
+   def __init__(self, sender, password, receivers, server=smtp_server, port=email_port, timeout=smtp_timeout):
+      # receivers: list of addresses or comma-separated string
+      self.sender    = sender
+      self.password  = password
+      self.receivers = receivers.split(',') if isinstance(receivers, str) else list(receivers)
+      self.server    = server
+      self.port      = port
+      self.timeout   = timeout
+
+   def message(self, subject, parts):
+      message = MIMEMultipart()
+      message['From']    = 'PRBB LIMS <{}>'.format(self.sender)
+      message['Subject'] = subject
+      message['Bcc']     = ','.join(self.receivers)
+      for part in parts:
+         message.attach(part)
+      return message
+
+   def connect(self):
+      # Logged in SMTP connection (context manager, quits on exit)
+      context = ssl.create_default_context()
+      server  = smtplib.SMTP_SSL(self.server, self.port, context=context, timeout=self.timeout)
+      server.login(self.sender, self.password)
+      return server
+
+   def send(self, subject, parts):
+      message = self.message(subject, parts)
+      with self.connect() as server:
+         server.sendmail(self.sender, self.receivers, message.as_string())
+
+
+###
+### MAIL SPOOL
+###
+
+class SpooledMailer(object):
+   # Same interface as Mailer, send() only queues the message
+
+   def __init__(self, mailer, spool):
+      self.mailer = mailer
+      self.spool  = spool
+
+   def send(self, subject, parts):
+      message = self.mailer.message(subject, parts)
+      name = self.spool.put({
+         'subject':   subject,
+         'receivers': self.mailer.receivers,
+         'message':   message.as_string(),
+         'queued':    time.time(),
+         'attempts':  0,
+         'next_try':  0
+      })
+      logging.info(' mail: digest queued in {}'.format(os.path.join(self.spool.root, name)))
+      return name
+
+
+def retry_delay(attempts):
+   # Exponential backoff with jitter, capped
+   delay = min(retry_cap, retry_base * 2**(attempts-1))
+   return random.uniform(0.5, 1.0) * delay
+
+
+class SpoolSender(object):
+
+   def __init__(self, spool, mailer, coalesce=coalesce_after):
+      self.spool    = spool
+      self.mailer   = mailer
+      self.coalesce = coalesce
+      self.sent     = 0
+      self.stopped  = threading.Event()
+      self.thread   = None
+
+   def due(self, now=None):
+      # [(name, entry)] ready to be sent, in queue order
+      now = time.time() if now is None else now
+      entries = []
+      for name in self.spool.entries():
+         try:
+            entry = self.spool.read(name)
+         except (IOError, OSError, ValueError):
+            continue
+         if entry.get('next_try', 0) <= now:
+            entries.append((name, entry))
+      return entries
+
+   def coalesced(self, batch):
+      # One e-mail with the queued digests attached
+      subjects = [entry['subject'] for _, entry in batch]
+      index = '<html><body><h1>LIMS digests ({})</h1><p>E-mail delivery was delayed, the following digests are attached:</p><ul>{}</ul></body></html>'.format(
+         len(batch), ''.join('<li>{}</li>'.format(s) for s in subjects))
+      parts = [MIMEText(index, 'html')] + [MIMEMessage(message_from_string(entry['message'])) for _, entry in batch]
+      mailer = Mailer(self.mailer.sender, None, batch[0][1]['receivers'])
+      return mailer.message('LIMS digests: {} delayed reports'.format(len(batch)), parts).as_string()
+
+   def defer(self, batch, error):
+      for name, entry in batch:
+         entry['attempts'] = entry.get('attempts', 0) + 1
+         entry['next_try'] = time.time() + retry_delay(entry['attempts'])
+         entry['error']    = str(error)
+         self.spool.update(name, entry)
+      logging.warning(' mail: delivery of {} digests failed ({}), retrying later'.format(len(batch), error))
+
+   def lock(self):
+      # Only one sender drains a spool at a time
+      if fcntl is None:
+         return True
+      self.lock_file = open(os.path.join(self.spool.root, '.sender.lock'), 'w')
+      try:
+         fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except (IOError, OSError):
+         self.lock_file.close()
+         return False
+      return True
+
+   def unlock(self):
+      if fcntl is not None:
+         self.lock_file.close()
+
+   def send_pending(self):
+      # Sends the due digests over one SMTP connection, returns the number sent
+      if not self.lock():
+         return 0
+      try:
+         due = self.due()
+         if not due:
+            return 0
+
+         # Group by receivers, coalesce when delivery fell behind
+         groups = collections.OrderedDict()
+         for name, entry in due:
+            groups.setdefault(tuple(entry['receivers']), []).append((name, entry))
+         batches = []
+         for receivers, entries in groups.items():
+            if len(entries) > self.coalesce:
+               batches.append((receivers, entries))
+            else:
+               batches.extend((receivers, [e]) for e in entries)
+
+         try:
+            server = self.mailer.connect()
+         except (smtplib.SMTPException, OSError) as e:
+            self.defer(due, e)
+            return 0
+
+         sent = 0
+         try:
+            for receivers, batch in batches:
+               message = batch[0][1]['message'] if len(batch) == 1 else self.coalesced(batch)
+               try:
+                  server.sendmail(self.mailer.sender, list(receivers), message)
+               except (smtplib.SMTPException, OSError) as e:
+                  self.defer(batch, e)
+                  continue
+               for name, _ in batch:
+                  self.spool.ack(name)
+               sent += len(batch)
+         finally:
+            try:
+               server.quit()
+            except (smtplib.SMTPException, OSError):
+               pass
+
+         self.sent += sent
+         if sent:
+            logging.info(' mail: {} digests sent'.format(sent))
+         return sent
+      finally:
+         self.unlock()
+
+   def run(self, interval):
+      while True:
+         self.send_pending()
+         if self.stopped.wait(interval):
+            break
+
+   def start(self, interval=60):
+      # Background sender thread
+      self.thread = threading.Thread(target=self.run, args=(interval,), name='mail-sender', daemon=True)
+      self.thread.start()
+
+   def stop(self, flush=True):
+      self.stopped.set()
+      if self.thread is not None:
+         self.thread.join()
+      if flush:
+         self.send_pending()
+
+
+###
+### SPOOL SENDER SCRIPT
+###
+
+if __name__ == '__main__':
+   parser = argparse.ArgumentParser('mailer')
+   parser.add_argument('spool', help='Mail spool folder (--mail-spool of lims_sync/status_report)')
+   parser.add_argument('--loop', type=float, metavar='SECONDS', help='Keep running and check the spool every SECONDS (default: send the pending digests and exit)')
+   parser.add_argument('--coalesce', type=int, default=coalesce_after, help='Send more than this many pending digests for the same receivers as one e-mail (default: %(default)s)')
+   options = parser.parse_args()
+
+   EMAIL_SENDER   = os.environ.get('LIMS_EMAIL_ADDRESS')
+   EMAIL_PASSWORD = os.environ.get('LIMS_EMAIL_PASSWORD')
+   if EMAIL_SENDER is None or EMAIL_PASSWORD is None:
+      print("ERROR: define environment variables LIMS_EMAIL_ADDRESS, LIMS_EMAIL_PASSWORD before running this script.")
+      sys.exit(1)
+
+   logging.basicConfig(level=logging.INFO, format='[%(asctime)s][%(levelname)s]%(message)s')
+   sender = SpoolSender(Spool(options.spool), Mailer(EMAIL_SENDER, EMAIL_PASSWORD, []), options.coalesce)
+   if options.loop:
+      try:
+         sender.run(options.loop)
+      except KeyboardInterrupt:
+         pass
+   else:
+      sender.send_pending()
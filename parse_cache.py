@@ -0,0 +1,74 @@
+import os, hashlib, importlib, pickle, uuid
+
+# Content-addressed cache of parsed instrument exports. Entries are keyed by
+# the hash of the parser name/version, of the pandas/numpy versions (pickled
+# frames may not load under other versions) and of the contents of the
+# parsed files, so editing a file or bumping a version misses the cache.
+# Entries that cannot be loaded are removed and count as misses.
+#
+#   {root}/{key[:2]}/{key}.pickle
+
+hash_buffer_size = 1024*1024
+
+def library_versions(names=('pandas', 'numpy')):
+   versions = []
+   for name in names:
+      try:
+         versions.append('{}={}'.format(name, importlib.import_module(name).__version__))
+      except ImportError:
+         versions.append('{}=none'.format(name))
+   return ';'.join(versions)
+
+
+class ParseCache(object):
+
+   def __init__(self, root):
+      self.root   = root
+      self.hits   = 0
+      self.misses = 0
+      self.versions = library_versions()
+      os.makedirs(root, exist_ok=True)
+
+   def key(self, parser, sources):
+      # parser: parser name and version, sources: list of file names
+      h   = hashlib.sha256(parser.encode('utf-8'))
+      h.update(b'\0' + self.versions.encode('utf-8'))
+      buf = bytearray(hash_buffer_size)
+      view = memoryview(buf)
+      for fname in sources:
+         h.update(b'\0')
+         with open(fname, 'rb') as f:
+            for n in iter(lambda: f.readinto(buf), 0):
+               h.update(view[:n])
+      return h.hexdigest()
+
+   def _fname(self, key):
+      return os.path.join(self.root, key[:2], '{}.pickle'.format(key))
+
+   def get(self, key):
+      fname = self._fname(key)
+      try:
+         with open(fname, 'rb') as f:
+            value = pickle.load(f)
+      except FileNotFoundError:
+         self.misses += 1
+         return None
+      except Exception:
+         # Truncated, or pickled by other library versions (AttributeError,
+         # ImportError, TypeError...)
+         self.misses += 1
+         try:
+            os.remove(fname)
+         except OSError:
+            pass
+         return None
+      self.hits += 1
+      return value
+
+   def put(self, key, value):
+      fname = self._fname(key)
+      os.makedirs(os.path.dirname(fname), exist_ok=True)
+      tmp = '{}.{}.tmp'.format(fname, uuid.uuid4().hex[:8])
+      with open(tmp, 'wb') as f:
+         pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+      os.replace(tmp, fname)
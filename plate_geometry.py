@@ -0,0 +1,48 @@
+import numpy as np
+
+# Plate layouts as precomputed lookup tables. Wells are numbered 1..size in
+# row-major order (A1, A2, ..., the numbering of the instrument exports);
+# index 0 of every table is unused so well numbers index them directly.
+#
+# A 384-well plate holds the samples of a 96-well plate in 2x2 blocks
+# (local singleplex): the block of a 96-well parent well has the quadrants
+# 0=top left, 1=top right, 2=bottom left and 3=bottom right.
+
+class PlateGeometry(object):
+
+   def __init__(self, rows, cols, parent=None):
+      self.rows   = rows
+      self.cols   = cols
+      self.size   = rows*cols
+      self.parent = parent
+
+      n = np.arange(self.size + 1)
+      self.row = np.where(n > 0, (n-1)//cols, -1)
+      self.col = np.where(n > 0, (n-1)%cols, -1)
+      self.position = np.array([''] + ['{}{}'.format(chr(65+r), c+1) for r, c in zip(self.row[1:], self.col[1:])], dtype=object)
+      self.row_names = [chr(65+r) for r in range(rows)]
+
+      # Position to well number, also zero-padded (A01) and lowercase
+      self.number = {}
+      for i in range(1, self.size+1):
+         r, c = chr(65+self.row[i]), self.col[i]+1
+         for pos in ('{}{}'.format(r, c), '{}{:02d}'.format(r, c)):
+            self.number[pos] = self.number[pos.lower()] = i
+
+      if parent is not None:
+         # 96-well parent of each well and 2x2 block tables
+         self.parent_row = np.where(n > 0, self.row//2, -1)
+         self.parent_col = np.where(n > 0, self.col//2, -1)
+         self.parent_well = np.where(n > 0, self.parent_row*parent.cols + self.parent_col + 1, 0)
+         self.quadrant = np.where(n > 0, (self.row%2)*2 + self.col%2, -1)
+         self.base = np.where(n > 0, n - (self.row%2)*cols - self.col%2, 0)
+         # block[well] = well numbers of the 4 quadrants of its block
+         self.block = self.base[:,None] + np.array([0, 1, cols, cols+1])[None,:]
+         self.block[0] = 0
+
+   def well_number(self, position):
+      return self.number[position.strip()]
+
+
+plate_96  = PlateGeometry(8, 12)
+plate_384 = PlateGeometry(16, 24, parent=plate_96)
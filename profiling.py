@@ -0,0 +1,107 @@
+import os, io, time, contextlib
+import cProfile, tracemalloc
+from lims_logging import log_phase
+
+# Per-phase profiling of the LIMS scripts (--profile, --trace-memory). Each
+# phase (fetch, merge, parse, upload, render) has its own cProfile profile,
+# accumulated over all the times the phase runs, and a list of tracemalloc
+# reports with the top allocations of each run of the phase. dump() writes
+# them next to the run log:
+#
+#   {root}/{job_name}_{phase}.prof        (pstats / snakeviz)
+#   {root}/{job_name}_{phase}_memory.txt
+#
+# Phases can be nested, the outer profile is paused while an inner phase runs.
+# The log records of a phase are tagged with its name (even when disabled).
+
+memory_top    = 25 # allocation sites per report
+memory_frames = 1  # traceback depth of the allocation sites
+
+# The snapshots themselves are not reported
+snapshot_filters = [tracemalloc.Filter(False, tracemalloc.__file__)]
+
+
+class PhaseProfiler(object):
+
+   def __init__(self, root=None, job_name=None, profile=False, trace_memory=False):
+      self.root         = root
+      self.job_name     = job_name
+      self.profile      = profile
+      self.trace_memory = trace_memory
+      self.profiles     = {}
+      self.memory       = {}
+      self.times        = {}
+      self.stack        = []
+      if trace_memory and not tracemalloc.is_tracing():
+         tracemalloc.start(memory_frames)
+
+   @property
+   def enabled(self):
+      return self.profile or self.trace_memory
+
+   @contextlib.contextmanager
+   def phase(self, name, label=None):
+      # label: run of the phase in the memory reports (e.g. the plate)
+      if not self.enabled:
+         with log_phase(name):
+            yield
+         return
+
+      # The outer phase is paused, the snapshots are not profiled
+      if self.profile and self.stack:
+         self.profiles[self.stack[-1]].disable()
+      if self.trace_memory:
+         if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+         start_snapshot = tracemalloc.take_snapshot().filter_traces(snapshot_filters)
+      if self.profile:
+         prof = self.profiles.setdefault(name, cProfile.Profile())
+         prof.enable()
+      self.stack.append(name)
+
+      start = time.time()
+      try:
+         with log_phase(name):
+            yield
+      finally:
+         elapsed = time.time() - start
+         self.times[name] = self.times.get(name, 0.0) + elapsed
+         self.stack.pop()
+         if self.profile:
+            prof.disable()
+         if self.trace_memory:
+            self.memory.setdefault(name, []).append(self.memory_report(name, label, elapsed, start_snapshot))
+         if self.profile and self.stack:
+            self.profiles[self.stack[-1]].enable()
+
+   def memory_report(self, name, label, elapsed, start_snapshot):
+      current, peak = tracemalloc.get_traced_memory()
+      stats = tracemalloc.take_snapshot().filter_traces(snapshot_filters).compare_to(start_snapshot, 'lineno')
+      out = io.StringIO()
+      out.write('## {}{} ({:.3f}s, current {:.1f} KB, peak {:.1f} KB)\n'.format(name, ' ' + str(label) if label is not None else '', elapsed, current/1024.0, peak/1024.0))
+      for stat in stats[:memory_top]:
+         out.write('{}\n'.format(stat))
+      return out.getvalue()
+
+   def files(self, phase):
+      prefix = os.path.join(self.root, '{}_{}'.format(self.job_name, phase))
+      return '{}.prof'.format(prefix), '{}_memory.txt'.format(prefix)
+
+   def summary(self):
+      return ', '.join('{} {:.3f}s'.format(phase, t) for phase, t in sorted(self.times.items()))
+
+   def dump(self):
+      # Returns the list of written files
+      written = []
+      if not self.enabled or self.root is None:
+         return written
+      for phase, prof in self.profiles.items():
+         fname = self.files(phase)[0]
+         prof.dump_stats(fname)
+         written.append(fname)
+      for phase, reports in self.memory.items():
+         fname = self.files(phase)[1]
+         with open(fname, 'w') as f:
+            f.write('\n'.join(reports))
+         written.append(fname)
+      return written
@@ -0,0 +1,45 @@
+import os, json, time, uuid
+
+# Durable folder queue shared by the LIMS scripts. Each entry is a JSON file
+# written under a temporary name and renamed, so readers only see complete
+# entries. Consumers remove (ack) an entry once it has been processed.
+
+class Spool(object):
+
+   def __init__(self, root):
+      self.root = root
+      os.makedirs(root, exist_ok=True)
+
+   def put(self, data):
+      # Names sort in creation order
+      name = '{:020d}-{}-{}.json'.format(int(time.time()*1e6), os.getpid(), uuid.uuid4().hex[:8])
+      tmp  = os.path.join(self.root, '.{}.tmp'.format(name))
+      with open(tmp, 'w') as f:
+         json.dump(data, f)
+         f.flush()
+         os.fsync(f.fileno())
+      os.replace(tmp, os.path.join(self.root, name))
+      return name
+
+   def entries(self):
+      return sorted(e for e in os.listdir(self.root) if e.endswith('.json') and not e.startswith('.'))
+
+   def read(self, name):
+      with open(os.path.join(self.root, name)) as f:
+         return json.load(f)
+
+   def update(self, name, data):
+      # Rewrites an entry in place (keeps its position in the queue)
+      tmp = os.path.join(self.root, '.{}.{}.tmp'.format(name, uuid.uuid4().hex[:8]))
+      with open(tmp, 'w') as f:
+         json.dump(data, f)
+      os.replace(tmp, os.path.join(self.root, name))
+
+   def ack(self, name):
+      try:
+         os.remove(os.path.join(self.root, name))
+      except FileNotFoundError:
+         pass
+
+   def __len__(self):
+      return len(self.entries())
@@ -1,31 +1,19 @@
 import sys, os, glob
-import requests
 import logging
 import datetime
 import argparse
-import traceback
-import smtplib, ssl
 import pandas as pd
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-
-# Get environment variables
-LIMS_USER       = os.environ.get('LIMS_USER')
-LIMS_PASSWORD   = os.environ.get('LIMS_PASSWORD')
-EMAIL_SENDER    = os.environ.get('LIMS_EMAIL_ADDRESS')
-EMAIL_PASSWORD  = os.environ.get('LIMS_EMAIL_PASSWORD')
-EMAIL_RECEIVERS = os.environ.get('LIMS_EMAIL_RECEIVERS')
-
-if LIMS_USER       is None or\
-   LIMS_PASSWORD   is None or\
-   EMAIL_SENDER    is None or\
-   EMAIL_RECEIVERS is None or\
-   EMAIL_PASSWORD  is None:
-   print("ERROR: define environment variables LIMS_USER, LIMS_PASSWORD, LIMS_EMAIL_ADDRESS, LIMS_EMAIL_PASSWORD, LIMS_EMAIL_RECEIVERS before running this script.")
-   sys.exit(1)
-
-job_name  = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
-job_start = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
+from columnar import SnapshotStore, ColumnBuilder
+from html_report import HtmlReport
+from lims_client import LimsSession
+from mailer import Mailer, SpooledMailer
+from spool import Spool
+from profiling import PhaseProfiler
+from lims_logging import log_handler
+from dashboard import Dashboard, default_interval
+
+# Environment variables with the LIMS and e-mail credentials
+env_variables = ['LIMS_USER', 'LIMS_PASSWORD', 'LIMS_EMAIL_ADDRESS', 'LIMS_EMAIL_PASSWORD', 'LIMS_EMAIL_RECEIVERS']
 
 # API DEFINITIONS
 base_url           = 'https://orfeu.cnag.crg.eu'
@@ -60,212 +48,42 @@ organization_url  = '{}{}'.format(base_url, organization_base)
 ### HTML REPORT
 ###
 
-def html_digest(report, stats, tb):
+html_style = '\nth, td { text-align: center; padding: 10px; }\ntable, th, td { border: 1px solid black; border-collapse: collapse;}\n'
 
-   # Color definition
-   header_color = ' style="background-color:gainsboro;"'
-   count_color  = ' style="background-color:ivory;"'
-   true_color   = ' style="background-color:rgb(212,239,223);"'
-   false_color  = ' style="background-color:lightcoral;"'
-   
-   html = '<html><head><style>\nth, td { text-align: center; padding: 10px; }\ntable, th, td { border: 1px solid black; border-collapse: collapse;}\n</style></head><body>'
+# Color definition
+header_color = ' style="background-color:gainsboro;"'
+count_color  = ' style="background-color:ivory;"'
+true_color   = ' style="background-color:rgb(212,239,223);"'
+false_color  = ' style="background-color:lightcoral;"'
 
-   # Header
-   html += '<h1>Project status report ({})</h1>\n'.format(datetime.datetime.now().strftime('%d/%m/%Y %H:%M'))
+# Precomputed status cells
+no_cells     = '<td{c}>❌</td><td{c}>❌</td><td{c}>❌</td><td{c}>❌</td>'.format(c=false_color)
+verified_txt = {'OK': '✅', 'F': '<b>Failed</b>', 'H': '<b>On Hold</b>'}
 
-   # Sample stats
-   html += '<br><h2>Sample stats</h2>\n'
-   html += '<table style="white-space:nowrap;"><tr>\
-   <th{c} rowspan="2">Project</th>\
-   <th{c} rowspan="2">In RNA plate</th>\
-   <th{c} rowspan="2">In PCR plate</th>\
-   <th{c} rowspan="2">Awaiting PCR verif.</th>\
-   <th{c} colspan="3">PCR Verified</th>\
-   <th{c} rowspan="2">Sent - Awaiting review</th>\
-   <th{c} rowspan="2">Reviewed</th>\
-   <th{c} rowspan="2">Sent to CTTI/ICS</th>\
-   </tr><tr>\
-   <th{c}>Failed</th>\
-   <th{c}>On Hold</th>\
-   <th{c}>Success</th>\
-   </tr>'.format(c=header_color)
+digest_size_budget = 1000000 # bytes, larger digests move long blocks to attachments
 
-   list_failed = False
-   list_onhold = False
-   
-   for proj in stats['project'].unique():
-      if (sample_stats['project'] == proj).sum() == 0:
-         continue
-      html += '<tr>'
-      html += '<td><b>{}</b></td>'.format(proj)
-      html += '<td>{}</td>'.format(((sample_stats['project'] == proj) & (sample_stats['status'] == 'RNA')).sum())
-      html += '<td>{}</td>'.format(((sample_stats['project'] == proj) & (sample_stats['status'] == 'PCR')).sum())
-      html += '<td>{}</td>'.format(((sample_stats['project'] == proj) & (sample_stats['status'] == 'RUNNING')).sum())
-      failed_cnt = ((sample_stats['project'] == proj) & (sample_stats['status'] == 'FAILED')).sum()
-      list_failed = True if failed_cnt else list_failed
-      html += '<td>{}</td>'.format(failed_cnt if failed_cnt == 0 else '<a href="#failed{}">{}</a>'.format(proj,failed_cnt))
-      hold_cnt = ((sample_stats['project'] == proj) & (sample_stats['status'] == 'HOLD')).sum()
-      list_onhold = True if hold_cnt else list_onhold
-      html += '<td>{}</td>'.format(hold_cnt if hold_cnt == 0 else '<a href="#hold{}">{}</a>'.format(proj, hold_cnt))
-      html += '<td>{}</td>'.format(((sample_stats['project'] == proj) & (sample_stats['status'] == 'VERIFIED')).sum())
-      html += '<td>{}</td>'.format(((sample_stats['project'] == proj) & (sample_stats['status'] == 'SENT')).sum())
-      html += '<td>{}</td>'.format(((sample_stats['project'] == proj) & (sample_stats['status'] == 'REVIEWED')).sum())
-      html += '<td{}><b>{}</b></td>'.format(count_color, ((sample_stats['project'] == proj) & (sample_stats['status'] == 'DONE')).sum())
-      html += '</tr>'
-      
-   html += '</table>'
-   
-   # PCR in progress
-   html += '<br><h2>PCR runs in progress</h2>\n'
-   html += '<table style="white-space:nowrap;"><tr>\
-   <th{c}>RNA plate</th>\
-   <td{c}>Date created</td>\
-   <th{c}>PCR in LIMS</th>\
-   <td{c}>SDS export</td>\
-   <td{c}>LIMS upload</td>\
-   <td{c}>PCR verified</td>\
-   </tr>'.format(c=header_color)
-
-   # Sort report by RNA date
-   report = sorted(report, key = lambda x: x['created'])
-
-   for rna in report:
-      if len(rna['pcr']) == 0:
-         html += '<tr>'
-         html += '<td><b>{}</b></td><td>{}</td>'.format(rna['barcode'], rna['created'].replace('T', ' '))
-         html += '<td{c}>❌</td><td{c}>❌</td><td{c}>❌</td><td{c}>❌</td>'.format(c=false_color)
-         html += '</tr>'
-      else:
-         for pcr in rna['pcr']:
-            if pcr['verified'] in ['OK', 'F']:
-               continue
-            html += '<tr>'
-            html += '<td><b>{}</b></td><td>{}</td>'.format(rna['barcode'], rna['created'].replace('T', ' '))
-            html += '<td{}><b>{}</b></td><td{}>{}</td><td{}>{}</td><td{}>{}</td>'.format(
-               true_color,
-               pcr['barcode'],
-               true_color if pcr['sdsfile'] else false_color,
-               '✅' if pcr['sdsfile'] else '❌',
-               true_color if pcr['uploaded'] else false_color,
-               '✅' if pcr['uploaded'] else '❌',
-               true_color if pcr['verified'] == 'OK' else false_color,
-               '✅' if pcr['verified'] == 'OK' else '<b>Failed</b>' if pcr['verified'] == 'F' else '<b>On Hold</b>' if pcr['verified'] == 'H' else '❌'
-            )
-            html += '</tr>'
-
-   html += '</table>'
-
-
-   # Diagnosis verification status
-   html += '<br><h2>Diagnosis verification status</h2>\n'
-   html += '<table style="white-space:nowrap;"><tr>\
-   <th{c}>PCR barcode</th>\
-   <th{c}>Project</th>\
-   <td{c}>Organization</td>\
-   <td{c}>Project samples</td>\
-   <td{c}>PCR verified</td>\
-   <td{c}>Sent for review</td>\
-   <td{c}>Reviewed</td>\
-   <td{c}>Results sent</td>\
-   </tr>'.format(c=header_color)
-
-   # Remove completed diagnosis
-   for rna in report:
-      for pcr in rna['pcr']:
-         for proj in pcr['projects']:
-            if proj['done'] or ((pcr['verified'] in ['OK', 'F']) and proj['sent'] == 'F'):
-               continue
-
-            html += '<tr>'
-            html += '<td><b>{}</b></td><td>{}</td><td>{}</td><td>{}</td><td{}>{}</td><td{}>{}</td><td{}>{}</td><td{}>{}</td>'.format(
-               pcr['barcode'],
-               proj['name'],
-               proj['org'],
-               proj['samples'],
-               true_color if pcr['verified'] == 'OK' else false_color,
-               '✅' if pcr['verified'] == 'OK' else '<b>Failed</b>' if pcr['verified'] == 'F' else '<b>On Hold</b>' if pcr['verified'] == 'H' else '❌',
-               true_color if proj['sent'] == 'Y' else '' if proj['sent'] == 'F' else false_color,
-               '✅' if proj['sent'] == 'Y' else '&nbsp;' if proj['sent'] == 'F' else '❌',
-               true_color if proj['reviewed'] else '' if proj['sent'] == 'F' else false_color,
-               '✅' if proj['reviewed'] else '' if proj['sent'] == 'F' else '❌',
-               true_color if proj['done'] else '' if proj['sent'] == 'F' else false_color,
-               '✅' if proj['done'] else '' if proj['sent'] == 'F' else '❌'
-            )
-
-            html += '</tr>'
-   html += '</table>'
-
-   # List of samples
-   if list_failed or list_onhold:
-      html += '<br><h2>List of potentially delayed samples</h2>\n'
-      if list_failed:
-         html += '<h3>Samples on <b>failed</b> PCRs</h3>\n'
-         
-         for proj in stats['project'].unique():
-            failed_samples = sample_stats[((sample_stats['project'] == proj) & (sample_stats['status'] == 'FAILED'))]
-            if failed_samples.shape[0]:
-               failed_samples = failed_samples.sort_values('pcrplate')
-               html += '<h4><a name="failed{}"></a>Samples on Failed PCR (Project: {}, samples: {})</h4>\n'.format(proj,proj,failed_samples.shape[0])
-               html += '<p style="font-family:\'Courier New\'">'
-               for s in failed_samples.iterrows():
-                  html += '{}\t{}<br>'.format(s[1]['pcrplate'], s[1]['sample'])
-               html += '</p>'
-
-      if list_onhold:
-         html += '<br><h3>Samples <b>on hold</b> in PCRs</h3>\n'
-         
-         for proj in stats['project'].unique():
-            hold_samples = sample_stats[((sample_stats['project'] == proj) & (sample_stats['status'] == 'HOLD'))]
-            if hold_samples.shape[0]:
-               hold_samples = hold_samples.sort_values('pcrplate')
-               html += '<h4><a name="hold{}"></a>Samples in PCR on hold (Project: {}, samples: {})</h4>\n'.format(proj,proj,hold_samples.shape[0])
-               html += '<p style="font-family:\'Courier New\'">'
-               for s in hold_samples.iterrows():
-                  html += '{}\t{}<br>'.format(s[1]['pcrplate'], s[1]['sample'])
-               html += '</p>'
 
-   html += "</body></html>"
+###
+### LIMS REQUEST METHODS
+###
 
-   return MIMEText(html, 'html')
+def lims_headers(user, password):
+   return {'content-type': 'application/json', 'Authorization': 'ApiKey {}:{}'.format(user, password)}
 
-###
-### EMAIL NOTIFICATIONS
-### 
-
-smtp_server     = "smtp.gmail.com"
-email_port      = 465
-email_receivers = EMAIL_RECEIVERS.split(',')
-
-def send_digest(digest, stats, tb=None):
-   message = MIMEMultipart()
-   message['From']    = 'PRBB LIMS <{}>'.format(EMAIL_SENDER)
-   message['Subject'] = "Project status report ({})".format(datetime.datetime.now().strftime('%d/%m/%Y'))
-   message['Bcc']     = ','.join(email_receivers)
-   message.attach(html_digest(digest, stats, tb))
-   
-   context = ssl.create_default_context()
-   with smtplib.SMTP_SSL(smtp_server, email_port, context=context) as server:
-      server.login(EMAIL_SENDER, EMAIL_PASSWORD)
-      server.sendmail(EMAIL_SENDER, email_receivers, message.as_string())
 
 ###
-### LIMS REQUEST METHODS
+### FIELD PROJECTION
 ###
 
-req_headers = {'content-type': 'application/json', 'Authorization': 'ApiKey {}:{}'.format(LIMS_USER, LIMS_PASSWORD) };
-
-def lims_request(method, url, params=None, json_data=None, headers=req_headers):
-   # methods: GET, OPTIONS, HEAD, POST, PUT, PATCH, DELETE
-   r = requests.request(method, url, params=params, headers=headers, json=json_data, verify=False)
-   assert_error(r.status_code < 300,
-                  'LIMS request returned non-successful response ({}). Request details: METHOD={}, URL={}, PARAMS={}, DATA={}'.format(
-                     r.status_code,
-                     method,
-                     url,
-                     params,
-                     json_data
-                  ))
-   return r, r.status_code
+# Fields kept from each LIMS collection, nested fields as in LIMS filters
+rnawell_fields      = ['resource_uri', 'sample__project', 'sample__barcode']
+pcrwell_fields      = ['rna_extraction_well', 'pcr_plate']
+pcrproject_fields   = ['pcr_plate', 'project', 'results_sent', 'diagnosis_completed', 'diagnosis_sent']
+pcrrun_fields       = ['pcr_plate', 'status']
+pcrplate_fields     = ['barcode', 'id', 'resource_uri']
+project_fields      = ['resource_uri', 'name', 'organization']
+rnaplate_fields     = ['barcode', 'date_prepared']
+organization_fields = ['resource_uri', 'name']
 
 ###
 ### ERROR CONTROL
@@ -294,12 +112,19 @@ def assert_warning(cond, msg):
 ### LOGGING
 ###
 
-def setup_logger(log_path):
+def new_job():
+   # Job name (also the log file name) and start time
+   now = datetime.datetime.now()
+   return now.strftime('%Y%m%d_%H%M%S'), now.strftime('%d/%m/%Y %H:%M:%S')
+
+def setup_logger(log_path, job_name, json_lines=False):
    log_level = logging.INFO
    log_file = '{}/{}.log'.format(log_path, job_name)
-   log_format = '[%(asctime)s][%(levelname)s]%(message)s'
 
-   logging.basicConfig(level=log_level, filename=log_file, format=log_format)
+   # Written from a background thread
+   logger = logging.getLogger()
+   logger.setLevel(log_level)
+   logger.addHandler(log_handler(log_file, json_lines))
 
    return log_file
 
@@ -312,9 +137,26 @@ def getOptions(args=sys.argv[1:]):
    parser = argparse.ArgumentParser('lims_sync')
    parser.add_argument('path', help='Input folder (where the *_results.txt and *_clipped.txt files are)')
    parser.add_argument('-l', '--logpath', help='Root folder to store logs', required=True)
+   parser.add_argument('-s', '--snapshot', help='Folder to store columnar snapshots of the fetched LIMS collections')
+   parser.add_argument('--snapshot-max-age', type=float, help='Reuse snapshots younger than this many seconds instead of querying LIMS')
+   parser.add_argument('--digest-budget', type=int, default=digest_size_budget, help='Maximum size (bytes) of the e-mail digest body, longer sections are sent as compressed attachments')
+   parser.add_argument('--profile', action='store_true', help='Write cProfile stats of each phase (fetch, merge, render) next to the run log')
+   parser.add_argument('--trace-memory', action='store_true', help='Write the top memory allocations (tracemalloc) of each phase run next to the run log')
+   parser.add_argument('--serve', type=int, metavar='PORT', help='Serve the report as a local HTTP dashboard on this port instead of sending the e-mail')
+   parser.add_argument('--bind', default='127.0.0.1', help='Dashboard address (default: %(default)s)')
+   parser.add_argument('--refresh', type=float, default=default_interval, help='Seconds between dashboard refreshes from LIMS (default: %(default)s)')
+   parser.add_argument('--log-json', action='store_true', help='Write the run log as JSON lines (time, level, phase, message)')
+   parser.add_argument('--mail-spool', help='Queue the e-mail report in this folder instead of sending it (delivered by: python mailer.py MAIL_SPOOL)')
    options = parser.parse_args(args)
    return options
 
+def getEnvironment(environ=os.environ):
+   env = {name: environ.get(name) for name in env_variables}
+   if None in env.values():
+      print("ERROR: define environment variables {} before running this script.".format(', '.join(env_variables)))
+      sys.exit(1)
+   return env
+
 ###
 ### SAMPLE STATUS FILTER
 ###
@@ -327,13 +169,13 @@ def sample_status(group):
       status = 'REVIEWED'
    elif (group['results_sent'] == 'Y').any():
       status = 'SENT'
-   elif (group['status_y'] == 'OK').any():
+   elif (group['run_status'] == 'OK').any():
       status = 'VERIFIED'
-   elif (group['status_y'] == 'R').any():
+   elif (group['run_status'] == 'R').any():
       status = 'RUNNING'
-   elif (group['status_y'] == 'H').any():
+   elif (group['run_status'] == 'H').any():
       status = 'HOLD'
-   elif (group['status_y'] == 'F').any():
+   elif (group['run_status'] == 'F').any():
       status = 'FAILED'
    elif group['pcr_plate'].any():
       status = 'PCR'
@@ -342,190 +184,425 @@ def sample_status(group):
 
 
 ###
-### MAIN SCRIPT
+### STATUS REPORT
 ###
 
-if __name__ == '__main__':
-   
-   # Parse arguments
-   options = getOptions(sys.argv[1:])
-   path    = options.path
+class StatusReport(object):
+   # Builds the project status report from LIMS. The LIMS session and the
+   # snapshot store are kept between reports, so a long-running process can
+   # call build() periodically.
+
+   def __init__(self, lims_user, lims_password, session=None, snapshot=None, snapshot_max_age=None, digest_size_budget=digest_size_budget, profiler=None, job_name=None):
+      self.headers            = lims_headers(lims_user, lims_password)
+      self.session            = session or LimsSession()
+      self.snapshot           = snapshot
+      self.snapshot_max_age   = snapshot_max_age
+      self.digest_size_budget = digest_size_budget
+      self.profiler           = profiler or PhaseProfiler()
+      self.job_name           = job_name or new_job()[0]
+
+
+   ##
+   ## LIMS REQUESTS
+   ##
+
+   def request(self, method, url, params=None, json_data=None, headers=None):
+      # methods: GET, OPTIONS, HEAD, POST, PUT, PATCH, DELETE
+      r = self.session.request(method, url, params=params, json_data=json_data, headers=headers or self.headers)
+      assert_error(r.status_code < 300,
+                     'LIMS request returned non-successful response ({}). Request details: METHOD={}, URL={}, PARAMS={}, DATA={}'.format(
+                        r.status_code,
+                        method,
+                        url,
+                        params,
+                        json_data
+                     ))
+      return r, r.status_code
+
+   def get_frame(self, collection, base, fields, err_msg):
+      # Reuse a fresh snapshot if allowed, otherwise fetch all pages and store a new one
+      if self.snapshot is not None and self.snapshot_max_age is not None:
+         frame = self.snapshot.load_frame(collection, fields, max_age=self.snapshot_max_age)
+         if frame is not None:
+            logging.info(' snapshot: {} loaded from {} ({} objects)'.format(collection, self.snapshot.root, frame.shape[0]))
+            return frame
+
+      # Each page is projected into typed columns and the JSON is dropped
+      columns  = ColumnBuilder(fields)
+      next_url = base
+      while next_url:
+         r, status = self.request('GET', base_url+next_url, params={'limit': 1000})
+         assert_critical(status < 300, err_msg)
+         page = r.json()
+         columns.append(page['objects'])
+         next_url = page['meta']['next']
+
+      if self.snapshot is not None:
+         self.snapshot.save_builder(collection, columns)
+         logging.info(' snapshot: {} saved to {} ({} objects)'.format(collection, self.snapshot.root, columns.rows))
+      return columns.frame()
 
-   # Set up logger
-   logpath = setup_logger(options.logpath).replace('//','/')
 
-   
    ##
    ## OVERALL PROJECT STATUS
    ##
 
-   # Sample info
-   # next_url = sample_base 
-   # samples = [] 
-   # while next_url: 
-   #    r, status = lims_request('GET', base_url+next_url, params={'limit': 10000}) 
-   #    if not assert_critical(status < 300, 'Could not retreive samples from LIMS'):
-   #       break
-   #    samples.extend(r.json()['objects']) 
-   #    next_url = r.json()['meta']['next']
-
-   # Rna wells
-   next_url = rnawell_base 
-   rnawells = [] 
-   while next_url: 
-      r, status = lims_request('GET', base_url+next_url, params={'limit': 1000}) 
-      assert_critical(status < 300, 'Could not retreive rna wells from LIMS')
-      rnawells.extend(r.json()['objects']) 
-      next_url = r.json()['meta']['next']
-   
-   # Pcr wells
-   next_url = pcrwell_base
-   pcrwells = [] 
-   while next_url: 
-      r, status = lims_request('GET', base_url+next_url, params={'limit': 1000}) 
-      assert_critical(status < 300, 'Could not retreive pcr wells from LIMS')
-      pcrwells.extend(r.json()['objects']) 
-      next_url = r.json()['meta']['next']
-
-   # Get pcr plate projects
-   next_url = pcrproject_base
-   pcrprojects = []
-   while next_url:
-      r, status = lims_request('GET', base_url+next_url, params={'limit': 1000})
-      assert_critical(status < 300, 'Could not retreive pcr plate projects from LIMS')
-      pcrprojects.extend(r.json()['objects'])
-      next_url = r.json()['meta']['next']
-
-   # Get pcr runs
-   next_url = pcrrun_base
-   pcrruns_data = []
-   while next_url:
-      r, status = lims_request('GET', base_url+next_url, params={'limit': 1000})
-      assert_critical(status < 300, 'Could not retreive pcr runs from LIMS')
-      pcrruns_data.extend(r.json()['objects'])
-      next_url = r.json()['meta']['next']
+   def sample_stats(self):
+      # Sample info
+      # next_url = sample_base 
+      # samples = [] 
+      # while next_url: 
+      #    r, status = lims_request('GET', base_url+next_url, params={'limit': 10000}) 
+      #    if not assert_critical(status < 300, 'Could not retreive samples from LIMS'):
+      #       break
+      #    samples.extend(r.json()['objects']) 
+      #    next_url = r.json()['meta']['next']
+
+      with self.profiler.phase('fetch'):
+         # Rna wells
+         dfrnawells = self.get_frame('rnaextractionwell', rnawell_base, rnawell_fields, 'Could not retreive rna wells from LIMS')
+         dfrnawells = dfrnawells.rename(columns={'sample__project': 'project', 'sample__barcode': 'sample_bcd'})
+
+         # Pcr wells
+         dfpcrwells = self.get_frame('pcrwell', pcrwell_base, pcrwell_fields, 'Could not retreive pcr wells from LIMS')
+
+         # Get pcr plate projects
+         dfpcrprojs       = self.get_frame('pcrplateproject', pcrproject_base, pcrproject_fields, 'Could not retreive pcr plate projects from LIMS')
+         self.pcrprojects = dfpcrprojs.to_dict('records')
+
+         # Get pcr runs
+         dfpcrruns    = self.get_frame('pcrrun', pcrrun_base, pcrrun_fields, 'Could not retreive pcr runs from LIMS')
+         dfpcrruns    = dfpcrruns.rename(columns={'status': 'run_status'})
+         self.pcrruns = dict(zip(dfpcrruns['pcr_plate'], dfpcrruns['run_status']))
+
+         # Get pcr plates
+         dfpcrplates    = self.get_frame('pcrplate', pcrplate_base, pcrplate_fields, 'Could not retreive pcr plates from LIMS')
+         pcrplate_bcd   = dict(zip(dfpcrplates['resource_uri'], dfpcrplates['barcode']))
+         self.pcrplates = dict(zip(dfpcrplates['barcode'], dfpcrplates['resource_uri']))
+
+
+         # Get projects
+         projects = self.get_frame('project', project_base, project_fields, 'Could not retreive projects from LIMS').to_dict('records')
+         self.projects = {o['resource_uri']: o for o in projects if not o['name'] in ['CONTROLS', 'SERRANO_HOSPITAL', 'TESTS']}
+         project_names = {uri: o['name'] for uri, o in self.projects.items()}
       
-   pcrruns = {o['pcr_plate']: o for o in pcrruns_data}
-
-   # Get pcr plates
-   next_url  = pcrplate_base
-   pcrplates = []
-   while next_url:
-      r, status = lims_request('GET', base_url+next_url, params={'limit': 1000})
-      assert_critical(status < 300, 'Could not retreive pcr plates from LIMS')
-      pcrplates.extend(r.json()['objects'])
-      next_url = r.json()['meta']['next']
+      with self.profiler.phase('merge'):
+         # Merge tables
+         data = dfrnawells.merge(dfpcrwells, how='left', left_on='resource_uri', right_on='rna_extraction_well')
+         data = data.merge(dfpcrprojs, how='left', on=['pcr_plate', 'project'])
+         data = data.merge(dfpcrruns, how='left', on='pcr_plate')
       
-   pcrplate_bcd = {o['resource_uri']: o['barcode'] for o in pcrplates}
-   pcrplates = {o['barcode']: o for o in pcrplates}
+         data['project']   = data['project'].map(project_names)
+         data['pcr_plate'] = data['pcr_plate'].map(pcrplate_bcd)
 
+         return data.groupby(by='sample_bcd').apply(sample_status)
 
-   # Get projects
-   r, status = lims_request('GET', project_url, params={'limit': 1000})
-   assert_critical(status < 300, 'Could not retreive projects from LIMS')
-   projects = r.json()['objects']
-   projects = {o['resource_uri']: o for o in projects if not o['name'] in ['CONTROLS', 'SERRANO_HOSPITAL', 'TESTS']}
-   
-
-   # Create data frames
-#   samples  = pd.DataFrame(samples)
-   dfrnawells = pd.DataFrame(rnawells)
-   dfpcrwells = pd.DataFrame(pcrwells)
-   dfpcrprojs = pd.DataFrame(pcrprojects)
-   dfpcrruns  = pd.DataFrame(pcrruns_data)
 
-   dfrnawells['project']    = dfrnawells['sample'].apply(lambda x: x['project'])
-   dfrnawells['sample_bcd'] = dfrnawells['sample'].apply(lambda x: x['barcode'])
-   
-   # Merge tables
-   data = dfrnawells.merge(dfpcrwells, how='left', left_on='resource_uri', right_on='rna_extraction_well')
-   data = data.merge(dfpcrprojs, how='left', on=['pcr_plate', 'project'])
-   data = data.merge(dfpcrruns, how='left', on='pcr_plate')
-   
-   data['project'] = data['project'].apply(lambda x: projects[x]['name'] if x in projects else None)
-   data['pcr_plate'] = data['pcr_plate'].apply(lambda x: pcrplate_bcd[x] if x in pcrplate_bcd else None)
-
-   sample_stats = data.groupby(by='sample_bcd').apply(sample_status)
-   
    ##
    ## PCR STATUS INFO
    ##
 
-   # Rna plates
-   next_url = rnaplate_base 
-   rnaplates = [] 
-   while next_url: 
-      r, status = lims_request('GET', base_url+next_url, params={'limit': 1000}) 
-      assert_critical(status < 300, 'Could not retreive rna plates from LIMS')
-      rnaplates.extend(r.json()['objects']) 
-      next_url = r.json()['meta']['next']
-   rnaplates = {o['barcode']: o for o in rnaplates}   
-
-
-   # Get organizations
-   r, status = lims_request('GET', organization_url, params={'limit': 10000})
-   assert_critical(status < 300, 'Could not retreive organizations from LIMS')
-   orgs = r.json()['objects']
-   orgs = {o['resource_uri']: o for o in orgs}
-
-   # Find all processed samples in path
-   flist = glob.glob('{}/*_results.txt'.format(path))
-   export_files = [fname.split('/')[-1].split('_results.txt')[0] for fname in flist]
-
-   # Merge information
-   report = []
-   for rnabcd in rnaplates:
-      info = {
-         'barcode': rnabcd,
-         'created': rnaplates[rnabcd]['date_prepared'],
-      }
-
-      pcrs = []
-      for pcrbcd in pcrplates:
-         # Check if pcr plates exist for this rna plate
-         if rnabcd in pcrbcd:
-            pcrinfo = {
-               'barcode': pcrplates[pcrbcd]['barcode'],
-               'sdsfile': pcrbcd in export_files         # Check if files were exported from SDS
+   def pcr_status(self, path):
+      # Status of the pcr plates of each rna plate (uses the pcr plates, runs
+      # and projects fetched by sample_stats)
+
+      with self.profiler.phase('fetch'):
+         # Rna plates
+         rnaplates = self.get_frame('rnaextractionplate', rnaplate_base, rnaplate_fields, 'Could not retreive rna plates from LIMS')
+         rnaplates = dict(zip(rnaplates['barcode'], rnaplates['date_prepared']))
+
+
+         # Get organizations
+         orgs = self.get_frame('organization', organization_base, organization_fields, 'Could not retreive organizations from LIMS')
+         orgs = dict(zip(orgs['resource_uri'], orgs['name']))
+
+      with self.profiler.phase('merge'):
+         # Find all processed samples in path
+         flist = glob.glob('{}/*_results.txt'.format(path))
+         export_files = [fname.split('/')[-1].split('_results.txt')[0] for fname in flist]
+
+         # Merge information
+         report = []
+         for rnabcd in rnaplates:
+            info = {
+               'barcode': rnabcd,
+               'created': rnaplates[rnabcd],
             }
-            uri = pcrplates[pcrbcd]['resource_uri']
-
-            # Run info
-            if uri in pcrruns:
-               pcrinfo['uploaded'] = True
-               pcrinfo['verified'] = pcrruns[uri]['status']
-            else:
-               pcrinfo['uploaded'] = False
-               pcrinfo['verified'] = False
-
-            # Project info
-            pcrprojinfo = []
-            for proj in pcrprojects:
-               if proj['pcr_plate'] == uri:
-                  projinfo = {}
-                  if not proj['project'] in projects:
-                     continue
-                  p = projects[proj['project']]
-                  projinfo['name'] = p['name'] if p else 'UNKNOWN'
-                  projinfo['org']  = orgs[p['organization']]['name'] if p['organization'] in orgs else 'UNKNOWN'
-                  projinfo['sent'] = proj['results_sent'] # N: Not sent, Y: Sent, F: Never Send
-                  projinfo['reviewed'] = proj['diagnosis_completed'] # 0: Not sent, 1; Sent
-                  projinfo['done'] = proj['diagnosis_sent'] if projinfo['name'] == 'ORFEU' else projinfo['reviewed'] # 0: Not sent, 1: Sent
-                  if not (proj['diagnosis_sent'] or proj['results_sent'] == 'F'):
-                     r, status = lims_request('GET', rnawell_url, params= {'limit': 10000, 'sample__project__name__exact': p['name'], 'rna_extraction_plate__barcode__exact': rnabcd})
-                     assert_error(status < 300, 'Could not retreive sample count for project {}/ pcrplate {} from LIMS'.format(p['name'], pcrbcd))
-                     projinfo['samples'] = r.json()['meta']['total_count']
+
+            pcrs = []
+            for pcrbcd in self.pcrplates:
+               # Check if pcr plates exist for this rna plate
+               if rnabcd in pcrbcd:
+                  pcrinfo = {
+                     'barcode': pcrbcd,
+                     'sdsfile': pcrbcd in export_files         # Check if files were exported from SDS
+                  }
+                  uri = self.pcrplates[pcrbcd]
+
+                  # Run info
+                  if uri in self.pcrruns:
+                     pcrinfo['uploaded'] = True
+                     pcrinfo['verified'] = self.pcrruns[uri]
                   else:
-                     projinfo['samples'] = 'NA'
+                     pcrinfo['uploaded'] = False
+                     pcrinfo['verified'] = False
+
+                  # Project info
+                  pcrprojinfo = []
+                  for proj in self.pcrprojects:
+                     if proj['pcr_plate'] == uri:
+                        projinfo = {}
+                        if not proj['project'] in self.projects:
+                           continue
+                        p = self.projects[proj['project']]
+                        projinfo['name'] = p['name'] if p else 'UNKNOWN'
+                        projinfo['org']  = orgs[p['organization']] if p['organization'] in orgs else 'UNKNOWN'
+                        projinfo['sent'] = proj['results_sent'] # N: Not sent, Y: Sent, F: Never Send
+                        projinfo['reviewed'] = proj['diagnosis_completed'] # 0: Not sent, 1; Sent
+                        projinfo['done'] = proj['diagnosis_sent'] if projinfo['name'] == 'ORFEU' else projinfo['reviewed'] # 0: Not sent, 1: Sent
+                        if not (proj['diagnosis_sent'] or proj['results_sent'] == 'F'):
+                           r, status = self.request('GET', rnawell_url, params= {'limit': 10000, 'sample__project__name__exact': p['name'], 'rna_extraction_plate__barcode__exact': rnabcd})
+                           assert_error(status < 300, 'Could not retreive sample count for project {}/ pcrplate {} from LIMS'.format(p['name'], pcrbcd))
+                           projinfo['samples'] = r.json()['meta']['total_count']
+                        else:
+                           projinfo['samples'] = 'NA'
+
+                        if projinfo['samples'] != 0:
+                           pcrprojinfo.append(projinfo)
+                        
+                  pcrinfo['projects'] = pcrprojinfo
+
+                  pcrs.append(pcrinfo)
+            info['pcr'] = pcrs
+            report.append(info)
+
+      return report
+
+   def build(self, path):
+      # Returns (report, sample stats), path: folder of the instrument exports
+      stats  = self.sample_stats()
+      report = self.pcr_status(path)
+      return report, stats
+
+
+   ##
+   ## HTML REPORT
+   ##
+
+   def html_digest(self, report, stats, tb=None):
+      return self.render_report(report, stats, self.digest_size_budget).mime_parts()
+
+   def render_report(self, report, stats, size_budget=None):
+      # Returns the HtmlReport, size_budget=None keeps every block in the page
+
+      html = HtmlReport(html_style, size_budget)
+
+      # Header
+      html.title('Project status report ({})'.format(datetime.datetime.now().strftime('%d/%m/%Y %H:%M')))
+
+      # Sample stats
+      html.write('<br><h2>Sample stats</h2>\n')
+      html.write('<table style="white-space:nowrap;"><tr>\
+   <th{c} rowspan="2">Project</th>\
+   <th{c} rowspan="2">In RNA plate</th>\
+   <th{c} rowspan="2">In PCR plate</th>\
+   <th{c} rowspan="2">Awaiting PCR verif.</th>\
+   <th{c} colspan="3">PCR Verified</th>\
+   <th{c} rowspan="2">Sent - Awaiting review</th>\
+   <th{c} rowspan="2">Reviewed</th>\
+   <th{c} rowspan="2">Sent to CTTI/ICS</th>\
+   </tr><tr>\
+   <th{c}>Failed</th>\
+   <th{c}>On Hold</th>\
+   <th{c}>Success</th>\
+   </tr>'.format(c=header_color))
 
-                  if projinfo['samples'] != 0:
-                     pcrprojinfo.append(projinfo)
-                     
-            pcrinfo['projects'] = pcrprojinfo
+      # Sample counts per project and status, computed once
+      counts   = stats.groupby(['project', 'status']).size().to_dict()
+      totals   = stats.groupby('project').size()
+      projects = [proj for proj in stats['project'].unique() if proj in totals.index]
 
-            pcrs.append(pcrinfo)
-      info['pcr'] = pcrs
-      report.append(info)
+      def count(proj, status):
+         return counts.get((proj, status), 0)
+
+      list_failed = False
+      list_onhold = False
+   
+      for proj in projects:
+         failed_cnt = count(proj, 'FAILED')
+         hold_cnt   = count(proj, 'HOLD')
+         list_failed = True if failed_cnt else list_failed
+         list_onhold = True if hold_cnt else list_onhold
+         html.write(
+            '<tr>',
+            '<td><b>{}</b></td>'.format(proj),
+            '<td>{}</td>'.format(count(proj, 'RNA')),
+            '<td>{}</td>'.format(count(proj, 'PCR')),
+            '<td>{}</td>'.format(count(proj, 'RUNNING')),
+            '<td>{}</td>'.format(failed_cnt if failed_cnt == 0 else '<a href="#failed{}">{}</a>'.format(proj,failed_cnt)),
+            '<td>{}</td>'.format(hold_cnt if hold_cnt == 0 else '<a href="#hold{}">{}</a>'.format(proj, hold_cnt)),
+            '<td>{}</td>'.format(count(proj, 'VERIFIED')),
+            '<td>{}</td>'.format(count(proj, 'SENT')),
+            '<td>{}</td>'.format(count(proj, 'REVIEWED')),
+            '<td{}><b>{}</b></td>'.format(count_color, count(proj, 'DONE')),
+            '</tr>'
+         )
+      
+      html.write('</table>')
    
+      # PCR in progress
+      html.write('<br><h2>PCR runs in progress</h2>\n')
+      html.write('<table style="white-space:nowrap;"><tr>\
+   <th{c}>RNA plate</th>\
+   <td{c}>Date created</td>\
+   <th{c}>PCR in LIMS</th>\
+   <td{c}>SDS export</td>\
+   <td{c}>LIMS upload</td>\
+   <td{c}>PCR verified</td>\
+   </tr>'.format(c=header_color))
+
+      # Sort report by RNA date
+      report = sorted(report, key = lambda x: x['created'])
+
+      for rna in report:
+         rna_cells = '<td><b>{}</b></td><td>{}</td>'.format(rna['barcode'], rna['created'].replace('T', ' '))
+         if len(rna['pcr']) == 0:
+            html.write('<tr>', rna_cells, no_cells, '</tr>')
+         else:
+            for pcr in rna['pcr']:
+               if pcr['verified'] in ['OK', 'F']:
+                  continue
+               html.write('<tr>', rna_cells, '<td{}><b>{}</b></td><td{}>{}</td><td{}>{}</td><td{}>{}</td>'.format(
+                  true_color,
+                  pcr['barcode'],
+                  true_color if pcr['sdsfile'] else false_color,
+                  '✅' if pcr['sdsfile'] else '❌',
+                  true_color if pcr['uploaded'] else false_color,
+                  '✅' if pcr['uploaded'] else '❌',
+                  true_color if pcr['verified'] == 'OK' else false_color,
+                  verified_txt.get(pcr['verified'], '❌')
+               ), '</tr>')
+
+      html.write('</table>')
+
+
+      # Diagnosis verification status
+      html.write('<br><h2>Diagnosis verification status</h2>\n')
+      html.write('<table style="white-space:nowrap;"><tr>\
+   <th{c}>PCR barcode</th>\
+   <th{c}>Project</th>\
+   <td{c}>Organization</td>\
+   <td{c}>Project samples</td>\
+   <td{c}>PCR verified</td>\
+   <td{c}>Sent for review</td>\
+   <td{c}>Reviewed</td>\
+   <td{c}>Results sent</td>\
+   </tr>'.format(c=header_color))
+
+      # Remove completed diagnosis
+      for rna in report:
+         for pcr in rna['pcr']:
+            for proj in pcr['projects']:
+               if proj['done'] or ((pcr['verified'] in ['OK', 'F']) and proj['sent'] == 'F'):
+                  continue
+
+               html.write('<tr>', '<td><b>{}</b></td><td>{}</td><td>{}</td><td>{}</td><td{}>{}</td><td{}>{}</td><td{}>{}</td><td{}>{}</td>'.format(
+                  pcr['barcode'],
+                  proj['name'],
+                  proj['org'],
+                  proj['samples'],
+                  true_color if pcr['verified'] == 'OK' else false_color,
+                  verified_txt.get(pcr['verified'], '❌'),
+                  true_color if proj['sent'] == 'Y' else '' if proj['sent'] == 'F' else false_color,
+                  '✅' if proj['sent'] == 'Y' else '&nbsp;' if proj['sent'] == 'F' else '❌',
+                  true_color if proj['reviewed'] else '' if proj['sent'] == 'F' else false_color,
+                  '✅' if proj['reviewed'] else '' if proj['sent'] == 'F' else '❌',
+                  true_color if proj['done'] else '' if proj['sent'] == 'F' else false_color,
+                  '✅' if proj['done'] else '' if proj['sent'] == 'F' else '❌'
+               ), '</tr>')
+      html.write('</table>')
+
+      # List of samples
+      if list_failed or list_onhold:
+         html.write('<br><h2>List of potentially delayed samples</h2>\n')
+         html.begin_block()
+         delayed = stats[stats['status'].isin(['FAILED', 'HOLD'])].sort_values('pcrplate', kind='stable')
+         if list_failed:
+            html.write('<h3>Samples on <b>failed</b> PCRs</h3>\n')
+         
+            for proj in stats['project'].unique():
+               failed_samples = delayed[(delayed['project'] == proj) & (delayed['status'] == 'FAILED')]
+               if failed_samples.shape[0]:
+                  html.write('<h4><a name="failed{}"></a>Samples on Failed PCR (Project: {}, samples: {})</h4>\n'.format(proj,proj,failed_samples.shape[0]))
+                  html.write('<p style="font-family:\'Courier New\'">')
+                  html.write(*['{}\t{}<br>'.format(p, s) for p, s in zip(failed_samples['pcrplate'], failed_samples['sample'])])
+                  html.write('</p>')
+
+         if list_onhold:
+            html.write('<br><h3>Samples <b>on hold</b> in PCRs</h3>\n')
+         
+            for proj in stats['project'].unique():
+               hold_samples = delayed[(delayed['project'] == proj) & (delayed['status'] == 'HOLD')]
+               if hold_samples.shape[0]:
+                  html.write('<h4><a name="hold{}"></a>Samples in PCR on hold (Project: {}, samples: {})</h4>\n'.format(proj,proj,hold_samples.shape[0]))
+                  html.write('<p style="font-family:\'Courier New\'">')
+                  html.write(*['{}\t{}<br>'.format(p, s) for p, s in zip(hold_samples['pcrplate'], hold_samples['sample'])])
+                  html.write('</p>')
+         html.end_block('status_{}_delayed_samples'.format(self.job_name), 'List of potentially delayed samples')
+
+      return html
+
+   def send_digest(self, mailer, report, stats, tb=None):
+      subject = "Project status report ({})".format(datetime.datetime.now().strftime('%d/%m/%Y'))
+      with self.profiler.phase('render'):
+         parts = self.html_digest(report, stats, tb)
+      mailer.send(subject, parts)
+
+   def dashboard_html(self, path):
+      # Full report page for the dashboard
+      report, stats = self.build(path)
+      with self.profiler.phase('render'):
+         return self.render_report(report, stats).render()
+
+
+###
+### MAIN SCRIPT
+###
+
+if __name__ == '__main__':
+   
+   # Parse arguments
+   options = getOptions(sys.argv[1:])
+   env     = getEnvironment()
+   path    = options.path
+
+   job_name, _ = new_job()
+   status = StatusReport(
+      env['LIMS_USER'],
+      env['LIMS_PASSWORD'],
+      snapshot           = SnapshotStore(options.snapshot) if options.snapshot else None,
+      snapshot_max_age   = options.snapshot_max_age if options.snapshot else None,
+      digest_size_budget = options.digest_budget,
+      profiler           = PhaseProfiler(options.logpath, job_name, options.profile, options.trace_memory),
+      job_name           = job_name
+   )
+
+   # Set up logger
+   logpath = setup_logger(options.logpath, job_name, options.log_json).replace('//','/')
+
+   # Local dashboard, refreshed in the background until interrupted
+   if options.serve:
+      try:
+         Dashboard(lambda: status.dashboard_html(path), options.refresh).serve(options.bind, options.serve)
+      except KeyboardInterrupt:
+         pass
+      status.profiler.dump()
+      sys.exit(0)
+
    # Send status report
-   send_digest(report, sample_stats)
+   report, sample_stats = status.build(path)
+   mailer = Mailer(env['LIMS_EMAIL_ADDRESS'], env['LIMS_EMAIL_PASSWORD'], env['LIMS_EMAIL_RECEIVERS'])
+   if options.mail_spool:
+      mailer = SpooledMailer(mailer, Spool(options.mail_spool))
+   status.send_digest(mailer, report, sample_stats)
+   status.profiler.dump()
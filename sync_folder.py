@@ -3,6 +3,15 @@ import logging
 import argparse
 import shutil
 import hashlib
+import json
+import threading
+import concurrent.futures
+from spool import Spool
+
+try:
+   import xxhash
+except ImportError:
+   xxhash = None
 
 job_name  = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
 job_start = datetime.datetime.now().strftime('%d/%m/%Y %H:%M:%S')
@@ -18,6 +27,12 @@ def getOptions(args=sys.argv[1:]):
    parser.add_argument('dest', help='destination folder, where info will be copied to')
    parser.add_argument('-l', '--logpath', help='logfile path', required=True)
    parser.add_argument('-f', '--force', help='overwrite existing files with different hash')
+   parser.add_argument('-c', '--hash-cache', help='hash cache file, unchanged files (same inode, size and mtime) are not rehashed')
+   parser.add_argument('-j', '--jobs', type=int, default=1, help='number of files hashed/copied in parallel')
+   parser.add_argument('-r', '--recursive', action='store_true', help='also sync subfolders (the folder structure is kept in dest)')
+   parser.add_argument('-s', '--spool', help='spool folder where the list of new or replaced *_results.txt/*_clipped.txt files is written for lims_sync')
+   parser.add_argument('-m', '--manifest', help='manifest file of the last synced state, entries with the same size and mtime on both sides are skipped')
+   parser.add_argument('--fast-hash', action='store_true', help='compare files with {} instead of md5 (md5 is still used to rename replaced files)'.format('xxhash' if xxhash else 'blake2b'))
    options = parser.parse_args(args)
    return options
 
@@ -26,12 +41,300 @@ def getOptions(args=sys.argv[1:]):
 ### FILE HASH
 ###
 
+hash_buffer_size = 1024*1024
+
+hash_algorithms = {
+   'md5':  hashlib.md5,
+   'fast': (xxhash.xxh3_128 if hasattr(xxhash, 'xxh3_128') else xxhash.xxh64) if xxhash else hashlib.blake2b
+}
+
+def file_digest(fname, algorithm=hashlib.md5):
+   hash_obj = algorithm()
+   buf  = bytearray(hash_buffer_size)
+   view = memoryview(buf)
+   with open(fname, "rb", buffering=0) as f:
+      for n in iter(lambda: f.readinto(buf), 0):
+         hash_obj.update(view[:n])
+   return hash_obj.hexdigest()
+
 def md5(fname):
-   hash_md5 = hashlib.md5()
-   with open(fname, "rb") as f:
-      for chunk in iter(lambda: f.read(4096), b""):
-         hash_md5.update(chunk)
-   return hash_md5.hexdigest()
+   return file_digest(fname, hashlib.md5)
+
+
+###
+### HASH CACHE
+###
+
+class HashCache(object):
+   # Persistent file digests keyed by path and validated with the file's
+   # inode, size and mtime, so unchanged files are never read again.
+
+   def __init__(self, cache_file=None):
+      self.cache_file = cache_file
+      self.entries    = {}
+      self.hashed     = 0
+      self.cached     = 0
+      self.dirty      = False
+      self.lock       = threading.Lock()
+
+      if cache_file and os.path.isfile(cache_file):
+         try:
+            with open(cache_file) as f:
+               self.entries = json.load(f)
+         except ValueError:
+            logging.warning("hash cache {} is corrupt, starting a new one".format(cache_file))
+
+   def _stat_key(self, st):
+      return [st.st_ino, st.st_size, st.st_mtime_ns]
+
+   def digest(self, fname, kind='md5', st=None):
+      path = os.path.abspath(fname)
+      key  = self._stat_key(st or os.stat(path))
+      with self.lock:
+         entry = self.entries.get(path)
+         if entry is not None and entry['stat'] == key and kind in entry:
+            self.cached += 1
+            return entry[kind]
+
+      # Hash outside the lock so other files can be hashed meanwhile
+      digest = file_digest(path, hash_algorithms[kind])
+      with self.lock:
+         entry = self.entries.get(path)
+         if entry is None or entry['stat'] != key:
+            entry = self.entries[path] = {'stat': key}
+         entry[kind] = digest
+         self.hashed += 1
+         self.dirty   = True
+      return digest
+
+   def store(self, fname, digests, st=None):
+      # Record digests known from an identical file (e.g. the copy source)
+      path = os.path.abspath(fname)
+      key  = self._stat_key(st or os.stat(path))
+      with self.lock:
+         self.entries[path] = dict(digests, stat=key)
+         self.dirty = True
+
+   def known(self, fname, st=None):
+      # Digests already computed for the current version of the file
+      path = os.path.abspath(fname)
+      key  = self._stat_key(st or os.stat(path))
+      with self.lock:
+         entry = self.entries.get(path)
+         if entry is None or entry['stat'] != key:
+            return {}
+         return {k: v for k, v in entry.items() if k != 'stat'}
+
+   def forget(self, fname):
+      with self.lock:
+         if self.entries.pop(os.path.abspath(fname), None) is not None:
+            self.dirty = True
+
+   def save(self):
+      if not self.cache_file or not self.dirty:
+         return
+      # Drop entries of files that no longer exist
+      self.entries = {p: e for p, e in self.entries.items() if os.path.exists(p)}
+      tmp = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+      with open(tmp, 'w') as f:
+         json.dump(self.entries, f)
+      os.replace(tmp, self.cache_file)
+      self.dirty = False
+
+
+###
+### FILE COPY
+###
+
+def kernel_copy(fd_in, fd_out, size):
+   # Copy inside the kernel when possible: copy_file_range (Linux, Python
+   # 3.8+, can reflink or copy server-side on NFS 4.2), then sendfile, then
+   # a plain buffered copy. A method that copies nothing (returns 0 on FUSE,
+   # procfs, some NFS/overlay mounts) falls through to the next one. Returns
+   # the number of bytes copied, short if the source ended early.
+   copied = 0
+   if hasattr(os, 'copy_file_range'):
+      try:
+         while copied < size:
+            n = os.copy_file_range(fd_in, fd_out, size - copied)
+            if n == 0:
+               break
+            copied += n
+         if copied:
+            return copied
+      except OSError:
+         if copied:
+            raise
+   if hasattr(os, 'sendfile') and copied < size:
+      try:
+         while copied < size:
+            n = os.sendfile(fd_out, fd_in, copied, size - copied)
+            if n == 0:
+               break
+            copied += n
+         if copied:
+            return copied
+      except OSError:
+         if copied:
+            raise
+   while copied < size:
+      chunk = os.read(fd_in, min(hash_buffer_size, size - copied))
+      if not chunk:
+         break
+      os.write(fd_out, chunk)
+      copied += len(chunk)
+   return copied
+
+def copy_file(src, dst, replaced_name=None):
+   # Writes a temporary file next to dst and renames it atomically, so
+   # readers never see a partial file. If replaced_name is given the current
+   # dst is kept under that name.
+   os.makedirs(os.path.dirname(dst) or '.', exist_ok=True)
+   tmp = os.path.join(os.path.dirname(dst), '.{}.{}-{}.tmp'.format(os.path.basename(dst), os.getpid(), threading.get_ident()))
+   try:
+      with open(src, 'rb') as f_in, open(tmp, 'wb') as f_out:
+         size   = os.fstat(f_in.fileno()).st_size
+         copied = kernel_copy(f_in.fileno(), f_out.fileno(), size)
+      # Never publish a truncated copy
+      if copied != size:
+         raise IOError('short copy of {}: {} of {} bytes'.format(src, copied, size))
+      os.chmod(tmp, 0o644)
+
+      if replaced_name:
+         try:
+            # dst is never missing: hard link the old file, then replace dst
+            os.link(dst, replaced_name)
+         except OSError:
+            shutil.move(dst, replaced_name)
+      os.replace(tmp, dst)
+   except:
+      if os.path.exists(tmp):
+         os.remove(tmp)
+      raise
+
+
+###
+### LIMS_SYNC HANDOFF
+###
+
+# Files that trigger a plate sync in lims_sync
+spool_suffixes = ('_results.txt', '_clipped.txt')
+
+def spool_copied(spool, dest, copied):
+   files = sorted(os.path.abspath(os.path.join(dest, relpath)) for relpath in copied if relpath.endswith(spool_suffixes))
+   if files:
+      name = spool.put({'job': job_name, 'source': 'sync_folder', 'files': files})
+      logging.info("{} new or replaced export files spooled to {}".format(len(files), os.path.join(spool.root, name)))
+
+
+###
+### FOLDER SCAN
+###
+
+def scan_tree(root, recursive=False, prefix=''):
+   # {relative path: stat} of the files under root, using the metadata
+   # returned by scandir (no extra stat call per entry on most systems)
+   files = {}
+   with os.scandir(os.path.join(root, prefix) if prefix else root) as it:
+      for entry in it:
+         relpath = os.path.join(prefix, entry.name) if prefix else entry.name
+         if entry.is_file():
+            files[relpath] = entry.stat()
+         elif recursive and entry.is_dir():
+            files.update(scan_tree(root, recursive, relpath))
+   return files
+
+
+###
+### SYNC MANIFEST
+###
+
+class SyncManifest(object):
+   # State of every entry after the last successful sync:
+   #   {relpath: {'src': [[source, size, mtime_ns], ...], 'dst': [size, mtime_ns]}}
+
+   def __init__(self, manifest_file=None):
+      self.manifest_file = manifest_file
+      self.entries       = {}
+      if manifest_file and os.path.isfile(manifest_file):
+         try:
+            with open(manifest_file) as f:
+               self.entries = json.load(f)
+         except ValueError:
+            logging.warning("manifest {} is corrupt, all files will be checked".format(manifest_file))
+
+   def state(self, sources, dst_stat):
+      # sources: [(source, stat)] in source order
+      return {
+         'src': [[path, st.st_size, st.st_mtime_ns] for path, st in sources],
+         'dst': [dst_stat.st_size, dst_stat.st_mtime_ns] if dst_stat is not None else None
+      }
+
+   def unchanged(self, relpath, sources, dst_stat):
+      return dst_stat is not None and self.entries.get(relpath) == self.state(sources, dst_stat)
+
+   def update(self, relpath, sources, dst_stat):
+      self.entries[relpath] = self.state(sources, dst_stat)
+
+   def save(self, current=None):
+      # current: relpaths present in the sources, others are dropped
+      if not self.manifest_file:
+         return
+      if current is not None:
+         self.entries = {p: e for p, e in self.entries.items() if p in current}
+      tmp = '{}.{}.tmp'.format(self.manifest_file, os.getpid())
+      with open(tmp, 'w') as f:
+         json.dump(self.entries, f)
+      os.replace(tmp, self.manifest_file)
+
+
+###
+### SYNC
+###
+
+def sync_file(fname, paths, dest, dst_files, hash_cache, hash_kind):
+   # Files with the same name are processed in source order, by one worker.
+   # Returns True if dest was copied or replaced.
+   copied = False
+   for path in paths:
+      src_path = os.path.join(path,fname)
+      dst_path = os.path.join(dest,fname)
+      replaced = None
+      logging.info("[{}] begin processing, source path: {}".format(fname, src_path))
+      if fname in dst_files:
+         logging.info("[{}] file already exists in {}".format(fname, dest))
+         # Check if it is the same file (files of different size are never equal)
+         s_stat = os.stat(src_path)
+         d_stat = os.stat(dst_path)
+         same   = False
+         if s_stat.st_size == d_stat.st_size:
+            s_hash = hash_cache.digest(src_path, hash_kind, s_stat)
+            same   = s_hash == hash_cache.digest(dst_path, hash_kind, d_stat)
+
+         if not same:
+            # md5 is kept for the renamed file name
+            d_hash   = hash_cache.digest(dst_path, 'md5', d_stat)
+            replaced = dst_path+'.'+d_hash
+            logging.info("[{}] dest file is different, renaming {} to {}".format(fname, dst_path, replaced))
+         else:
+            logging.info("[{}] files are equal. {}: {}".format(fname, hash_kind, s_hash))
+            # File is in sync: done
+            continue
+
+      # Now copy the source file (if the dest file is different, append .[filehash] at the end of its name)
+      logging.info("[{}] copy {} to {}".format(fname, src_path, dst_path))
+      copy_file(src_path, dst_path, replaced)
+      if replaced:
+         hash_cache.forget(dst_path)
+         dst_files.add(fname+'.'+d_hash)
+      # The copy has the same digests as the source
+      if hash_cache.known(src_path):
+         hash_cache.store(dst_path, hash_cache.known(src_path))
+      logging.info("[{}] end processing".format(fname))
+      dst_files.add(fname)
+      copied = True
+
+   return copied
 
 
 ###
@@ -60,36 +363,46 @@ if __name__ == '__main__':
    dest    = options.dest
    logpath = setup_logger(options.logpath).replace('//','/')
 
+   hash_kind  = 'fast' if options.fast_hash else 'md5'
+   hash_cache = HashCache(options.hash_cache)
+   manifest   = SyncManifest(options.manifest)
+   spool      = Spool(options.spool) if options.spool else None
+   src_paths  = {}
+   copied     = []
+
    try:
-      src_files = [(f, path) for path in sources for f in os.listdir(path) if os.path.isfile(os.path.join(path,f))]
-      dst_files = [f for f in os.listdir(dest) if os.path.isfile(os.path.join(dest,f))]
-
-      for (fname, path) in src_files:
-         logging.info("[{}] begin processing, source path: {}".format(fname, os.path.join(path,fname)))
-         if fname in dst_files:
-            logging.info("[{}] file already exists in {}".format(fname, dest))
-            # Check if it is the same file
-            s_hash = md5(os.path.join(path,fname))
-            d_hash = md5(os.path.join(dest,fname))
-
-            if s_hash != d_hash:
-               logging.info("[{}] dest file is different, renaming {} to {}".format(fname, os.path.join(dest,fname), os.path.join(dest,fname)+'.'+d_hash))
-               # If file already exists, append .[filehash] at the end of the current file name
-               shutil.move(os.path.join(dest,fname), os.path.join(dest,fname)+'.'+d_hash)
-               dst_files.append(fname+'.'+d_hash)
+      dst_stats = scan_tree(dest, options.recursive)
+      dst_files = set(dst_stats)
+
+      # Group sources by file name, keeping the source order
+      for path in sources:
+         for relpath, st in scan_tree(path, options.recursive).items():
+            src_paths.setdefault(relpath, []).append((path, st))
+
+      # Only entries that changed since the last synced state are processed
+      changed = {relpath: srcs for relpath, srcs in src_paths.items() if not manifest.unchanged(relpath, srcs, dst_stats.get(relpath))}
+      logging.info("{} files in sources, {} changed since last sync".format(len(src_paths), len(changed)))
+
+      with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, options.jobs)) as pool:
+         jobs = {pool.submit(sync_file, relpath, [path for path, st in srcs], dest, dst_files, hash_cache, hash_kind): relpath for relpath, srcs in changed.items()}
+         for job in concurrent.futures.as_completed(jobs):
+            relpath = jobs[job]
+            if job.exception() is not None:
+               tb = ''.join(traceback.format_exception(type(job.exception()), job.exception(), job.exception().__traceback__))
+               logging.error("[{}] sync failed:\n{}".format(relpath, tb))
             else:
-               logging.info("[{}] files are equal. md5: {}".format(fname, s_hash))
-               # File is in sync: done
-               continue
-
-         # Now copy the source file
-         logging.info("[{}] copy {} to {}".format(fname, os.path.join(path,fname), os.path.join(dest,fname)))
-         shutil.copy(os.path.join(path,fname), os.path.join(dest,fname))
-         logging.info("[{}] chown".format(fname))
-         os.chmod(os.path.join(dest,fname), 0o644)
-         logging.info("[{}] end processing".format(fname))
-         dst_files.append(fname)
+               manifest.update(relpath, changed[relpath], os.stat(os.path.join(dest, relpath)))
+               if job.result():
+                  copied.append(relpath)
 
    except:
       tb = traceback.format_exc()         
       logging.error(tb)
+
+   finally:
+      # Hand off whatever was copied, even if the run failed later
+      if spool is not None:
+         spool_copied(spool, dest, copied)
+      hash_cache.save()
+      manifest.save(src_paths)
+      logging.info("hash cache: {} files hashed, {} digests reused".format(hash_cache.hashed, hash_cache.cached))
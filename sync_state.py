@@ -0,0 +1,55 @@
+import os, json, time
+
+# Local record of the instrument exports already processed, keyed by results
+# file with the size and mtime of the results and clipped files. Lets
+# lims_sync skip unchanged exports without querying LIMS. Exports that could
+# not be synced (e.g. plate not yet in LIMS) are retried after a delay even
+# if they did not change.
+
+def export_signature(results_file, clipped_file):
+   sig = []
+   for fname in (results_file, clipped_file):
+      try:
+         st = os.stat(fname)
+      except (IOError, OSError):
+         sig.append(None)
+         continue
+      sig.append([st.st_size, st.st_mtime_ns])
+   return sig
+
+def clipped_file(results_file):
+   return results_file[:-len('_results.txt')] + '_clipped.txt'
+
+
+class SyncState(object):
+
+   def __init__(self, state_file):
+      self.state_file = state_file
+      self.exports    = {}
+      try:
+         with open(state_file) as f:
+            self.exports = json.load(f)
+      except (IOError, OSError, ValueError):
+         pass
+
+   def changed(self, results_file):
+      # True if the export is new, changed or due for a retry
+      entry = self.exports.get(os.path.abspath(results_file))
+      if entry is None or entry['signature'] != export_signature(results_file, clipped_file(results_file)):
+         return True
+      return entry['retry'] is not None and entry['retry'] <= time.time()
+
+   def record(self, results_file, retry_after=None):
+      # retry_after: seconds after which the export is processed again
+      self.exports[os.path.abspath(results_file)] = {
+         'signature': export_signature(results_file, clipped_file(results_file)),
+         'retry':     None if retry_after is None else time.time() + retry_after
+      }
+
+   def save(self):
+      # Forget exports that were removed
+      self.exports = {k: v for k, v in self.exports.items() if os.path.exists(k)}
+      tmp = '{}.tmp'.format(self.state_file)
+      with open(tmp, 'w') as f:
+         json.dump(self.exports, f)
+      os.replace(tmp, self.state_file)
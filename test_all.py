@@ -11,27 +11,75 @@ except ImportError:
    from urllib2 import urlopen
 
 
+class FakeResponse(object):
+   def __init__(self, status_code, objects=None, location=None):
+      self.status_code = status_code
+      self.objects     = objects or []
+      self.headers     = {'Location': location}
+   def json(self):
+      return {'objects': self.objects, 'meta': {'next': None, 'total_count': len(self.objects)}}
+
+
+class FakeLims(object):
+   # Stands in for LimsSession. GET requests return the objects routed to
+   # their url (a list, or a function of the request params); every request
+   # gets the next status queued for (method, url), or a successful one.
+   # Requests are recorded in calls (and with their bodies in sent), error
+   # (if set) is raised by every request.
+
+   success = {'GET': 200, 'POST': 201, 'PATCH': 202, 'PUT': 204, 'DELETE': 204}
+
+   def __init__(self, routes=None, statuses=None):
+      self.routes   = routes or {}
+      self.statuses = statuses or {}
+      self.calls    = []
+      self.sent     = []
+      self.error    = None
+
+   def request(self, method, url, params=None, json_data=None, headers=None):
+      self.calls.append((method, url))
+      self.sent.append((method, url, json_data))
+      if self.error is not None:
+         raise self.error
+      return self.respond(method, url, params or {}, json_data)
+
+   def respond(self, method, url, params, json_data):
+      queued = self.statuses.get((method, url))
+      status = queued.pop(0) if queued else self.success[method]
+      if method == 'GET':
+         objects = self.routes.get(url, [])
+         return FakeResponse(status, objects(params) if callable(objects) else objects)
+      return FakeResponse(status, location='{}/{}/'.format(url.rstrip('/'), len(self.sent)))
+
+   def requests(self, method, url):
+      # Bodies of the (method, url) requests
+      return [body for m, u, body in self.sent if (m, u) == (method, url)]
+
+
 class TestBasic(unittest.TestCase):
 
    def test_Python_version(self):
       if sys.version_info < (3,5):
          # Make sure import fails on unsupported Python versions.
          with self.assertRaises(ImportError):
-            import lims_sync_7900ht
+            import lims_sync
       else:
          # Make sure import succeeds on supported Python versions.
-         import lims_sync_7900ht
+         import lims_sync
 
    def test_API_URLs(self):
 
-      pytest.importorskip('lims_sync_7900ht')
-      import lims_sync_7900ht
+      pytest.importorskip('lims_sync')
+      import lims_sync
 
       # Hard-coded here. Will fail if the base URL is changed in the code.
-      prefixall = 'https://orfeu.cnag.crg.eu/prbblims_devel/api/covid19/'
+      prefixall = 'https://orfeu.cnag.crg.eu/prbblims/api/covid19/'
 
-      with urlopen(prefixall) as response:
-         data = response.read()
+      try:
+         with urlopen(prefixall) as response:
+            data = response.read()
+      except IOError:
+         pytest.skip('LIMS API not reachable')
 
       self.assertTrue('pcrplate' in str(data))
       self.assertTrue('pcrwell' in str(data))
@@ -41,46 +89,1084 @@ class TestBasic(unittest.TestCase):
       self.assertTrue('amplification' in str(data))
       self.assertTrue('organization' in str(data))
 
-      self.assertTrue(lims_sync_7900ht.pcrplate_url.startswith(prefixall))
-      self.assertTrue(lims_sync_7900ht.pcrwell_url.startswith(prefixall))
-      self.assertTrue(lims_sync_7900ht.pcrrun_url.startswith(prefixall))
-      self.assertTrue(lims_sync_7900ht.detector_url.startswith(prefixall))
-      self.assertTrue(lims_sync_7900ht.results_url.startswith(prefixall))
-      self.assertTrue(lims_sync_7900ht.amplification_url.startswith(prefixall))
-      self.assertTrue(lims_sync_7900ht.organization_url.startswith(prefixall))
+      self.assertTrue(lims_sync.pcrplate_url.startswith(prefixall))
+      self.assertTrue(lims_sync.pcrwell_url.startswith(prefixall))
+      self.assertTrue(lims_sync.pcrrun_url.startswith(prefixall))
+      self.assertTrue(lims_sync.detector_url.startswith(prefixall))
+      self.assertTrue(lims_sync.results_url.startswith(prefixall))
+      self.assertTrue(lims_sync.amplification_url.startswith(prefixall))
+      self.assertTrue(lims_sync.organization_url.startswith(prefixall))
 
    def test_globals(self):
 
-      pytest.importorskip('lims_sync_7900ht')
-      import lims_sync_7900ht
+      pytest.importorskip('lims_sync')
+      import lims_sync
 
-      match = re.match(r'\d{8}_\d{6}', lims_sync_7900ht.job_name)
+      job_name, job_start = lims_sync.new_job()
+      match = re.match(r'\d{8}_\d{6}', job_name)
       self.assertIsNotNone(match)
 
       match = re.match(r'\d{2}/\d{2}/\d{4} \d{2}:\d{2}:\d{2}',
-            lims_sync_7900ht.job_start)
+            job_start)
       self.assertIsNotNone(match)
 
+      # Credentials are only required by the main script
+      with self.assertRaises(SystemExit):
+         lims_sync.getEnvironment({'LIMS_USER': 'user'})
+      env = lims_sync.getEnvironment({name: 'x' for name in lims_sync.env_variables})
+      self.assertEqual(env['LIMS_PASSWORD'], 'x')
+
    def test_options(self):
 
-      pytest.importorskip('lims_sync_7900ht')
-      import lims_sync_7900ht
+      pytest.importorskip('lims_sync')
+      import lims_sync
 
       # Check that calling with insufficient options causes exit.
       with self.assertRaises(SystemExit):
-         lims_sync_7900ht.getOptions(args=[])
+         lims_sync.getOptions(args=[])
 
       with self.assertRaises(SystemExit):
-         lims_sync_7900ht.getOptions(args=['-o', 'odir'])
+         lims_sync.getOptions(args=['-o', 'odir'])
 
       with self.assertRaises(SystemExit):
-         lims_sync_7900ht.getOptions(args=['-l', 'lir'])
+         lims_sync.getOptions(args=['-l', 'lir'])
 
       with self.assertRaises(SystemExit):
-         lims_sync_7900ht.getOptions(args=['-o', 'odir', '-l', 'ldir'])
+         lims_sync.getOptions(args=['-o', 'odir', '-l', 'ldir'])
 
       # Check that otherwise the call is fine.
-      opt = lims_sync_7900ht.getOptions(args=['-o', 'odir', '-l', 'ldir', 'path'])
+      opt = lims_sync.getOptions(args=['-o', 'odir', '-l', 'ldir', 'path'])
       self.assertEqual(opt.path, 'path')
       self.assertEqual(opt.output, 'odir')
       self.assertEqual(opt.logpath, 'ldir')
+
+
+   def test_sync_engine(self):
+
+      pytest.importorskip('pandas')
+      import tempfile
+      import lims_sync
+
+      with tempfile.TemporaryDirectory() as tmp:
+         session = FakeLims({
+            lims_sync.pcrplate_url: [{'barcode': 'P1', 'id': 1, 'resource_uri': '/pcrplate/1/'}],
+            lims_sync.pcrrun_url:   [{'pcr_plate': '/pcrplate/1/'}]
+         })
+         engine  = lims_sync.SyncEngine('user', 'password', tmp, session=session)
+         try:
+            self.assertEqual(engine.sync_plate('{}/P1_results.txt'.format(tmp)), 'skipped')
+            self.assertEqual(engine.sync_plate('{}/P2_results.txt'.format(tmp)), 'noinfo')
+            self.assertEqual(engine.digest['skipped'], ['P1'])
+            self.assertEqual(engine.digest['noinfo'], ['P2'])
+            # References are loaded once
+            self.assertEqual(len([c for c in session.calls if c[1] == lims_sync.pcrplate_url]), 1)
+            self.assertTrue(lims_sync.digest_pending(engine.digest))
+
+            engine.start_job()
+            self.assertFalse(lims_sync.digest_pending(engine.digest))
+
+            # Plates leased by another worker are left alone
+            from leases import PlateLeases
+            engine.leases = PlateLeases(os.path.join(tmp, 'leases'), owner='a')
+            self.assertTrue(PlateLeases(os.path.join(tmp, 'leases'), owner='b').acquire('P1'))
+            self.assertEqual(engine.sync_plate('{}/P1_results.txt'.format(tmp)), 'leased')
+            self.assertEqual(engine.digest['leased'], ['P1'])
+            self.assertEqual(engine.sync_plate('{}/P2_results.txt'.format(tmp)), 'noinfo')
+            self.assertEqual(os.listdir(os.path.join(tmp, 'leases')), ['P1.lease'])
+         finally:
+            engine.close()
+
+   def test_sync_engine_lims_errors(self):
+
+      pytest.importorskip('pandas')
+      import tempfile
+      import requests
+      import lims_sync
+      from lims_client import LimsUnavailable
+
+      with tempfile.TemporaryDirectory() as tmp:
+         session = FakeLims({lims_sync.pcrplate_url: [{'barcode': 'P1', 'id': 1, 'resource_uri': '/pcrplate/1/'}]})
+         engine  = lims_sync.SyncEngine('user', 'password', tmp, session=session)
+         try:
+            engine.load_references()
+            # A timeout fails the plate only
+            session.error = requests.Timeout('read timed out')
+            self.assertEqual(engine.sync_plate('{}/P1_results.txt'.format(tmp)), 'error')
+            self.assertEqual(engine.digest['error'], ['P1'])
+            # An open circuit breaker stops the job
+            session.error = LimsUnavailable('circuit breaker open')
+            with self.assertRaises(LimsUnavailable):
+               engine.sync_plate('{}/P1_results.txt'.format(tmp))
+            self.assertEqual(engine.digest['error'], ['P1', 'P1'])
+         finally:
+            engine.close()
+
+   def test_snapshot_plates(self):
+
+      pytest.importorskip('pandas')
+      import tempfile
+      import lims_sync
+      from columnar import SnapshotStore
+
+      plates = [{'barcode': 'P{}'.format(i), 'id': i, 'resource_uri': '/pcrplate/{}/'.format(i)} for i in [1, 2]]
+      with tempfile.TemporaryDirectory() as tmp:
+         # P2 was registered in LIMS after the snapshot was saved
+         snapshot = SnapshotStore(os.path.join(tmp, 'snapshot'))
+         snapshot.save('pcrplate', plates[:1])
+         session = FakeLims({lims_sync.pcrplate_url: plates, lims_sync.pcrrun_url: [{'pcr_plate': '/pcrplate/2/'}]})
+         engine  = lims_sync.SyncEngine('user', 'password', tmp, session=session, snapshot=snapshot, snapshot_max_age=3600)
+         try:
+            self.assertEqual(engine.sync_plate('{}/P1_results.txt'.format(tmp)), 'skipped')
+            self.assertEqual(session.calls.count(('GET', lims_sync.pcrplate_url)), 0)
+            self.assertEqual(engine.sync_plate('{}/P2_results.txt'.format(tmp)), 'skipped')
+            self.assertEqual(engine.sync_plate('{}/P3_results.txt'.format(tmp)), 'noinfo')
+            # The plates are reloaded once, the snapshot is updated
+            self.assertEqual(session.calls.count(('GET', lims_sync.pcrplate_url)), 1)
+            self.assertEqual([p['barcode'] for p in snapshot.load_records('pcrplate')], ['P1', 'P2'])
+         finally:
+            engine.close()
+
+   def test_unchanged_wells(self):
+
+      pd = pytest.importorskip('pandas')
+      import lims_sync
+      from amplification import AmplificationMatrix
+
+      results = pd.DataFrame({'Well': [1, 2], 'Detector Name': ['N1', 'N1'], 'Ct': ['NA', 23.826], 'Threshold': [0.2, 0.2]})
+      curves  = AmplificationMatrix.from_frame(pd.DataFrame({'well': [1, 1, 2, 2], 'cycle': [1, 2, 1, 2], 'Rn': [1.001, 1.002, 1.5, 2.5], 'Delta Rn': [0.0, 0.001, 0.5, 1.5]}))
+      res_objs = [
+         {'id': 11, 'resource_uri': '/results/11/', 'pcr_well': '/pw/1/', 'detector': '/d/1/', 'ct': None, 'qpcr_threshold': '0.2', 'amplification': False},
+         {'id': 12, 'resource_uri': '/results/12/', 'pcr_well': '/pw/2/', 'detector': '/d/1/', 'ct': '23.826', 'qpcr_threshold': '0.2', 'amplification': True}
+      ]
+      amp_objs = [
+         {'results': '/api/covid19/results/11/', 'cycle': 2, 'rn': '1.002', 'delta_rn': '0.001'},
+         {'results': '/api/covid19/results/11/', 'cycle': 1, 'rn': '1.001', 'delta_rn': '0.0'},
+         {'results': '/api/covid19/results/12/', 'cycle': 1, 'rn': '1.5',   'delta_rn': '0.5'}
+      ]
+      args = (results, res_objs, {'A1': '/pw/1/', 'A2': '/pw/2/'}, {'n1': '/d/1/'}, curves)
+
+      # A2 is missing one point of its curve in LIMS
+      self.assertEqual(lims_sync.unchanged_wells(*args, lims_sync.lims_curves(amp_objs)), {'A1': '/results/11/'})
+      amp_objs.append({'results': '/api/covid19/results/12/', 'cycle': 2, 'rn': '2.5', 'delta_rn': '1.5'})
+      self.assertEqual(len(lims_sync.unchanged_wells(*args, lims_sync.lims_curves(amp_objs))), 2)
+      # Different curve values or no curves at all
+      amp_objs[0]['rn'] = '1.1'
+      self.assertEqual(lims_sync.unchanged_wells(*args, lims_sync.lims_curves(amp_objs)), {'A2': '/results/12/'})
+      self.assertEqual(lims_sync.unchanged_wells(*args, {}), {})
+
+   def test_diff_resync(self):
+
+      pytest.importorskip('pandas')
+      import tempfile
+      import lims_sync
+
+      class Lims(FakeLims):
+         # Results and amplificationdata of plate P1
+         def __init__(self):
+            FakeLims.__init__(self, {
+               lims_sync.pcrplate_url:      [{'barcode': 'P1', 'id': 1, 'resource_uri': '/pcrplate/1/'}],
+               lims_sync.detector_url:      [{'name': 'N1', 'resource_uri': '/d/1/'}],
+               lims_sync.pcrrun_url:        lambda params: self.pcrrun,
+               lims_sync.results_url:       lambda params: list(self.results.values()),
+               lims_sync.amplification_url: lambda params: [o for objs in self.amp.values() for o in objs],
+               lims_sync.pcrwell_url:       lambda params: [] if 'rna_extraction_well__sample__sample_type__name__exact' in params else
+                                            [{'position': p, 'resource_uri': '/pw/{}/'.format(p), 'automatic_diagnosis': None, 'pass_fail': None} for p in ['A1', 'A2']]
+            })
+            self.results, self.amp, self.pcrrun = {}, {}, []
+            self.fail_patch = False
+         def respond(self, method, url, params, json_data):
+            if method == 'POST' and url == lims_sync.results_url:
+               rid = len(self.sent)
+               self.results[rid] = dict(json_data, id=rid, resource_uri='/results/{}/'.format(rid))
+               return FakeResponse(201, location='/api/covid19/results/{}/'.format(rid))
+            if method == 'PATCH' and url == lims_sync.amplification_url:
+               if self.fail_patch:
+                  return FakeResponse(500)
+               for o in json_data['objects']:
+                  self.amp.setdefault(lims_sync.results_id(o['results']), []).append(dict(o, rn=str(o['rn']), delta_rn=str(o['delta_rn'])))
+            if method == 'DELETE':
+               rid = int(lims_sync.results_id(url))
+               self.results.pop(rid)
+               self.amp.pop(str(rid), None)
+            if method == 'POST' and url == lims_sync.pcrrun_url:
+               self.pcrrun.append({'pcr_plate': '/pcrplate/1/'})
+            return FakeLims.respond(self, method, url, params, json_data)
+
+      export = '\n'.join([
+         '* Block Type = 384-Well Block',
+         '* Run End Time = 05-12-2020 10:31:42 AM',
+         '',
+         '[Amplification Data]',
+         'Well\tCycle\tTarget Name\tRn\tDelta Rn',
+         '1\t1\tN1\t1.0010\t0.0000',
+         '1\t2\tN1\t1.0020\t0.0010',
+         '2\t1\tN1\t1.5000\t0.5000',
+         '2\t2\tN1\t2.5000\t1.5000',
+         '',
+         '[Results]',
+         'Well\tWell Position\tSample Name\tTarget Name\tCT\tCt Threshold',
+         '1\tA1\tS1\tN1\tUndetermined\t0.2',
+         '2\tA2\tS2\tN1\t23.826\t0.2',
+         ''
+      ])
+
+      def posted(lims):
+         return len([c for c in lims.calls if c == ('POST', lims_sync.results_url)])
+
+      with tempfile.TemporaryDirectory() as tmp:
+         fname = os.path.join(tmp, 'P1_results.txt')
+         with open(fname, 'w') as f:
+            f.write(export)
+         lims   = Lims()
+         engine = lims_sync.SyncEngine('user', 'password', tmp, session=lims, diff_resync=True, chunk_retries=0)
+         try:
+            # Results are written but their curves are not
+            lims.fail_patch = True
+            self.assertEqual(engine.sync_plate(fname), 'error')
+            self.assertEqual((len(lims.results), len(lims.amp)), (2, 0))
+
+            # Wells without curves in LIMS are rewritten
+            lims.fail_patch, lims.calls = False, []
+            self.assertEqual(engine.sync_plate(fname), 'success')
+            self.assertEqual(posted(lims), 2)
+            self.assertEqual(sorted(lims.amp), sorted(str(rid) for rid in lims.results))
+            # Curves are posted with the exported decimals
+            self.assertEqual(sorted((o['cycle'], o['rn'], o['delta_rn']) for objs in lims.amp.values() for o in objs),
+                             [(1, '1.001', '0.0'), (1, '1.5', '0.5'), (2, '1.002', '0.001'), (2, '2.5', '1.5')])
+
+            # Nothing changed: nothing is rewritten
+            lims.pcrrun, lims.calls = [], []
+            self.assertEqual(engine.sync_plate(fname), 'success')
+            self.assertEqual(posted(lims), 0)
+            self.assertEqual(len([c for c in lims.calls if c[0] == 'DELETE']), 0)
+
+            # Plate lease lost: renewals succeed as given, then fail
+            class Leases(object):
+               def __init__(self, renewals):
+                  self.renewals, self.lost = renewals, None
+               def acquire(self, plate):
+                  return True
+               def renew(self, plate):
+                  if self.renewals and self.renewals.pop(0):
+                     return True
+                  if self.lost is None:
+                     self.lost = len(lims.calls)
+                  return False
+               def release(self, plate):
+                  pass
+
+            # Renewals (one well per chunk): results DELETE, A1 results POST,
+            # A1 amplificationdata PATCH, same for A2, pcrwell PATCH, pcrrun POST
+            engine.diff_resync, engine.chunk_wells = False, 1
+            for renewals, deleted, created, pcrwells in [(0, 0, 0, False), (1, 2, 0, False), (2, 2, 1, False), (4, 2, 2, False), (5, 2, 2, False), (6, 2, 2, True)]:
+               engine.leases, lims.pcrrun = None, []
+               self.assertEqual(engine.sync_plate(fname), 'success')
+               engine.leases = Leases([True]*renewals)
+               lims.pcrrun, lims.calls = [], []
+               self.assertEqual(engine.sync_plate(fname), 'error')
+               # Nothing is written once the lease is lost
+               self.assertEqual([c for c in lims.calls[engine.leases.lost:] if c[0] != 'GET'], [])
+               self.assertEqual(len([c for c in lims.calls if c[0] == 'DELETE']), deleted)
+               self.assertEqual(posted(lims), created)
+               self.assertEqual(('PATCH', lims_sync.pcrwell_url) in lims.calls, pcrwells)
+               self.assertEqual(lims.pcrrun, [])
+         finally:
+            engine.close()
+
+   def test_amplification_chunks(self):
+
+      pytest.importorskip('lims_sync')
+      import lims_sync
+
+      wells  = [('A{}'.format(i), [{'cycle': c} for c in range(n)]) for i, n in enumerate([40, 40, 40, 10, 90], 1)]
+      chunks = [[pos for pos, objs in chunk] for chunk in lims_sync.amplification_chunks(wells, 3, 100)]
+      # At most 3 wells and 100 objects per chunk (a larger well goes alone)
+      self.assertEqual(chunks, [['A1', 'A2'], ['A3', 'A4'], ['A5']])
+      chunks = [[pos for pos, objs in chunk] for chunk in lims_sync.amplification_chunks(wells, 2, 1000)]
+      self.assertEqual(chunks, [['A1', 'A2'], ['A3', 'A4'], ['A5']])
+      self.assertEqual(list(lims_sync.amplification_chunks([], 2, 1000)), [])
+
+   def test_upload_amplification(self):
+
+      pytest.importorskip('pandas')
+      import tempfile
+      from unittest import mock
+      import lims_sync
+
+      wells = [(pos, [{'results': '/results/{}/'.format(pos), 'cycle': c, 'rn': 1.0, 'delta_rn': 0.0} for c in range(1, 41)]) for pos in ['A1', 'A2', 'A3', 'A4']]
+      with tempfile.TemporaryDirectory() as tmp:
+         # A2 fails before it is applied and is retried, A3 fails after the
+         # server stored its curves (not retried), A4 fails for good
+         session = FakeLims({lims_sync.amplification_url: wells[2][1]}, {('PATCH', lims_sync.amplification_url): [202, 503, 202, 500, 500, 500, 500]})
+         engine  = lims_sync.SyncEngine('user', 'password', tmp, session=session, chunk_wells=1, chunk_retries=2)
+         done    = []
+         try:
+            with mock.patch('lims_sync.time.sleep') as sleep:
+               failed = engine.upload_amplification('P1', wells, done.extend)
+         finally:
+            engine.close()
+         self.assertEqual(failed, ['A4'])
+         self.assertEqual(done, ['A1', 'A2', 'A3'])
+         patched = [sorted(set(o['results'] for o in body['objects'])) for body in session.requests('PATCH', lims_sync.amplification_url)]
+         self.assertEqual(patched, [['/results/{}/'.format(pos)] for pos in ['A1', 'A2', 'A2', 'A3', 'A4', 'A4', 'A4']])
+         self.assertEqual(len(session.requests('GET', lims_sync.amplification_url)), 5)
+         self.assertEqual(sleep.call_count, 3)
+
+         # Curves that cannot be checked are not retried
+         session = FakeLims(statuses={('PATCH', lims_sync.amplification_url): [500], ('GET', lims_sync.amplification_url): [500]})
+         engine  = lims_sync.SyncEngine('user', 'password', tmp, session=session, chunk_retries=2)
+         try:
+            self.assertEqual(engine.upload_amplification('P1', wells[:1]), ['A1'])
+         finally:
+            engine.close()
+         self.assertEqual(len(session.requests('PATCH', lims_sync.amplification_url)), 1)
+
+
+class TestStatusReport(unittest.TestCase):
+
+   def test_report(self):
+
+      pytest.importorskip('pandas')
+      import tempfile
+      import status_report
+      from columnar import SnapshotStore
+
+      # Project ORFEU: S1 and S2 on plate R1P1 (verified, results sent), S3 on
+      # R2P1 (failed), S4 only in an RNA plate. TESTS samples are left out.
+      wells = [('S1', '/proj/1/', 'R1'), ('S2', '/proj/1/', 'R1'), ('S3', '/proj/1/', 'R2'), ('S4', '/proj/1/', 'R3'), ('T1', '/proj/2/', 'R1')]
+      def rnawells(params):
+         if 'sample__project__name__exact' in params:
+            return [w for w in wells if w[2] == params['rna_extraction_plate__barcode__exact'] and w[1] == '/proj/1/']
+         return [{'resource_uri': '/rw/{}/'.format(s), 'sample': {'project': p, 'barcode': s}, 'extra': 'x'} for s, p, r in wells]
+
+      lims = FakeLims({
+         status_report.rnawell_url:      rnawells,
+         status_report.pcrwell_url:      [{'rna_extraction_well': '/rw/{}/'.format(s), 'pcr_plate': '/pcrplate/{}/'.format(p)} for s, p in [('S1', 1), ('S2', 1), ('S3', 2), ('T1', 1)]],
+         status_report.pcrproject_url:   [{'pcr_plate': '/pcrplate/1/', 'project': '/proj/1/', 'results_sent': 'Y', 'diagnosis_completed': False, 'diagnosis_sent': False}],
+         status_report.pcrrun_url:       [{'pcr_plate': '/pcrplate/1/', 'status': 'OK'}, {'pcr_plate': '/pcrplate/2/', 'status': 'F'}],
+         status_report.pcrplate_url:     [{'barcode': 'R1P1', 'id': 1, 'resource_uri': '/pcrplate/1/'}, {'barcode': 'R2P1', 'id': 2, 'resource_uri': '/pcrplate/2/'}],
+         status_report.project_url:      [{'resource_uri': '/proj/1/', 'name': 'ORFEU', 'organization': '/org/1/'}, {'resource_uri': '/proj/2/', 'name': 'TESTS', 'organization': '/org/1/'}],
+         status_report.rnaplate_url:     [{'barcode': r, 'date_prepared': '2020-05-0{}T10:00:00'.format(i)} for i, r in enumerate(['R1', 'R2', 'R3'], 1)],
+         status_report.organization_url: [{'resource_uri': '/org/1/', 'name': 'CNAG'}]
+      })
+
+      with tempfile.TemporaryDirectory() as tmp:
+         with open(os.path.join(tmp, 'R1P1_results.txt'), 'w') as f:
+            f.write('results')
+         snapshot = SnapshotStore(os.path.join(tmp, 'snapshot'))
+         status   = status_report.StatusReport('user', 'password', session=lims, snapshot=snapshot, job_name='job')
+         report, stats = status.build(tmp)
+
+         # Projected frames, stored in the snapshot
+         self.assertEqual(status.get_frame('rnaextractionwell', status_report.rnawell_base, status_report.rnawell_fields, '').columns.tolist(), status_report.rnawell_fields)
+         self.assertEqual(len(snapshot.collections()), 8)
+
+         self.assertEqual(dict(zip(stats['sample'], stats['status'])), {'S1': 'SENT', 'S2': 'SENT', 'S3': 'FAILED', 'S4': 'RNA', 'T1': 'VERIFIED'})
+         self.assertEqual(stats[stats['sample'] == 'S3']['pcrplate'].tolist(), ['R2P1'])
+         self.assertEqual([(rna['barcode'], [(p['barcode'], p['sdsfile'], p['uploaded'], p['verified']) for p in rna['pcr']]) for rna in report], [
+            ('R1', [('R1P1', True, True, 'OK')]),
+            ('R2', [('R2P1', False, True, 'F')]),
+            ('R3', [])
+         ])
+         self.assertEqual(report[0]['pcr'][0]['projects'], [{'name': 'ORFEU', 'org': 'CNAG', 'sent': 'Y', 'reviewed': False, 'done': False, 'samples': 2}])
+
+         html = status.render_report(report, stats).render()
+         # Sample stats of ORFEU (TESTS is not a reported project)
+         self.assertIn('<td><b>ORFEU</b></td><td>1</td><td>0</td><td>0</td><td><a href="#failedORFEU">1</a></td><td>0</td><td>0</td><td>2</td><td>0</td>', html)
+         self.assertNotIn('<b>TESTS</b>', html)
+         # Only R3 (no pcr plate) is in progress, R1P1 awaits the diagnosis
+         self.assertIn('<td><b>R3</b></td><td>2020-05-03 10:00:00</td>' + status_report.no_cells, html)
+         self.assertNotIn('<td><b>R1</b></td><td>2020-05-01 10:00:00</td>', html)
+         self.assertIn('<td><b>R1P1</b></td><td>ORFEU</td><td>CNAG</td><td>2</td>', html)
+         self.assertIn('R2P1\tS3<br>', html)
+
+         # Fresh snapshots are reused, only the sample counts are queried
+         lims.calls = []
+         status = status_report.StatusReport('user', 'password', session=lims, snapshot=snapshot, snapshot_max_age=3600, job_name='job')
+         self.assertEqual(status.build(tmp)[0], report)
+         self.assertEqual(lims.calls, [('GET', status_report.rnawell_url)])
+
+
+class TestSnapshot(unittest.TestCase):
+
+   def test_roundtrip(self):
+      import tempfile
+      from columnar import SnapshotStore
+
+      objs = [
+         {'id': 1, 'barcode': 'P001', 'ok': True,  'ct': 21.5, 'sample': {'project': '/p/1/'}},
+         {'id': 2, 'barcode': 'P002', 'ok': False, 'ct': None, 'sample': None}
+      ]
+
+      with tempfile.TemporaryDirectory() as root:
+         store = SnapshotStore(root)
+         store.save('pcrplate', objs)
+         self.assertEqual(store.collections(), ['pcrplate'])
+         self.assertTrue(store.is_fresh('pcrplate', 60))
+
+         # Column-selective, memory-mapped load
+         data, nulls = store.load('pcrplate', ['barcode', 'id'])
+         self.assertEqual(list(data['barcode']), ['P001', 'P002'])
+         self.assertEqual(data['id'].dtype.kind, 'i')
+
+         self.assertEqual(store.load_records('pcrplate'), objs)
+         self.assertIsNone(store.load('pcrplate', max_age=-1))
+
+   def test_page_projection(self):
+      from columnar import ColumnBuilder
+
+      columns = ColumnBuilder(['resource_uri', 'sample__project', 'sample__barcode', 'ct'])
+      columns.append([{'resource_uri': '/w/1/', 'sample': {'project': '/p/1/', 'barcode': 'S1'}, 'ct': None, 'extra': 'x'}])
+      columns.append([{'resource_uri': '/w/2/', 'sample': {'project': '/p/2/', 'barcode': 'S22'}, 'ct': 30}])
+
+      frame = columns.frame()
+      self.assertEqual(list(frame.columns), ['resource_uri', 'sample__project', 'sample__barcode', 'ct'])
+      self.assertEqual(list(frame['sample__barcode']), ['S1', 'S22'])
+      self.assertTrue(frame['ct'].isna()[0])
+      self.assertEqual(frame['ct'][1], 30)
+
+
+class TestArchive(unittest.TestCase):
+
+   def test_partitioned_query(self):
+      import tempfile, datetime
+      from archive import ResultsArchive
+
+      def results(plate, detectors, cts):
+         return {
+            'plate':     [plate]*len(cts),
+            'well':      list(range(1, len(cts)+1)),
+            'detector':  detectors,
+            'ct':        cts,
+            'threshold': [0.2]*len(cts),
+            'run_date':  [datetime.datetime(2020, 5, 1)]*len(cts)
+         }
+
+      with tempfile.TemporaryDirectory() as root:
+         archive = ResultsArchive(root)
+         archive.write('results', 'P1', '2020-05-01', 'viia7',  results('P1', ['N1', 'N2'], [30.5, float('nan')]))
+         archive.write('results', 'P2', '2020-06-02', '7900HT', results('P2', ['N1'], [25.0]))
+         self.assertEqual([p[:2] for p in archive.partitions('results')], [('2020-05-01', 'viia7'), ('2020-06-02', '7900ht')])
+
+         data = archive.load('results', ['plate', 'ct'], start='2020-05-01', end='2020-05-31', detector='N1')
+         self.assertEqual(list(data['plate']), ['P1'])
+         self.assertEqual(data['ct'].dtype, 'float64')
+         self.assertEqual(len(archive.load('results', instrument='7900HT')['plate']), 1)
+
+         # Rewriting a plate replaces its entry, also across partitions
+         archive.write('results', 'P1', '2020-06-02', 'viia7', results('P1', ['N1'], [31.0]))
+         self.assertEqual(sorted(archive.load('results', ['plate'], detector='N1')['plate']), ['P1', 'P2'])
+         self.assertEqual(len(archive.load('results', ['plate'], end='2020-05-31')['plate']), 0)
+
+
+class TestLeases(unittest.TestCase):
+
+   def test_shards(self):
+      from leases import shard_of, parse_shard
+      plates  = ['PLATE{}'.format(i) for i in range(100)]
+      shards  = [shard_of(p, 3) for p in plates]
+      self.assertEqual(set(shards), {0, 1, 2})
+      self.assertEqual(shards, [shard_of(p.lower(), 3) for p in plates])
+      self.assertEqual(parse_shard('1/3'), (1, 3))
+      with self.assertRaises(ValueError):
+         parse_shard('3/3')
+
+   def test_plate_leases(self):
+      import tempfile, time
+      from leases import PlateLeases
+
+      with tempfile.TemporaryDirectory() as tmp:
+         a = PlateLeases(tmp, owner='a', ttl=60)
+         b = PlateLeases(tmp, owner='b', ttl=60)
+         self.assertTrue(a.acquire('P1'))
+         self.assertFalse(b.acquire('P1'))
+         self.assertTrue(a.renew('P1'))
+
+         # Released leases can be taken by other workers
+         a.release('P1')
+         self.assertTrue(b.acquire('P1'))
+
+         # Expired leases of crashed workers are reclaimed
+         old = time.time() - 120
+         os.utime(os.path.join(tmp, 'P1.lease'), (old, old))
+         self.assertTrue(a.acquire('P1'))
+         self.assertFalse(b.renew('P1'))
+         self.assertTrue(a.owns('P1'))
+         b.release('P1')
+         self.assertTrue(a.owns('P1'))
+         self.assertEqual(sorted(os.listdir(tmp)), ['P1.lease'])
+
+
+class TestCheckpoint(unittest.TestCase):
+
+   def test_resume_state(self):
+      import tempfile
+      from checkpoint import UploadCheckpoint
+
+      with tempfile.TemporaryDirectory() as tmp:
+         src = os.path.join(tmp, 'P1_results.txt')
+         with open(src, 'w') as f:
+            f.write('results')
+
+         ckpt = UploadCheckpoint(os.path.join(tmp, 'ckpt'))
+         self.assertEqual(ckpt.load('P1', [src]), {})
+         ckpt.complete('P1', {'A1': '/results/1/', 'A2': '/results/2/'})
+         ckpt.keep('P1', {'A1': '/results/1/'})
+         self.assertEqual(UploadCheckpoint(os.path.join(tmp, 'ckpt')).load('P1', [src]), {'A1': '/results/1/'})
+
+         # Changed source files invalidate the checkpoint
+         with open(src, 'a') as f:
+            f.write('reanalysis')
+         self.assertEqual(ckpt.load('P1', [src]), {})
+         ckpt.clear('P1')
+         self.assertEqual(os.listdir(os.path.join(tmp, 'ckpt')), [])
+
+
+class TestParseCache(unittest.TestCase):
+
+   def test_content_key(self):
+      import tempfile
+      import pandas as pd
+      from parse_cache import ParseCache
+
+      with tempfile.TemporaryDirectory() as tmp:
+         src = os.path.join(tmp, 'P1_results.txt')
+         with open(src, 'w') as f:
+            f.write('Well\tCt\n1\t30.1\n')
+
+         cache = ParseCache(os.path.join(tmp, 'cache'))
+         key   = cache.key('viia7:1', [src])
+         self.assertIsNone(cache.get(key))
+         cache.put(key, (pd.DataFrame({'Ct': ['30.1']}), None, '2020-05-01'))
+         results, rn, run_date = cache.get(key)
+         self.assertEqual(list(results['Ct']), ['30.1'])
+         self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+         # Parser version and file contents are part of the key
+         self.assertNotEqual(cache.key('viia7:2', [src]), key)
+         with open(src, 'a') as f:
+            f.write('2\t31.0\n')
+         self.assertNotEqual(cache.key('viia7:1', [src]), key)
+
+   def test_unloadable_entry(self):
+      import tempfile
+      from parse_cache import ParseCache
+
+      with tempfile.TemporaryDirectory() as tmp:
+         src = os.path.join(tmp, 'P1_results.txt')
+         with open(src, 'w') as f:
+            f.write('Well\tCt\n1\t30.1\n')
+
+         cache = ParseCache(os.path.join(tmp, 'cache'))
+         key   = cache.key('viia7:1', [src])
+         # Library versions are part of the key
+         cache.versions = 'pandas=0.0;numpy=0.0'
+         self.assertNotEqual(cache.key('viia7:1', [src]), key)
+
+         # Entry referring to a class that no longer exists (AttributeError)
+         fname = cache._fname(key)
+         os.makedirs(os.path.dirname(fname))
+         with open(fname, 'wb') as f:
+            f.write(b'cparse_cache\nNoSuchClass\n.')
+         self.assertIsNone(cache.get(key))
+         self.assertFalse(os.path.exists(fname))
+         self.assertEqual(cache.misses, 1)
+
+
+class TestCtCalling(unittest.TestCase):
+
+   def test_vectorized_ct(self):
+      import numpy as np
+      from ct_calling import call_ct
+
+      # Sigmoid curves on a sloped baseline, well 3 does not amplify
+      cycles = np.arange(1, 41)
+      wells, cyc, rn = [], [], []
+      for well, mid in [(1, 25.0), (2, 30.0), (3, None)]:
+         curve = 1.0 + 0.002*cycles
+         if mid is not None:
+            curve = curve + 2.0/(1 + np.exp(-(cycles - mid)))
+         wells += [well]*len(cycles)
+         cyc   += list(cycles)
+         rn    += list(curve)
+
+      ids, ct = call_ct(wells, cyc, rn, {1: 0.2, 2: 0.2, 3: 0.2})
+      self.assertEqual(list(ids), [1, 2, 3])
+      # 2/(1+exp(-(c-mid))) = 0.2 at c = mid - ln(9)
+      self.assertAlmostEqual(ct[0], 25.0 - np.log(9), delta=0.2)
+      self.assertAlmostEqual(ct[1], 30.0 - np.log(9), delta=0.2)
+      self.assertTrue(np.isnan(ct[2]))
+
+
+class TestAmplification(unittest.TestCase):
+
+   def test_matrix_slices(self):
+      pd = pytest.importorskip('pandas')
+      import numpy as np
+      import lims_sync
+      from amplification import AmplificationMatrix
+
+      # Unsorted long-format table, well 3 has one cycle less
+      rn = pd.DataFrame({
+         'well':     [3, 1, 1, 3, 1],
+         'cycle':    [2, 3, 1, 1, 2],
+         'rep':      ['N1']*5,
+         'Rn':       [1.5, 1.3, 1.001, 1.4, 1.2],
+         'Delta Rn': [0.5, 0.3, 0.0, 0.4, 0.2]
+      })
+      curves = AmplificationMatrix.from_frame(rn)
+      self.assertEqual(curves.values.shape, (2, 3, 2))
+      self.assertEqual(curves.values.dtype, np.float64)
+      self.assertTrue(np.shares_memory(curves.curves(1), curves.values))
+      self.assertEqual(curves.curves(3).shape, (2, 2))
+      self.assertEqual(curves.curves(2).shape, (0, 2))
+      self.assertTrue(3 in curves and 2 not in curves)
+
+      # Payloads keep the exported decimals
+      data = lims_sync.amplification_data(curves.curves(1), '/r/1/')
+      self.assertEqual(data, [
+         {'results': '/r/1/', 'cycle': 1, 'rn': 1.001, 'delta_rn': 0.0},
+         {'results': '/r/1/', 'cycle': 2, 'rn': 1.2,   'delta_rn': 0.2},
+         {'results': '/r/1/', 'cycle': 3, 'rn': 1.3,   'delta_rn': 0.3}
+      ])
+      self.assertIsInstance(data[0]['rn'], float)
+
+
+class TestPlateGeometry(unittest.TestCase):
+
+   def test_lookup_tables(self):
+      from plate_geometry import plate_96, plate_384
+
+      self.assertEqual(plate_96.position[1], 'A1')
+      self.assertEqual(plate_96.position[96], 'H12')
+      self.assertEqual(plate_384.position[[1, 24, 25, 384]].tolist(), ['A1', 'A24', 'B1', 'P24'])
+      self.assertEqual(plate_384.well_number('B2'), 26)
+      self.assertEqual(plate_384.well_number('b02'), 26)
+
+      # 2x2 sample blocks: C3 (well 51) is the top left well of parent B2
+      for pos in ['C3', 'C4', 'D3', 'D4']:
+         w = plate_384.well_number(pos)
+         self.assertEqual(plate_384.base[w], 51)
+         self.assertEqual(plate_96.position[plate_384.parent_well[w]], 'B2')
+         self.assertEqual((plate_384.parent_row[w], plate_384.parent_col[w]), (1, 1))
+      self.assertEqual(plate_384.quadrant[[51, 52, 75, 76]].tolist(), [0, 1, 2, 3])
+      self.assertEqual(plate_384.block[76].tolist(), [51, 52, 75, 76])
+
+
+class TestSyncState(unittest.TestCase):
+
+   def test_changed_exports(self):
+      import tempfile
+      from sync_state import SyncState
+
+      with tempfile.TemporaryDirectory() as tmp:
+         results = os.path.join(tmp, 'P1_results.txt')
+         with open(results, 'w') as f:
+            f.write('results')
+
+         state = SyncState(os.path.join(tmp, 'state.json'))
+         self.assertTrue(state.changed(results))
+         state.record(results)
+         state.save()
+
+         state = SyncState(os.path.join(tmp, 'state.json'))
+         self.assertFalse(state.changed(results))
+
+         # A new clipped file changes the export
+         with open(os.path.join(tmp, 'P1_clipped.txt'), 'w') as f:
+            f.write('clipped')
+         self.assertTrue(state.changed(results))
+
+         # Failed exports are retried after the delay
+         state.record(results, retry_after=3600)
+         self.assertFalse(state.changed(results))
+         state.record(results, retry_after=-1)
+         self.assertTrue(state.changed(results))
+
+
+class TestProfiling(unittest.TestCase):
+
+   def test_phase_profiler(self):
+      import tempfile, pstats
+      from profiling import PhaseProfiler
+
+      # Disabled profiler writes nothing
+      self.assertEqual(PhaseProfiler().dump(), [])
+
+      with tempfile.TemporaryDirectory() as tmp:
+         profiler = PhaseProfiler(tmp, 'job', profile=True, trace_memory=True)
+         try:
+            for plate in ['P1', 'P2']:
+               with profiler.phase('upload', plate):
+                  with profiler.phase('parse', plate):
+                     [list(range(100)) for i in range(100)]
+            written = profiler.dump()
+         finally:
+            import tracemalloc
+            tracemalloc.stop()
+
+         self.assertEqual(sorted(os.path.basename(f) for f in written),
+                          ['job_parse.prof', 'job_parse_memory.txt', 'job_upload.prof', 'job_upload_memory.txt'])
+         self.assertGreater(pstats.Stats(os.path.join(tmp, 'job_parse.prof')).total_calls, 0)
+         with open(os.path.join(tmp, 'job_upload_memory.txt')) as f:
+            reports = f.read()
+         self.assertIn('## upload P1', reports)
+         self.assertIn('## upload P2', reports)
+         self.assertEqual(profiler.stack, [])
+
+
+class TestDashboard(unittest.TestCase):
+
+   def test_snapshot_and_server(self):
+      import threading
+      from dashboard import Dashboard, ThreadingHTTPServer
+
+      pages = iter(['<html><body><p>one</p></body></html>', None])
+      def build():
+         page = next(pages)
+         if page is None:
+            raise RuntimeError('LIMS <down>')
+         return page
+
+      dashboard = Dashboard(build, interval=3600)
+      self.assertTrue(dashboard.refresh())
+      self.assertEqual(dashboard.page(), b'<html><body><p>one</p></body></html>')
+
+      # A failed refresh keeps the last snapshot, the error is shown (escaped)
+      # at the top of its body
+      self.assertFalse(dashboard.refresh())
+      page = dashboard.page()
+      self.assertIn(b'LIMS &lt;down&gt;', page)
+      self.assertTrue(page.startswith(b'<html><body><p style="color:red">'))
+      self.assertTrue(page.endswith(b'<p>one</p></body></html>'))
+
+      server = ThreadingHTTPServer(('127.0.0.1', 0), dashboard.handler())
+      thread = threading.Thread(target=server.serve_forever, daemon=True)
+      thread.start()
+      try:
+         url = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+         with urlopen(url) as response:
+            self.assertEqual(response.read(), dashboard.page())
+         with self.assertRaises(IOError):
+            urlopen(url + 'missing')
+      finally:
+         server.shutdown()
+         server.server_close()
+      self.assertEqual(dashboard.refreshes, 1)
+
+
+class TestMailer(unittest.TestCase):
+
+   def test_spooled_delivery(self):
+      import smtplib, tempfile, time
+      from email import message_from_string
+      from email.mime.text import MIMEText
+      from unittest import mock
+      from spool import Spool
+      import mailer
+
+      with tempfile.TemporaryDirectory() as tmp:
+         spool  = Spool(tmp)
+         smtp   = mailer.Mailer('lims@example.org', 'secret', 'a@example.org,b@example.org')
+         queued = mailer.SpooledMailer(smtp, spool)
+         for i in range(5):
+            queued.send('digest {}'.format(i), [MIMEText('<p>{}</p>'.format(i), 'html')])
+         self.assertEqual(len(spool), 5)
+
+         sender = mailer.SpoolSender(spool, smtp, coalesce=3)
+         with mock.patch('mailer.smtplib.SMTP_SSL') as SMTP:
+            # Connection failure: entries are kept and retried later
+            SMTP.return_value.login.side_effect = smtplib.SMTPAuthenticationError(535, b'denied')
+            self.assertEqual(sender.send_pending(), 0)
+            entry = spool.read(spool.entries()[0])
+            self.assertEqual(entry['attempts'], 1)
+            self.assertGreater(entry['next_try'], time.time())
+            self.assertEqual(sender.due(), [])
+
+            # Delivery fell behind: one connection, one coalesced e-mail
+            SMTP.return_value.login.side_effect = None
+            self.assertEqual(len(sender.due(now=time.time() + mailer.retry_cap)), 5)
+            with mock.patch('mailer.time.time', return_value=time.time() + mailer.retry_cap):
+               self.assertEqual(sender.send_pending(), 5)
+            self.assertEqual(SMTP.call_count, 2)
+            server = SMTP.return_value
+            self.assertEqual(server.sendmail.call_count, 1)
+            _, receivers, message = server.sendmail.call_args[0]
+            self.assertEqual(receivers, ['a@example.org', 'b@example.org'])
+            attached = [p for p in message_from_string(message).walk() if p.get_content_type() == 'message/rfc822']
+            self.assertEqual(len(attached), 5)
+            self.assertEqual(len(spool), 0)
+
+            # Below the threshold digests are sent as they are
+            queued.send('digest 5', [MIMEText('<p>5</p>', 'html')])
+            self.assertEqual(sender.send_pending(), 1)
+            self.assertIn('Subject: digest 5', server.sendmail.call_args[0][2])
+
+
+class TestHtmlReport(unittest.TestCase):
+
+   def test_index_and_budget(self):
+      import gzip
+      from html_report import HtmlReport
+
+      html = HtmlReport('td { padding: 10px; }', size_budget=200)
+      html.title('Report')
+      html.section('first', 'First section:', 'First section')
+      html.write('<p>short</p>')
+      html.section('long', 'Long section')
+      html.begin_block()
+      html.write(*['<tr><td>{}</td></tr>'.format(i) for i in range(100)])
+      self.assertTrue(html.end_block('long_table', 'Long table'))
+
+      doc = html.render()
+      self.assertTrue(doc.index('<h1>Report</h1>') < doc.index('- <a href="#first">First section</a><br>') < doc.index('<p>short</p>'))
+      self.assertFalse('<td>99</td>' in doc)
+
+      fname, data = html.attachments[0]
+      self.assertEqual(fname, 'long_table.html.gz')
+      self.assertTrue('<td>99</td>' in gzip.decompress(data).decode())
+      self.assertEqual(len(html.mime_parts()), 2)
+
+
+class TestLogging(unittest.TestCase):
+
+   def test_plate_log_index(self):
+      from lims_logging import PlateLogIndex
+
+      index  = PlateLogIndex()
+      logger = logging.getLogger('test_plate_log_index')
+      logger.addHandler(index)
+      logger.setLevel(logging.INFO)
+
+      logger.info('[pcrplate=P1/pcrwell=A1] BEGIN pcrwell processing')
+      logger.warning('[pcrplate=P1/pcrwell=A1] detector RP not found')
+      logger.error('[pcrplate=P10] error creating PCRRUN in LIMS')
+      logger.critical('[pcrplate=P10] critical')
+
+      self.assertEqual(len(index.lines('P1', logging.WARNING)), 1)
+      self.assertEqual(index.lines('P1', logging.ERROR), [])
+      self.assertEqual(len(index.lines('P10', logging.ERROR)), 2)
+      self.assertEqual(index.plates(logging.ERROR), ['P10'])
+
+   def test_async_log_handler(self):
+      import json, tempfile
+      from lims_logging import log_handler, log_phase
+
+      with tempfile.TemporaryDirectory() as tmp:
+         fname   = os.path.join(tmp, 'run.log')
+         handler = log_handler(fname, json_lines=True, summary=True)
+         logger  = logging.getLogger('test_async_log_handler')
+         logger.addHandler(handler)
+         logger.setLevel(logging.INFO)
+         logger.propagate = False
+
+         logger.info(' job started')
+         with log_phase('upload'):
+            for well in ['A1', 'A2', 'A3']:
+               logger.info('[pcrplate=P1/pcrwell={}] BEGIN pcrwell processing'.format(well))
+               logger.info('[pcrplate=%s/pcrwell=%s] post(results) = %s', 'P1', well, 201)
+            logger.warning('[pcrplate=P1/pcrwell=A2] detector RP not found')
+            logger.info('[pcrplate=P1] SUCCESS pcrplate processing')
+         logger.removeHandler(handler)
+         handler.close()
+
+         with open(fname) as f:
+            lines = [json.loads(line) for line in f]
+         self.assertEqual([l['message'] for l in lines], [
+            ' job started',
+            '[pcrplate=P1/pcrwell=A2] detector RP not found',
+            '[pcrplate=P1] 6 pcrwell INFO lines collapsed (3 wells: A1..A3)',
+            '[pcrplate=P1] SUCCESS pcrplate processing'
+         ])
+         self.assertEqual((lines[1]['plate'], lines[1]['well'], lines[1]['phase']), ('P1', 'A2', 'upload'))
+         self.assertIsNone(lines[0]['phase'])
+
+
+class TestLimsClient(unittest.TestCase):
+
+   def test_encode_body(self):
+      import gzip, json
+      from lims_client import RequestStats, encode_body, json_encoders
+
+      data  = {'objects': [{'results': '/api/results/1/', 'cycle': i, 'rn': 1.5} for i in range(100)]}
+      stats = RequestStats()
+      for encoder in json_encoders:
+         body, headers = encode_body(data, encoder, False, stats)
+         self.assertEqual(json.loads(body), data)
+         self.assertEqual(headers, {})
+
+      body, headers = encode_body(data, 'json', True, stats)
+      self.assertEqual(headers, {'Content-Encoding': 'gzip'})
+      self.assertEqual(json.loads(gzip.decompress(body)), data)
+      self.assertEqual(encode_body(None, stats=stats), (None, {}))
+
+      self.assertEqual(stats.requests, len(json_encoders) + 2)
+      self.assertLess(stats.wire_bytes, stats.body_bytes)
+
+   def test_non_finite_values(self):
+      import numpy as np
+      from lims_client import encode_body, json_encoders
+
+      # NaN and infinity are sent as null by every encoder
+      data = {'objects': [{'cycle': 1, 'rn': float('nan'), 'delta_rn': np.float64('inf')}, {'cycle': 2, 'rn': 1.5, 'delta_rn': (0.5, float('-inf'))}]}
+      for encoder in json_encoders:
+         body, _ = encode_body(data, encoder)
+         self.assertEqual(body, b'{"objects":[{"cycle":1,"rn":null,"delta_rn":null},{"cycle":2,"rn":1.5,"delta_rn":[0.5,null]}]}')
+
+   def test_retry_and_breaker(self):
+      from unittest import mock
+      import requests
+      import lims_client
+
+      session = lims_client.LimsSession(retries=2, breaker=lims_client.CircuitBreaker(failure_threshold=3, reset_timeout=60))
+      with mock.patch('lims_client.time.sleep'), mock.patch.object(session.http, 'request') as request:
+         # Transient errors on idempotent calls are retried
+         request.side_effect = [FakeResponse(502), requests.Timeout(), FakeResponse(200)]
+         self.assertEqual(session.request('GET', 'url').status_code, 200)
+         self.assertEqual(session.stats.retries, 2)
+
+         # POST is sent once
+         request.side_effect = [FakeResponse(503)]
+         self.assertEqual(session.request('POST', 'url', json_data={}).status_code, 503)
+
+         # Three consecutive failures open the circuit, retries stop
+         request.side_effect = [FakeResponse(503), FakeResponse(503)]
+         with self.assertRaises(lims_client.LimsUnavailable):
+            session.request('DELETE', 'url')
+         self.assertEqual(session.breaker.state, 'open')
+         with self.assertRaises(lims_client.LimsUnavailable):
+            session.request('GET', 'url')
+         self.assertEqual(request.call_count, 6)
+
+   def test_adaptive_limiter(self):
+      from lims_client import AdaptiveLimiter
+
+      limiter = AdaptiveLimiter(initial=4, minimum=1, maximum=8)
+      for i in range(20):
+         limiter.acquire()
+         limiter.release(0.1, key='GET')
+      self.assertGreater(limiter.limit, 6)
+      limiter.acquire()
+      limiter.release(error=True)
+      self.assertLess(limiter.limit, 4.5)
+      limit = limiter.limit
+      limiter.acquire()
+      limiter.release(1.0, key='GET')
+      self.assertLess(limiter.limit, limit)
+      self.assertEqual(limiter.inflight, 0)
+
+
+class TestSyncFolder(unittest.TestCase):
+
+   def test_hash_cache(self):
+      import hashlib, tempfile
+      import sync_folder
+
+      with tempfile.TemporaryDirectory() as tmp:
+         fname = os.path.join(tmp, 'plate_results.txt')
+         cache_file = os.path.join(tmp, 'cache.json')
+         with open(fname, 'wb') as f:
+            f.write(b'x' * (sync_folder.hash_buffer_size + 10))
+
+         cache = sync_folder.HashCache(cache_file)
+         digest = cache.digest(fname)
+         self.assertEqual(digest, hashlib.md5(b'x' * (sync_folder.hash_buffer_size + 10)).hexdigest())
+         cache.save()
+
+         # Unchanged file: digest is reused from disk
+         cache = sync_folder.HashCache(cache_file)
+         self.assertEqual(cache.digest(fname), digest)
+         self.assertEqual((cache.hashed, cache.cached), (0, 1))
+
+         # Modified file: digest is recomputed
+         with open(fname, 'ab') as f:
+            f.write(b'y')
+         self.assertNotEqual(cache.digest(fname), digest)
+         self.assertEqual(cache.hashed, 1)
+
+   def test_copy_file(self):
+      import tempfile
+      import sync_folder
+
+      with tempfile.TemporaryDirectory() as tmp:
+         src = os.path.join(tmp, 'src.txt')
+         dst = os.path.join(tmp, 'dst.txt')
+         with open(src, 'w') as f:
+            f.write('new')
+         with open(dst, 'w') as f:
+            f.write('old')
+
+         sync_folder.copy_file(src, dst, dst + '.oldhash')
+         with open(dst) as f:
+            self.assertEqual(f.read(), 'new')
+         with open(dst + '.oldhash') as f:
+            self.assertEqual(f.read(), 'old')
+         # No temporary files left behind
+         self.assertEqual(sorted(os.listdir(tmp)), ['dst.txt', 'dst.txt.oldhash', 'src.txt'])
+
+   def test_short_copy(self):
+      import tempfile
+      from unittest import mock
+      import sync_folder
+
+      with tempfile.TemporaryDirectory() as tmp:
+         src = os.path.join(tmp, 'src.txt')
+         dst = os.path.join(tmp, 'dst.txt')
+         with open(src, 'w') as f:
+            f.write('new' * 1000)
+         with open(dst, 'w') as f:
+            f.write('old')
+
+         # Kernel copies that copy nothing fall through to the buffered copy
+         with mock.patch('os.copy_file_range', return_value=0, create=True), mock.patch('os.sendfile', return_value=0, create=True):
+            sync_folder.copy_file(src, dst)
+         with open(dst) as f:
+            self.assertEqual(f.read(), 'new' * 1000)
+
+         # A short copy is never published
+         with open(dst, 'w') as f:
+            f.write('old')
+         with mock.patch('sync_folder.kernel_copy', return_value=10):
+            with self.assertRaises(IOError):
+               sync_folder.copy_file(src, dst)
+         with open(dst) as f:
+            self.assertEqual(f.read(), 'old')
+         self.assertEqual(sorted(os.listdir(tmp)), ['dst.txt', 'src.txt'])
+
+   def test_scan_and_manifest(self):
+      import tempfile
+      import sync_folder
+
+      with tempfile.TemporaryDirectory() as tmp:
+         os.makedirs(os.path.join(tmp, 'sub'))
+         for relpath in ['a_results.txt', os.path.join('sub', 'b_results.txt')]:
+            with open(os.path.join(tmp, relpath), 'w') as f:
+               f.write(relpath)
+
+         self.assertEqual(sorted(sync_folder.scan_tree(tmp)), ['a_results.txt'])
+         files = sync_folder.scan_tree(tmp, recursive=True)
+         self.assertEqual(sorted(files), ['a_results.txt', os.path.join('sub', 'b_results.txt')])
+
+         manifest = sync_folder.SyncManifest(os.path.join(tmp, 'manifest.json'))
+         srcs = [('src', files['a_results.txt'])]
+         self.assertFalse(manifest.unchanged('a_results.txt', srcs, files['a_results.txt']))
+         manifest.update('a_results.txt', srcs, files['a_results.txt'])
+         manifest.save()
+
+         manifest = sync_folder.SyncManifest(os.path.join(tmp, 'manifest.json'))
+         self.assertTrue(manifest.unchanged('a_results.txt', srcs, files['a_results.txt']))
+         self.assertFalse(manifest.unchanged('a_results.txt', srcs, None))
+
+   def test_spool(self):
+      import tempfile
+      from spool import Spool
+
+      with tempfile.TemporaryDirectory() as tmp:
+         spool = Spool(os.path.join(tmp, 'spool'))
+         first = spool.put({'files': ['a_results.txt']})
+         second = spool.put({'files': ['b_clipped.txt']})
+         self.assertEqual(spool.entries(), [first, second])
+         self.assertEqual(spool.read(second), {'files': ['b_clipped.txt']})
+         spool.ack(first)
+         spool.ack(first)
+         self.assertEqual(len(spool), 1)